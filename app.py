@@ -25,6 +25,30 @@ from db import (
     map_categories_for_df,
     rename_category,
     compute_unique_keys_for_df,
+    list_ignored,
+    restore_ignored,
+    clear_ignored,
+    clear_transactions,
+    filter_tombstoned,
+    compact_ignored,
+    ignored_retention_days,
+    ensure_month_partitions,
+    get_usuario,
+    get_categoria_ids,
+    intern_comercios,
+    refresh_comercio_stats,
+    count_pending,
+    accept_suggestions,
+    pair_reimbursements,
+)
+from classifier import learn_categories
+from rules import flag_rules
+from suggest import (
+    SUGGESTION_SOURCES,
+    ensure_suggestions_fresh,
+    history_for_similarity,
+    pending_suggestions,
+    refresh_suggestions,
 )
 
 st.set_page_config(page_title="Dashboard de Facto$", layout="wide")
@@ -250,6 +274,15 @@ div[data-testid="stMetric"] [data-testid="stMetricDelta"]{
   padding: 0.6rem 0.9rem;
   margin-bottom: 0.3rem;
 }
+.pending-badge{
+  display: inline-block;
+  background: rgba(234,179,8,0.15);
+  border: 1px solid rgba(234,179,8,0.5);
+  border-radius: 999px;
+  padding: 0.15rem 0.7rem;
+  font-weight: 600;
+  text-decoration: none !important;
+}
 
 /* Data editor / tables */
 [data-testid="stDataFrame"]{
@@ -482,305 +515,78 @@ def load_df(file, date_format: str = "YYYY-MM-DD"):
     # y upsert para garantizar consistencia con la BD (hashlib determinístico, no Python hash())
     return df
 
-def _suggest_by_name_amount(hist_df, detalle_norm, monto, top_k=3):
-    if hist_df is None or hist_df.empty:
-        return []
-    normalized = str(detalle_norm or "").strip().upper()
-    if not normalized:
-        return []
-    matches = hist_df[hist_df["detalle_norm_cmp"] == normalized]
-    if matches.empty and len(normalized) >= 4:
-        prefix = normalized[:4]
-        matches = hist_df[hist_df["detalle_norm_cmp"].str.contains(prefix, na=False)]
-    if matches.empty:
-        return []
-    try:
-        monto_val = abs(float(pd.to_numeric(monto, errors="coerce") or 0.0))
-    except Exception:
-        monto_val = 0.0
-    if monto_val > 0:
-        tol = max(monto_val * 0.25, 1000)
-        low, high = monto_val - tol, monto_val + tol
-        filtered = matches[
-            (pd.to_numeric(matches["monto"], errors="coerce").fillna(0).abs() >= low)
-            & (pd.to_numeric(matches["monto"], errors="coerce").fillna(0).abs() <= high)
-        ]
-        if not filtered.empty:
-            matches = filtered
-    counts = (
-        matches.groupby("categoria")
-        .size()
-        .sort_values(ascending=False)
-        .head(top_k)
-    )
-    total = counts.sum()
-    suggestions = []
-    for cat, cnt in counts.items():
-        suggestions.append({"categoria": cat, "score": float(cnt) / float(total or 1)})
-    return suggestions
-
-
-def apply_category_change(conn, df_reference, unique_key: str, new_category: str):
-    if not unique_key or not new_category:
-        return False
-    target = df_reference[df_reference["unique_key"] == unique_key]
-    if target.empty:
-        return False
-    row = target.iloc[0].copy()
-    row["categoria"] = new_category
-    edits_df = pd.DataFrame([row])
-    try:
-        updated = apply_edits(conn, edits_df)
-        if updated:
-            try:
-                update_categoria_map_from_df(conn, edits_df)
-            except Exception:
-                pass
-            return True
-    except Exception as _apply_e:
-        st.error(f"No se pudo aplicar la categoría: {_apply_e}")
-    return False
-
-
-def build_suggestions_df(df, conn, hist_df=None):
-    """Construir DataFrame de sugerencias de categoría (optimizado, consultas en lote)."""
-    # Filas sin categoría o "Sin categoría"
-    mask = (df["categoria"].isna()) | (df["categoria"] == "") | (df["categoria"] == "Sin categoría")
-    sug_df = df[mask].copy()
-    if sug_df.empty:
-        return pd.DataFrame()
-
-    # Asegurar columna detalle_norm consistente
-    sug_df = sug_df.copy()
-    if "detalle_norm" not in sug_df.columns:
-        def _norm(s):
-            if pd.isna(s):
-                return ""
-            s = str(s).strip()
-            s = unicodedata.normalize("NFKD", s)
-            s = "".join(ch for ch in s if not unicodedata.combining(ch))
-            s = s.replace("\n", " ").replace("\t", " ")
-            s = "".join(ch if ch.isalnum() or ch.isspace() else " " for ch in s)
-            return " ".join(s.upper().split())
-        sug_df["detalle_norm"] = sug_df["detalle"].apply(_norm)
+def _totales_por_comercio(df, amt_col):
+    """Gasto absoluto por lugar, de mayor a menor: agrupa por comercio_id (entero) y etiqueta con su nombre."""
+    amt = np.abs(pd.to_numeric(df[amt_col], errors="coerce").fillna(0))
+    if "comercio_id" not in df.columns or df["comercio_id"].isna().all():
+        return amt.groupby(df["detalle_norm"]).sum().sort_values(ascending=False)
+    totales = amt.groupby(df["comercio_id"]).sum().sort_values(ascending=False)
+    nombres = df.drop_duplicates("comercio_id").set_index("comercio_id")["comercio"]
+    totales.index = nombres.reindex(totales.index).fillna("").to_numpy()
+    return totales
 
-    # 1) Resolver mapa exacto para TODOS los detalle_norm únicos en una sola consulta
-    dn_list = sorted(set(sug_df["detalle_norm"].dropna().astype(str)))
-    if not dn_list:
-        return pd.DataFrame()
 
-    exact_map = {}
-    try:
-        if isinstance(conn, dict) and conn.get("pg"):
-            engine = conn["engine"]
-            with engine.connect() as cx:
-                params = {f"dn{i}": v for i, v in enumerate(dn_list)}
-                placeholders = ", ".join([f":dn{i}" for i in range(len(dn_list))])
-                q = text(f"SELECT detalle_norm, categoria FROM categoria_map WHERE detalle_norm IN ({placeholders})")
-                rows = cx.execute(q, params).fetchall()
-                exact_map = {r[0]: r[1] for r in rows}
-        else:
-            placeholders = ",".join(["?"] * len(dn_list))
-            q = f"SELECT detalle_norm, categoria FROM categoria_map WHERE detalle_norm IN ({placeholders})"
-            rows = conn.execute(q, dn_list).fetchall()
-            exact_map = {r[0]: r[1] for r in rows}
-    except Exception:
-        exact_map = {}
-
-    # Pre-arreglo de resultados (los del mapa exacto se resuelven directo)
-    results = []
-    pending_dns = []
-    for _, row in sug_df.iterrows():
-        dn = str(row.get("detalle_norm") or "")
-        if not dn:
-            continue
-        if dn in exact_map and pd.notna(exact_map[dn]) and str(exact_map[dn]).strip() != "":
-            results.append({
-                "unique_key": row.get("unique_key", ""),
-                "detalle": row.get("detalle", ""),
-                "detalle_norm": dn,
-                "sugerida": exact_map[dn],
-                "fuente": "Mapa exacto",
-                "confianza": 1.0,
-                "aceptar": False,
-                "manual": "",
-            })
-        else:
-            pending_dns.append(dn)
+def _por_categoria(frame, valores, how="sum", por=(), dropna=True):
+    """
+    Agrega `valores` (Serie alineada con frame) por categoria_id (entero) y las columnas de `por`,
+    y etiqueta cada grupo con el nombre de la categoría al final, como _totales_por_comercio.
+    Devuelve un DataFrame con categoria, las columnas de `por` y _amt.
+    """
+    extra = [frame[c] for c in por]
+    if "categoria_id" not in frame.columns or frame["categoria_id"].isna().all():
+        g = valores.groupby([frame["categoria"], *extra], dropna=dropna)
+        return getattr(g, how)().rename("_amt").reset_index()
+    g = valores.groupby([frame["categoria_id"], *extra], dropna=dropna)
+    out = getattr(g, how)().rename("_amt").reset_index()
+    nombres = frame.drop_duplicates("categoria_id").set_index("categoria_id")["categoria"]
+    out.insert(0, "categoria", nombres.reindex(out["categoria_id"]).to_numpy())
+    return out.drop(columns=["categoria_id"])
+
+
+def _monto_neto(frame):
+    """
+    Monto para agregaciones, con el signo de monto: las transferencias entre cuentas propias y
+    los abonos emparejados cuentan 0, y un gasto reembolsado cuenta solo lo no cubierto.
+    """
+    monto = pd.to_numeric(frame["monto"], errors="coerce").fillna(0)
+    neto = monto.copy()
+    if "reembolso_diff" in frame.columns:
+        diff = pd.to_numeric(frame["reembolso_diff"], errors="coerce")
+        pareado = diff.notna()
+        neto[pareado] = np.sign(monto[pareado]) * diff[pareado].clip(lower=0)
+    for _col in ["es_entre_cuentas", "es_reembolso"]:
+        if _col in frame.columns:
+            neto[frame[_col].isin([1, True])] = 0
+    return neto
 
-    pending_dns = sorted(set([dn for dn in pending_dns if dn]))
 
-    # 2) Para los pendiente: calcular categoría dominante por detalle_norm en lote
-    dom_map = {}
-    if pending_dns:
-        try:
-            if isinstance(conn, dict) and conn.get("pg"):
-                engine = conn["engine"]
-                with engine.connect() as cx:
-                    params = {f"dn{i}": v for i, v in enumerate(pending_dns)}
-                    placeholders = ", ".join([f":dn{i}" for i in range(len(pending_dns))])
-                    q = text(f"""
-                        SELECT detalle_norm, categoria, cnt, total,
-                               CASE WHEN total > 0 THEN (cnt * 100.0) / total ELSE 0 END AS pct
-                        FROM (
-                            SELECT detalle_norm, categoria, COUNT(*) AS cnt,
-                                   SUM(COUNT(*)) OVER (PARTITION BY detalle_norm) AS total,
-                                   ROW_NUMBER() OVER (PARTITION BY detalle_norm ORDER BY COUNT(*) DESC) AS rn
-                            FROM movimientos
-                            WHERE detalle_norm IN ({placeholders})
-                              AND categoria IS NOT NULL
-                              AND categoria != 'Sin categoría'
-                            GROUP BY detalle_norm, categoria
-                        ) s
-                        WHERE rn = 1
-                    """)
-                    rows = cx.execute(q, params).fetchall()
-                    for r in rows:
-                        dn, cat, cnt, total, pct = r
-                        if pct is None:
-                            pct = 0.0
-                        dom_map[dn] = (cat, float(pct))
-            else:
-                # SQLite: equivalente sin window functions usando CTEs y join
-                placeholders = ",".join(["?"] * len(pending_dns))
-                q = f"""
-                    WITH filt AS (
-                        SELECT detalle_norm, categoria
-                        FROM movimientos
-                        WHERE detalle_norm IN ({placeholders})
-                          AND categoria IS NOT NULL
-                          AND categoria != 'Sin categoría'
-                    ),
-                    stats AS (
-                        SELECT detalle_norm, categoria, COUNT(*) AS cnt
-                        FROM filt
-                        GROUP BY detalle_norm, categoria
-                    ),
-                    total AS (
-                        SELECT detalle_norm, SUM(cnt) AS total
-                        FROM stats
-                        GROUP BY detalle_norm
-                    ),
-                    ranked AS (
-                        SELECT s.detalle_norm, s.categoria, s.cnt, t.total
-                        FROM stats s JOIN total t USING(detalle_norm)
-                    )
-                    SELECT r1.detalle_norm,
-                           r1.categoria,
-                           r1.cnt,
-                           r1.total,
-                           (r1.cnt * 100.0) / NULLIF(r1.total, 0) AS pct
-                    FROM ranked r1
-                    JOIN (
-                        SELECT detalle_norm, MAX(cnt) AS max_cnt FROM ranked GROUP BY detalle_norm
-                    ) m
-                    ON r1.detalle_norm = m.detalle_norm AND r1.cnt = m.max_cnt
-                """
-                rows = conn.execute(q, pending_dns).fetchall()
-                # Si hay empates, se devuelven múltiples filas; elegimos la primera por orden de aparición
-                seen = set()
-                for r in rows:
-                    dn, cat, cnt, total, pct = r
-                    if dn in seen:
-                        continue
-                    seen.add(dn)
-                    if pct is None:
-                        pct = 0.0
-                    dom_map[dn] = (cat, float(pct))
-        except Exception:
-            dom_map = {}
+def _col_monto(frame, respaldo="monto_real_plot"):
+    """Columna de monto para agregar: monto_neto si está, luego monto, luego `respaldo`."""
+    return next((c for c in ("monto_neto", "monto") if c in frame.columns), respaldo)
 
-    # Armar resultados finales
-    for _, row in sug_df.iterrows():
-        dn = str(row.get("detalle_norm") or "")
-        if not dn:
-            continue
-        if any(r.get("detalle_norm") == dn and r.get("unique_key") == row.get("unique_key", "") for r in results):
-            continue
-        cat_pct = dom_map.get(dn)
-        if cat_pct:
-            cat, pct = cat_pct
-            if pd.notna(cat) and str(cat).strip() != "" and float(pct) >= 70.0:
-                results.append({
-                    "unique_key": row.get("unique_key", ""),
-                    "detalle": row.get("detalle", ""),
-                    "detalle_norm": dn,
-                    "sugerida": cat,
-                    "fuente": "Historial dominante",
-                    "confianza": 0.8,
-                    "aceptar": False,
-                    "manual": "",
-                })
-                continue
-        # 3) Similitud por nombre/monto
-        if hist_df is not None and not hist_df.empty:
-            sim_suggestions = _suggest_by_name_amount(
-                hist_df,
-                row.get("detalle_norm"),
-                row.get("monto"),
-            )
-            if sim_suggestions:
-                best = sim_suggestions[0]
-                results.append({
-                    "unique_key": row.get("unique_key", ""),
-                    "detalle": row.get("detalle", ""),
-                    "detalle_norm": dn,
-                    "sugerida": best["categoria"],
-                    "fuente": f"Nombres similares ({best['score']:.2f})",
-                    "confianza": best["score"],
-                    "aceptar": False,
-                    "manual": "",
-                    "alternativas_sim": sim_suggestions,
-                    "monto": row.get("monto"),
-                })
-                continue
-        # 4) Sin sugerencia
-        results.append({
-            "unique_key": row.get("unique_key", ""),
-            "detalle": row.get("detalle", ""),
-            "detalle_norm": dn,
-            "sugerida": "Sin categoría",
-            "fuente": "Sin sugerencia",
-            "confianza": 0.0,
-            "aceptar": False,
-            "manual": "",
-            "alternativas_sim": [],
-            "monto": row.get("monto"),
-        })
-
-    return pd.DataFrame(results)
+
+def _usuario_sesion() -> str | None:
+    """
+    En modo multiusuario (APP_MULTIUSUARIO=1) cada sesión usa el email autenticado por
+    Streamlit. Sin email la sesión se detiene: nunca se cae al usuario compartido
+    (APP_USUARIO / "default").
+    """
+    if os.environ.get("APP_MULTIUSUARIO", "").strip().lower() not in ("1", "true", "si", "sí"):
+        return None
+    try:
+        email = (st.experimental_user.email or "").strip()
+    except Exception:
+        email = ""
+    if not email:
+        st.error("🔒 Inicia sesión para usar la app: el modo multiusuario requiere un email autenticado.")
+        st.stop()
+    return email
 
 
 # Inicializar DB
-conn = get_conn()
+conn = get_conn(usuario=_usuario_sesion())
 init_db(conn)
 
-# === Garantizar tabla de tombstones para evitar "resurrecciones" ===
-try:
-    if isinstance(conn, dict) and conn.get("pg"):
-        engine = conn["engine"]
-        with engine.begin() as cx:
-            cx.execute(text(
-                """
-                CREATE TABLE IF NOT EXISTS movimientos_borrados (
-                    unique_key TEXT PRIMARY KEY,
-                    deleted_at TIMESTAMPTZ DEFAULT NOW()
-                )
-                """
-            ))
-    else:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS movimientos_borrados (
-                unique_key TEXT PRIMARY KEY,
-                deleted_at TEXT DEFAULT (datetime('now'))
-            )
-            """
-        )
-        conn.commit()
-except Exception as _tb_e:
-    st.caption(f"(No se pudo garantizar tabla de tombstones: {_tb_e})")
-
 # Cargar/sembrar categorías
 categories = get_categories(conn)
 if not categories:
@@ -788,6 +594,7 @@ if not categories:
     categories = DEFAULT_CATEGORIES[:]
 
 uploaded = None
+ingeridos = 0
 with st.sidebar:
     with st.expander("📂 Cargar movimientos", expanded=False):
         date_format = st.selectbox(
@@ -806,6 +613,13 @@ with st.sidebar:
 if uploaded is not None:
     df_in = load_df(uploaded, date_format=date_format)
 
+    # Si el CSV trae signo (cargos negativos), los positivos son abonos: se guardan en es_abono
+    # para emparejar reembolsos en la base aunque la fila quede como Gasto (las palabras clave
+    # de transferencia no cuentan: también marcan transferencias salientes y pagos de tarjeta)
+    _monto_csv = pd.to_numeric(df_in.get("monto", pd.Series(0, index=df_in.index)), errors="coerce")
+    _abono_csv = (_monto_csv > 0) & (_monto_csv < 0).any()
+    df_in["es_abono"] = _abono_csv
+
     # Forzar todo como Gasto (convierte montos a negativo) — SIEMPRE ACTIVO
     # usar monto_cartola como base inmutable; solo firmamos el signo visible
     if "monto_cartola" in df_in.columns:
@@ -814,7 +628,11 @@ if uploaded is not None:
         df_in["monto"] = -pd.to_numeric(df_in.get("monto", 0), errors="coerce").abs()
     df_in["tipo"] = "Gasto"
     df_in["es_gasto"] = True
-    df_in["es_transferencia_o_abono"] = False
+    # Flags por palabras clave de config.json (mismo motor que prep.py); informativos: tipo manda
+    _marcas = flag_rules().flags(df_in.get("detalle_norm", df_in["detalle"]))
+    df_in["es_transferencia_o_abono"] = _marcas["es_transferencia_o_abono"]
+    if "es_compartido_posible" not in df_in.columns:
+        df_in["es_compartido_posible"] = _marcas["es_compartido_posible"]
 
     # Normalizar flags booleanos a True/False (evita DataError de Postgres por 0/1)
     for _col in ["es_gasto", "es_transferencia_o_abono", "es_compartido_posible"]:
@@ -851,26 +669,15 @@ if uploaded is not None:
 
     # --- Filtrar transacciones previamente borradas (tombstones) ---
     try:
-        tomb_uks = set()
-        if isinstance(conn, dict) and conn.get("pg"):
-            engine = conn["engine"]
-            with engine.connect() as cx:
-                tdf = pd.read_sql_query(text("SELECT unique_key FROM movimientos_borrados"), cx)
-        else:
-            tdf = pd.read_sql_query("SELECT unique_key FROM movimientos_borrados", conn)
-        if tdf is not None and not tdf.empty:
-            tomb_uks = set(tdf["unique_key"].astype(str).tolist())
-        before_len = len(df_in)
-        if "unique_key" in df_in.columns and tomb_uks:
-            df_in = df_in[~df_in["unique_key"].astype(str).isin(tomb_uks)].copy()
-            skipped = before_len - len(df_in)
-            if skipped > 0:
-                st.info(f"⛔ {skipped} fila(s) del CSV fueron omitidas porque sus unique_key están marcadas como borradas.")
+        df_in, skipped = filter_tombstoned(conn, df_in)
+        if skipped > 0:
+            st.info(f"⛔ {skipped} fila(s) del CSV fueron omitidas porque sus unique_key están marcadas como borradas.")
     except Exception as _tbe:
         st.caption(f"(No se pudo aplicar filtro de tombstones: {_tbe})")
 
     inserted, ignored = upsert_transactions(conn, df_in)
     st.success(f"Ingeridos: {inserted} nuevas filas, ignoradas por duplicado: {ignored}")
+    ingeridos = inserted
 
 
 # Cargar histórico desde DB
@@ -886,13 +693,15 @@ try:
             st.caption(f"🔁 Depurado: se eliminaron {dup_count} duplicados por unique_key al cargar la BD.")
 except Exception as _dedupe_e:
     st.caption(f"(No se pudo depurar duplicados: {_dedupe_e})")
-hist_similarity_df = df.copy()
-hist_similarity_df["detalle_norm_cmp"] = hist_similarity_df.get("detalle_norm", "").astype(str).str.strip().str.upper()
-hist_similarity_df = hist_similarity_df[
-    (hist_similarity_df["detalle_norm_cmp"] != "")
-    & hist_similarity_df["categoria"].notna()
-    & (hist_similarity_df["categoria"] != "Sin categoría")
-]
+if "monto" in df.columns:
+    df["monto_neto"] = _monto_neto(df)
+hist_similarity_df = history_for_similarity(df)
+# Sugerencias de lo recién ingerido: una pasada en lote que queda guardada en movimientos
+if ingeridos:
+    try:
+        refresh_suggestions(conn, df=df, hist_df=hist_similarity_df)
+    except Exception as _sug_e:
+        st.caption(f"(No se pudieron guardar las sugerencias: {_sug_e})")
 
 if df.empty:
     st.info(
@@ -910,8 +719,16 @@ elif reset_cmd == "clear_q":
 elif reset_cmd == "clear_range":
     st.session_state.pop("date_range", None)
 
+# Cola de pendientes de categoría (índice parcial en la base, sin recorrer df)
+n_pendientes = count_pending(conn)
+
 # Filtros en sidebar
 with st.sidebar:
+    if n_pendientes:
+        st.markdown(
+            f"<a class='pending-badge' href='#suggestions-panel'>🗂️ {n_pendientes} pendientes</a>",
+            unsafe_allow_html=True,
+        )
     st.header("Filtros")
     q = st.text_input("Buscar en detalle", "", key="search_q")
     # Filtro por mes (además del rango de fechas)
@@ -1071,7 +888,11 @@ if draft_key in st.session_state and "unique_key" in df_plot.columns:
             if col in base.columns and col in dset.columns:
                 base.loc[inter, col] = dset.loc[inter, col]
         df_plot = base.reset_index()
+        if "categoria_id" in df_plot.columns:
+            # El borrador cambia el nombre; las agregaciones agrupan por categoria_id
+            df_plot["categoria_id"] = df_plot["categoria"].map(get_categoria_ids(conn))
         df_plot["monto_real_plot"] = df_plot["monto"]
+        df_plot["monto_neto"] = _monto_neto(df_plot)
 
 # Paleta y mapeo de color consistente por categoría
 palette = [
@@ -1104,7 +925,7 @@ for c in domain:
 range_colors = [colors_by_category[c] for c in domain]
 
 # Cálculos base para métricas
-amt_col = "monto" if "monto" in df_plot.columns else "monto_real_plot"
+amt_col = _col_monto(df_plot)
 _total_series = pd.to_numeric(df_plot[amt_col], errors="coerce").abs().fillna(0)
 total_real = float(_total_series.sum())
 
@@ -1127,7 +948,7 @@ try:
     _maux = df_analysis.copy()
     if not _maux.empty:
         _maux["mes"] = _maux["fecha"].dt.to_period("M").astype(str)
-    amt_candidates = ["monto", "monto_real", "monto_real_plot"]
+    amt_candidates = ["monto_neto", "monto", "monto_real", "monto_real_plot"]
     _amtc = next((c for c in amt_candidates if c in _maux.columns), None)
     if _amtc is None:
         raise ValueError("No hay columna de monto para análisis mensual")
@@ -1145,7 +966,7 @@ try:
         df_mes_ins["mes"] = df_mes_ins["fecha"].dt.to_period("M").astype(str)
         last_m = sorted([m for m in df_mes_ins["mes"].dropna().unique()])[-1]
         curm = df_mes_ins[df_mes_ins["mes"] == last_m]
-        by_place = curm.assign(_a=np.abs(pd.to_numeric(curm[_amtc], errors="coerce").fillna(0))).groupby("detalle_norm")["_a"].sum().sort_values(ascending=False)
+        by_place = _totales_por_comercio(curm, _amtc)
         if len(by_place):
             top_place = by_place.index[0]
             top_place_val = float(by_place.iloc[0])
@@ -1168,16 +989,18 @@ with row2[1]:
 
 # Categoría más relevante se muestra debajo para evitar saturación
 if not df_plot.empty:
-    cat_agg_metric = df_plot.assign(_amt=np.abs(pd.to_numeric(df_plot[amt_col], errors="coerce").fillna(0))).groupby("categoria")["_amt"].sum().sort_values(ascending=False)
+    cat_agg_metric = (
+        _por_categoria(df_plot, np.abs(pd.to_numeric(df_plot[amt_col], errors="coerce").fillna(0)))
+        .set_index("categoria")["_amt"].sort_values(ascending=False)
+    )
     if len(cat_agg_metric) > 0:
         st.caption(f"Categoría más relevante: **{cat_agg_metric.index[0]}**")
 
 # Donut por categoría (centrado, compacto, con total al centro)
 if not df_plot.empty:
-    amt_col = "monto" if "monto" in df_plot.columns else "monto_real_plot"
+    amt_col = _col_monto(df_plot)
     cat_agg = (
-        df_plot.assign(_amt=np.abs(pd.to_numeric(df_plot[amt_col], errors="coerce").fillna(0)))
-        .groupby("categoria", dropna=False)["_amt"].sum().reset_index()
+        _por_categoria(df_plot, np.abs(pd.to_numeric(df_plot[amt_col], errors="coerce").fillna(0)), dropna=False)
         .rename(columns={"_amt": "total"})
         .sort_values("total", ascending=False)
     )
@@ -1272,19 +1095,13 @@ with col_tl:
     st.markdown("**🏪 Top 5 lugares del mes**")
     df_mes = _df_mes_actual(dfv, sel_mes)
     if not df_mes.empty:
-        # Agregar por comercio (detalle_norm) y, como respaldo, por categoría
-        amt_col2 = "monto" if "monto" in df_mes.columns else "monto_real_plot"
-        by_merchant = (
-            df_mes.assign(_amt=np.abs(pd.to_numeric(df_mes[amt_col2], errors="coerce").fillna(0)))
-                  .groupby("detalle_norm")["_amt"].sum().reset_index()
-                  .rename(columns={"_amt": "total"})
-                  .sort_values("total", ascending=False)
-        )
-        top5 = by_merchant.head(5)
+        # Agregar por comercio (comercio_id) y mostrar su nombre canónico
+        amt_col2 = _col_monto(df_mes)
+        top5 = _totales_por_comercio(df_mes, amt_col2).head(5)
         if top5.empty:
             st.caption("(Sin datos suficientes en el mes actual)")
         else:
-            st.table(top5.rename(columns={"detalle_norm": "Lugar", "total": "Total"}))
+            st.table(top5.rename_axis("Lugar").reset_index(name="Total"))
     else:
         st.caption("(Sin datos para este mes)")
 
@@ -1312,9 +1129,10 @@ col_left, col_right = st.columns([3, 2])
 
 with col_left:
     if not df_plot.empty:
-        amt_col = "monto" if "monto" in df_plot.columns else "monto_real_plot"
+        amt_col = _col_monto(df_plot)
         freq = (
-            df_plot.groupby("categoria").size().reset_index(name="veces")
+            _por_categoria(df_plot, pd.Series(1, index=df_plot.index), how="size")
+                  .rename(columns={"_amt": "veces"})
                   .sort_values("veces", ascending=True)  # ascendente para horizontal
         )
         if MOBILE and len(freq) > 12:
@@ -1365,7 +1183,7 @@ with col_right:
         dia_map = {0: "Lun", 1: "Mar", 2: "Mié", 3: "Jue", 4: "Vie", 5: "Sáb", 6: "Dom"}
         df_plot["dow"] = df_plot["fecha"].dt.dayofweek.map(dia_map)
         df_plot["dow_idx"] = df_plot["fecha"].dt.dayofweek
-        amt_col = "monto" if "monto" in df_plot.columns else "monto_real_plot"
+        amt_col = _col_monto(df_plot)
         dow_agg = df_plot.assign(_amt=np.abs(df_plot[amt_col].astype(float))).groupby(["dow", "dow_idx"])['_amt'].sum().reset_index()
         dow_agg.rename(columns={"_amt": "total"}, inplace=True)
         chart_dow = (
@@ -1385,10 +1203,9 @@ with col_right:
 # Fila B (completa): Ticket promedio por categoría (barras horizontales)
 st.markdown("---")
 if not df_plot.empty:
-    amt_col = "monto" if "monto" in df_plot.columns else "monto_real_plot"
+    amt_col = _col_monto(df_plot)
     avg = (
-        df_plot.assign(_amt=df_plot[amt_col].abs())
-              .groupby("categoria")['_amt'].mean().reset_index()
+        _por_categoria(df_plot, df_plot[amt_col].abs(), how="mean")
               .rename(columns={'_amt': 'ticket_prom'})
               .sort_values("ticket_prom", ascending=True)
     )
@@ -1467,11 +1284,10 @@ if sel_mes and sel_mes != "Todos" and not df_base_compare.empty:
         
         # Combinar y agregar por categoría y mes
         comparison_data = pd.concat([current_data, prev_data])
-        amt_col = "monto" if "monto" in comparison_data.columns else "monto_real_plot"
+        amt_col = _col_monto(comparison_data)
         
         comparison_agg = (
-            comparison_data.assign(_amt=np.abs(pd.to_numeric(comparison_data[amt_col], errors="coerce").fillna(0)))
-            .groupby(["categoria", "mes"])["_amt"].sum().reset_index()
+            _por_categoria(comparison_data, np.abs(pd.to_numeric(comparison_data[amt_col], errors="coerce").fillna(0)), por=["mes"])
             .rename(columns={"_amt": "total"})
         )
         
@@ -1541,56 +1357,126 @@ if sel_mes and sel_mes != "Todos" and not df_base_compare.empty:
 
 
 st.markdown('<div id="suggestions-panel"></div>', unsafe_allow_html=True)
-suggestions_df = build_suggestions_df(dfv, conn, hist_df=hist_similarity_df)
-rejecting_key = st.session_state.get("rejecting_key")
+# Página de la cola de pendientes con sus sugerencias guardadas; si las reglas cambiaron se
+# recalculan antes (en Postgres, en segundo plano)
+PENDING_PAGE_SIZE = 50
+pend_pages = max(1, math.ceil(n_pendientes / PENDING_PAGE_SIZE))
+pend_page = min(max(1, int(st.session_state.get("pending_page", 1))), pend_pages)
+st.session_state["pending_page"] = pend_page
+try:
+    ensure_suggestions_fresh(conn, df=df, hist_df=hist_similarity_df)
+except Exception as _sug_e:
+    st.caption(f"(No se pudieron recalcular las sugerencias: {_sug_e})")
+suggestions_df = pending_suggestions(
+    conn, limit=PENDING_PAGE_SIZE, offset=(pend_page - 1) * PENDING_PAGE_SIZE, hist_df=hist_similarity_df
+)
 
 if suggestions_df.empty:
     st.info("No hay transacciones pendientes de categorizar.")
 else:
     st.markdown("### Sugerencias de categoría")
-    st.caption(f"{len(suggestions_df)} movimientos necesitan categoría. Acepta o ajusta cada sugerencia.")
-    for _, row in suggestions_df.iterrows():
-        uk = str(row.get("unique_key", ""))
-        monto_txt = ""
-        if "monto" in row and row["monto"] not in (None, ""):
+    st.caption(
+        f"{n_pendientes} movimientos necesitan categoría. Marca las sugerencias a aceptar o cambia la "
+        "categoría propuesta y aplica la página de una vez."
+    )
+    bulk_msg = st.session_state.pop("bulk_accept_msg", None)
+    if bulk_msg:
+        st.success(bulk_msg)
+    # Aceptación en lote: un UPDATE por conjunto + un upsert del mapa, y un solo rerun
+    with st.expander("Aceptar en lote"):
+        col_src, col_conf = st.columns(2)
+        with col_src:
+            bulk_src = st.selectbox("Fuente", options=["Todas"] + SUGGESTION_SOURCES, key="bulk_accept_source")
+        with col_conf:
+            bulk_min = st.slider("Confianza mínima", min_value=0.0, max_value=1.0, value=0.8, step=0.05, key="bulk_accept_min")
+        bulk_fuente = None if bulk_src == "Todas" else bulk_src
+        n_bulk = count_pending(conn, min_confianza=bulk_min, fuente=bulk_fuente)
+        if st.button(f"Aceptar {n_bulk} sugerencia(s)", key="bulk_accept", disabled=n_bulk == 0):
             try:
-                monto_txt = f"${float(row['monto']):,.0f}"
-            except Exception:
-                monto_txt = str(row.get("monto"))
-        with st.container():
-            st.markdown(f"<div class='suggest-card'>**{row['detalle']}**</div>", unsafe_allow_html=True)
-            st.caption(f"Normalizado: {row['detalle_norm']} · Monto: {monto_txt or 's/d'}")
-            st.markdown(f"**Propuesta:** :blue[{row['sugerida']}]")
-            st.caption(f"Fuente: {row['fuente']} (confianza {row['confianza']:.2f})")
-            if isinstance(row.get("alternativas_sim"), list) and row["alternativas_sim"]:
-                chips = " ".join([f"`{alt['categoria']}` ({alt['score']:.2f})" for alt in row["alternativas_sim"]])
-                st.caption(f"Coincidencias similares: {chips}")
-            col_a, col_b = st.columns(2)
-            with col_a:
-                if st.button("Aceptar", key=f"accept_{uk}"):
-                    if apply_category_change(conn, df, uk, row["sugerida"]):
-                        st.success("Categoría aplicada.")
-                        st.session_state.pop("rejecting_key", None)
-                        scroll_and_rerun("suggestions-panel")
-            with col_b:
-                if st.button("Rechazar", key=f"reject_{uk}"):
-                    st.session_state["rejecting_key"] = uk
-                    scroll_and_rerun("suggestions-panel")
-
-        if st.session_state.get("rejecting_key") == uk:
-            manual_cat = st.selectbox(
-                "Selecciona la categoría correcta",
-                options=categories,
-                key=f"manual_select_{uk}",
+                applied = accept_suggestions(conn, min_confianza=bulk_min, fuente=bulk_fuente)
+                try:
+                    learn_categories(conn, applied)
+                except Exception:
+                    pass
+                st.session_state["bulk_accept_msg"] = f"Categorizadas {len(applied)} fila(s) en lote."
+                st.session_state["pending_page"] = 1
+                scroll_and_rerun("suggestions-panel")
+            except Exception as _bulk_e:
+                st.error(f"No se pudo aplicar en lote: {_bulk_e}")
+    if pend_pages > 1:
+        col_prev, col_pg, col_next = st.columns([1, 2, 1])
+        with col_prev:
+            if st.button("◀ Anterior", key="pending_prev", disabled=pend_page <= 1):
+                st.session_state["pending_page"] = pend_page - 1
+                scroll_and_rerun("suggestions-panel")
+        with col_pg:
+            st.caption(f"Página {pend_page} de {pend_pages}")
+        with col_next:
+            if st.button("Siguiente ▶", key="pending_next", disabled=pend_page >= pend_pages):
+                st.session_state["pending_page"] = pend_page + 1
+                scroll_and_rerun("suggestions-panel")
+    # Una sola grilla por página (en vez de tarjetas y botones por fila): aplicar = aceptar,
+    # categoria = propuesta editable; las filas marcadas se aplican juntas
+    grid = pd.DataFrame({
+        "aplicar": False,
+        "detalle": suggestions_df["detalle"],
+        "monto": pd.to_numeric(suggestions_df["monto"], errors="coerce"),
+        "categoria": suggestions_df["sugerida"].where(suggestions_df["sugerida"].isin(categories), "Sin categoría"),
+        "fuente": suggestions_df["fuente"],
+        "confianza": suggestions_df["confianza"].astype(float),
+        "alternativas": [
+            ", ".join(f"{alt['categoria']} ({alt['score']:.2f})" for alt in alts) if isinstance(alts, list) else ""
+            for alts in suggestions_df["alternativas_sim"]
+        ],
+        "unique_key": suggestions_df["unique_key"].astype(str),
+    })
+    grid_rev = int(st.session_state.get("pending_grid_rev", 0))
+    edited_grid = st.data_editor(
+        grid,
+        key=f"pending_grid_{pend_page}_{grid_rev}",
+        use_container_width=True,
+        hide_index=True,
+        disabled=["detalle", "monto", "fuente", "confianza", "alternativas", "unique_key"],
+        column_order=["aplicar", "detalle", "monto", "categoria", "fuente", "confianza", "alternativas"],
+        column_config={
+            "aplicar": st.column_config.CheckboxColumn("Aplicar", default=False, width="small"),
+            "monto": st.column_config.NumberColumn(format="%.0f"),
+            "categoria": st.column_config.SelectboxColumn("Categoría", options=categories, required=True),
+            "confianza": st.column_config.ProgressColumn(min_value=0.0, max_value=1.0, format="%.2f"),
+            "alternativas": st.column_config.TextColumn("Coincidencias similares"),
+        },
+    )
+    col_apply, col_page = st.columns(2)
+    with col_apply:
+        apply_marked = st.button("✅ Aplicar marcadas", key="pending_apply", use_container_width=True)
+    with col_page:
+        apply_page = st.button("Aceptar toda la página", key="pending_apply_page", use_container_width=True)
+    if apply_marked or apply_page:
+        batch = edited_grid if apply_page else edited_grid[edited_grid["aplicar"] == True]
+        batch = batch[batch["categoria"].notna() & (batch["categoria"] != "Sin categoría")]
+        if batch.empty:
+            st.warning("No hay filas marcadas con una categoría distinta a 'Sin categoría'.")
+        else:
+            edits_df = batch[["unique_key", "categoria"]].assign(
+                detalle_norm=batch["unique_key"].map(suggestions_df.set_index("unique_key")["detalle_norm"]),
+                monto=batch["monto"],
             )
-            if st.button("Guardar categoría manual", key=f"manual_save_{uk}"):
-                if manual_cat == "Sin categoría":
-                    st.warning("Elige una categoría distinta a 'Sin categoría'.")
-                else:
-                    if apply_category_change(conn, df, uk, manual_cat):
-                        st.success("Categoría manual aplicada.")
-                        st.session_state.pop("rejecting_key", None)
-                        scroll_and_rerun("suggestions-panel")
+            try:
+                updated = apply_edits(conn, edits_df[["unique_key", "categoria"]])
+                try:
+                    update_categoria_map_from_df(conn, edits_df)
+                except Exception:
+                    pass
+                try:
+                    previous = df.drop_duplicates("unique_key").set_index("unique_key")["categoria"]
+                    learn_categories(conn, edits_df.assign(categoria_anterior=edits_df["unique_key"].map(previous)))
+                except Exception:
+                    pass
+                st.session_state["bulk_accept_msg"] = f"Categorizadas {updated} fila(s)."
+                st.session_state["pending_grid_rev"] = grid_rev + 1
+                scroll_and_rerun("suggestions-panel")
+            except Exception as _grid_e:
+                st.error(f"No se pudo aplicar la página: {_grid_e}")
 
 st.markdown("### Tabla editable")
 st.markdown('<div id="tabla-movimientos"></div>', unsafe_allow_html=True)
@@ -1642,52 +1528,69 @@ def insert_manual_transaction(conn, fecha, detalle, monto, categoria, nota):
         "detalle_norm": detalle_norm,
         "monto": monto_val,
         "monto_real": monto_val,
-        "categoria": categoria or "Sin categoría",
+        "categoria_id": get_categoria_ids(conn).get(categoria or "Sin categoría"),
+        "comercio_id": intern_comercios(conn, [detalle_norm]).get(detalle_norm),
         "nota_usuario": nota or "",
         "es_gasto": True,
         "es_transferencia_o_abono": False,
+        "es_entre_cuentas": bool(flag_rules().flags(pd.Series([detalle_norm]))["es_entre_cuentas"].iloc[0]),
+        "es_abono": False,
+        "usuario": get_usuario(conn),
     }
     inserted_ok = False
     if isinstance(conn, dict) and conn.get("pg"):
         engine = conn["engine"]
+        ensure_month_partitions(conn, [fstr])
         with engine.begin() as cx:
             cx.execute(
                 text(
                     """
-                    INSERT INTO movimientos (unique_key, fecha, detalle, detalle_norm, monto, categoria, nota_usuario, monto_real, es_gasto, es_transferencia_o_abono)
-                    VALUES (:unique_key, :fecha, :detalle, :detalle_norm, :monto, :categoria, :nota_usuario, :monto_real, :es_gasto, :es_transferencia_o_abono)
-                    ON CONFLICT (unique_key) DO NOTHING
+                    INSERT INTO movimientos (unique_key, fecha, detalle, detalle_norm, comercio_id, monto, categoria_id, nota_usuario, monto_real, es_gasto, es_transferencia_o_abono, es_entre_cuentas, es_abono, usuario)
+                    VALUES (:unique_key, :fecha, :detalle, :detalle_norm, :comercio_id, :monto, :categoria_id, :nota_usuario, :monto_real, :es_gasto, :es_transferencia_o_abono, :es_entre_cuentas, :es_abono, :usuario)
+                    ON CONFLICT DO NOTHING
                     """
                 ),
                 row_db,
             )
-            got = cx.execute(text("SELECT 1 FROM movimientos WHERE unique_key = :uk"), {"uk": uk}).fetchone()
+            got = cx.execute(
+                text("SELECT 1 FROM movimientos WHERE usuario = :u AND unique_key = :uk"),
+                {"u": row_db["usuario"], "uk": uk},
+            ).fetchone()
             inserted_ok = bool(got)
     else:
         try:
             conn.execute(
                 """
                 INSERT OR IGNORE INTO movimientos
-                    (unique_key, fecha, detalle, detalle_norm, monto, categoria, nota_usuario, monto_real, es_gasto, es_transferencia_o_abono)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    (unique_key, fecha, detalle, detalle_norm, comercio_id, monto, categoria_id, nota_usuario, monto_real, es_gasto, es_transferencia_o_abono, es_entre_cuentas, es_abono, usuario)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 """,
                 (
                     row_db["unique_key"],
                     row_db["fecha"],
                     row_db["detalle"],
                     row_db["detalle_norm"],
+                    row_db["comercio_id"],
                     row_db["monto"],
-                    row_db["categoria"],
+                    row_db["categoria_id"],
                     row_db["nota_usuario"],
                     row_db["monto_real"],
                     int(bool(row_db["es_gasto"])),
                     int(bool(row_db["es_transferencia_o_abono"])),
+                    int(row_db["es_entre_cuentas"]),
+                    int(row_db["es_abono"]),
+                    row_db["usuario"],
                 ),
             )
             conn.commit()
             inserted_ok = True
         except Exception as e:
             return False, f"Error en inserción: {e}"
+    if inserted_ok:
+        refresh_comercio_stats(conn, [row_db["comercio_id"]])
+        # Un gasto manual puede ser el reembolsado por un abono ya cargado (y viceversa)
+        if not row_db["es_entre_cuentas"]:
+            pair_reimbursements(conn, [(uk, fstr)])
     return (True, "") if inserted_ok else (False, "No se insertó, prueba cambiando detalle/monto.")
 
 st.markdown('<div id="manual-form"></div>', unsafe_allow_html=True)
@@ -1796,29 +1699,6 @@ if "eliminar" not in df_table_display.columns:
 ordered_cols = ["eliminar"] + [c for c in df_table_display.columns if c != "eliminar"]
 df_table_display = df_table_display[ordered_cols]
 
-def register_tombstones(conn, unique_keys):
-    clean = [uk for uk in (unique_keys or []) if isinstance(uk, str) and uk.strip()]
-    if not clean:
-        return
-    try:
-        if isinstance(conn, dict) and conn.get("pg"):
-            engine = conn["engine"]
-            with engine.begin() as cx:
-                for uk in clean:
-                    cx.execute(
-                        text("INSERT INTO movimientos_borrados (unique_key) VALUES (:uk) ON CONFLICT (unique_key) DO NOTHING"),
-                        {"uk": uk},
-                    )
-        else:
-            for uk in clean:
-                try:
-                    conn.execute("INSERT OR IGNORE INTO movimientos_borrados (unique_key) VALUES (?)", (uk,))
-                except Exception:
-                    pass
-            conn.commit()
-    except Exception as tomb_e:
-        st.caption(f"(No se pudieron registrar tombstones: {tomb_e})")
-
 def delete_and_track(conn, unique_keys):
     clean = [uk for uk in (unique_keys or []) if isinstance(uk, str) and uk.strip()]
     if not clean:
@@ -1829,8 +1709,6 @@ def delete_and_track(conn, unique_keys):
     except Exception as del_e:
         st.error(f"No se pudo eliminar: {del_e}")
         return 0
-    if deleted > 0:
-        register_tombstones(conn, clean)
     return deleted
 
 # Formulario de edición mejorado
@@ -1933,6 +1811,18 @@ if save_clicked:
             st.info(f"Aprendidas {learned} reglas de categoría por 'detalle_norm'.")
     except Exception:
         pass
+    # Clasificador: solo las filas cuya categoría cambió respecto de lo cargado
+    try:
+        if not edits.empty and "categoria" in edits.columns:
+            before = df.drop_duplicates("unique_key").set_index("unique_key")
+            changed = edits[["unique_key", "categoria"]].join(
+                before[["detalle_norm", "monto", "categoria"]].rename(columns={"categoria": "categoria_anterior"}),
+                on="unique_key",
+                how="inner",
+            )
+            learn_categories(conn, changed[changed["categoria"] != changed["categoria_anterior"].fillna("Sin categoría")])
+    except Exception:
+        pass
 
     deleted = delete_and_track(conn, to_delete_keys)
 
@@ -1954,7 +1844,7 @@ st.markdown("### Más análisis")
 df_month2 = df_analysis.copy()
 if not df_month2.empty:
     df_month2["mes"] = df_month2["fecha"].dt.to_period("M").astype(str)
-    amt_col = "monto" if "monto" in df_month2.columns else "monto_real"
+    amt_col = _col_monto(df_month2, "monto_real")
     mensual2 = (
         df_month2.assign(_amt=np.abs(pd.to_numeric(df_month2[amt_col], errors="coerce").fillna(0)))
         .groupby("mes")["_amt"]
@@ -2002,11 +1892,10 @@ try:
     if not base_hist.empty:
         base_hist["mes"] = base_hist["fecha"].dt.to_period("M").astype(str)
         # Agregado mensual por categoría
-        amt_c = "monto" if "monto" in base_hist.columns else "monto_real_plot"
-        base_hist_amt = base_hist.assign(_amt=np.abs(pd.to_numeric(base_hist[amt_c], errors="coerce").fillna(0)))
+        amt_c = _col_monto(base_hist)
         monthly_by_cat = (
-            base_hist_amt.groupby(["categoria", "mes"])['_amt']
-            .sum().reset_index().rename(columns={'_amt': 'total_mes'})
+            _por_categoria(base_hist, np.abs(pd.to_numeric(base_hist[amt_c], errors="coerce").fillna(0)), por=["mes"])
+            .rename(columns={'_amt': 'total_mes'})
         )
 
         # Reglas para incluir categorías
@@ -2044,11 +1933,10 @@ try:
 
         # Acumulado del mes actual por categoría (visible o rango seleccionado)
         cur = dfv.copy()
-        cur_amt_col = "monto" if "monto" in cur.columns else "monto_real_plot"
+        cur_amt_col = _col_monto(cur)
         cur_agg = (
-            cur.assign(_amt=np.abs(pd.to_numeric(cur[cur_amt_col], errors="coerce").fillna(0)))
-               .groupby("categoria")['_amt']
-               .sum().reset_index().rename(columns={'_amt': 'actual_mes'})
+            _por_categoria(cur, np.abs(pd.to_numeric(cur[cur_amt_col], errors="coerce").fillna(0)))
+               .rename(columns={'_amt': 'actual_mes'})
         )
 
         # Merge proyección vs actual y calcular restante sugerido
@@ -2094,19 +1982,21 @@ if st.button("Reparar montos"):
                 result = cx.execute(text("""
                     UPDATE movimientos 
                     SET monto = ABS(monto_real) 
-                    WHERE monto_real IS NOT NULL 
+                    WHERE usuario = :u
+                    AND monto_real IS NOT NULL 
                     AND monto_real > 0 
                     AND (monto IS NULL OR monto = 0 OR ABS(monto) != monto_real)
-                """))
+                """), {"u": get_usuario(conn)})
                 updated_count = result.rowcount
         else:
             cur = conn.execute("""
                 UPDATE movimientos 
                 SET monto = ABS(monto_real) 
-                WHERE monto_real IS NOT NULL 
+                WHERE usuario = ?
+                AND monto_real IS NOT NULL 
                 AND monto_real > 0 
                 AND (monto IS NULL OR monto = 0 OR ABS(monto) != monto_real)
-            """)
+            """, (get_usuario(conn),))
             updated_count = cur.rowcount
             conn.commit()
         
@@ -2115,150 +2005,67 @@ if st.button("Reparar montos"):
     except Exception as e:
         st.error(f"Error al reparar montos: {e}")
 
-with st.expander("Movimientos ignorados"):
+if st.button("Compactar ignorados", help=f"Mueve tombstones a su tabla, colapsa duplicados repetidos y archiva los no vistos en {ignored_retention_days()} días"):
     try:
-        def _fetch_ignored_pg(engine):
-            # Discover available columns
-            with engine.connect() as cx:
-                cols = [r[0] for r in cx.execute(text("SELECT column_name FROM information_schema.columns WHERE table_name='movimientos_ignorados'")).fetchall()]
-            sel_cols = [c for c in ["id","unique_key","payload","created_at"] if c in cols]
-            if not sel_cols:
-                return pd.DataFrame()
-            q = f"SELECT {', '.join(sel_cols)} FROM movimientos_ignorados ORDER BY {('created_at' if 'created_at' in sel_cols else sel_cols[0])} DESC"
-            with engine.connect() as cx:
-                return pd.read_sql_query(text(q), cx)
-
-        def _fetch_ignored_sqlite(conn):
-            cols = pd.read_sql_query("PRAGMA table_info(movimientos_ignorados)", conn)["name"].tolist()
-            sel_cols = [c for c in ["id","unique_key","payload","created_at"] if c in cols]
-            if not sel_cols:
-                return pd.DataFrame()
-            order_col = "created_at" if "created_at" in sel_cols else sel_cols[0]
-            q = f"SELECT {', '.join(sel_cols)} FROM movimientos_ignorados ORDER BY {order_col} DESC"
-            return pd.read_sql_query(q, conn)
+        cstats = compact_ignored(conn)
+        st.success(
+            f"Compactación: {cstats['tombstones']} tombstone(s) movidos, "
+            f"{cstats['colapsados']} duplicado(s) colapsados, {cstats['expirados']} archivado(s)."
+        )
+    except Exception as e:
+        st.error(f"Error al compactar ignorados: {e}")
 
-        if isinstance(conn, dict) and conn.get("pg"):
-            engine = conn["engine"]
-            ignored_df = _fetch_ignored_pg(engine)
-        else:
-            ignored_df = _fetch_ignored_sqlite(conn)
-
-        if not ignored_df.empty:
-            # Normalize missing columns for UI
-            for c in ["id","unique_key","payload","created_at"]:
-                if c not in ignored_df.columns:
-                    ignored_df[c] = None
-
-            # Parsear payload para mostrar nombre (detalle) y monto en la grilla
-            def _parse_payload_to_cols(_df: pd.DataFrame) -> pd.DataFrame:
-                if _df is None or _df.empty:
-                    return _df
-                nombres, montos = [], []
-                for _, r in _df.iterrows():
-                    raw = r.get("payload")
-                    try:
-                        obj = json.loads(raw) if raw else {}
-                    except Exception:
-                        obj = {}
-                    # nombre: preferir 'detalle', luego 'detalle_norm'
-                    nombre = obj.get("detalle") or obj.get("detalle_norm") or ""
-                    # monto: preferir monto_real > 0, luego 'monto'
-                    m = obj.get("monto_real")
-                    if m in (None, "", 0):
-                        m = obj.get("monto")
-                    try:
-                        # tolerar coma decimal
-                        m = float(str(m).replace(",", ".")) if m is not None else None
-                    except Exception:
-                        m = None
-                    nombres.append(nombre)
-                    montos.append(m)
-                _df["nombre"] = nombres
-                _df["monto"] = montos
-                return _df
-
-            # Enriquecer ignored_df con nombre y monto
-            ignored_df = _parse_payload_to_cols(ignored_df)
-
-            st.write(f"Total de movimientos ignorados: {len(ignored_df)}")
+with st.expander("Movimientos ignorados"):
+    try:
+        IGNORED_PAGE_SIZE = 50
+        ign_page = max(1, int(st.session_state.get("ignored_page", 1)))
+        ignored_df, n_ignored = list_ignored(conn, limit=IGNORED_PAGE_SIZE, offset=(ign_page - 1) * IGNORED_PAGE_SIZE)
+        n_pages = max(1, math.ceil(n_ignored / IGNORED_PAGE_SIZE))
+        if ign_page > n_pages:
+            # La lista se achicó (restauraciones/vaciado): volver a la última página
+            ign_page = n_pages
+            st.session_state["ignored_page"] = ign_page
+            ignored_df, n_ignored = list_ignored(conn, limit=IGNORED_PAGE_SIZE, offset=(ign_page - 1) * IGNORED_PAGE_SIZE)
+
+        if n_ignored > 0:
+            st.write(f"Total de movimientos ignorados: {n_ignored}")
             st.dataframe(
-                ignored_df[[c for c in ["id", "created_at", "nombre", "monto", "unique_key"] if c in ignored_df.columns]],
+                ignored_df[[c for c in ["id", "created_at", "nombre", "monto", "veces", "last_seen_at", "unique_key"] if c in ignored_df.columns]],
                 use_container_width=True,
                 height=280
             )
+            if n_pages > 1:
+                col_prev, col_pg, col_next = st.columns([1, 2, 1])
+                with col_prev:
+                    if st.button("◀ Anterior", key="ignored_prev", disabled=ign_page <= 1):
+                        st.session_state["ignored_page"] = ign_page - 1
+                        scroll_and_rerun()
+                with col_pg:
+                    st.caption(f"Página {ign_page} de {n_pages}")
+                with col_next:
+                    if st.button("Siguiente ▶", key="ignored_next", disabled=ign_page >= n_pages):
+                        st.session_state["ignored_page"] = ign_page + 1
+                        scroll_and_rerun()
 
             sel_ids = st.multiselect("Selecciona IDs para reincorporar", [int(x) for x in ignored_df["id"].dropna().astype(int).tolist()])
             col_restore, col_restore_all, col_clear = st.columns(3)
 
-            def _restore_rows(subdf):
-                restored = 0
-                if isinstance(conn, dict) and conn.get("pg"):
-                    engine = conn["engine"]
-                    with engine.begin() as cx:
-                        for _, rr in subdf.iterrows():
-                            uk = rr.get("unique_key")
-                            payload = rr.get("payload")
-                            if not payload:
-                                continue
-                            row = json.loads(payload)
-                            cx.execute(text("DELETE FROM movimientos WHERE unique_key = :uk"), {"uk": uk})
-                            cx.execute(text(
-                                """
-                                INSERT INTO movimientos (unique_key, fecha, detalle, detalle_norm, monto, categoria, nota_usuario, monto_real, es_gasto, es_transferencia_o_abono)
-                                VALUES (:unique_key, :fecha, :detalle, :detalle_norm, :monto, :categoria, :nota_usuario, :monto_real, :es_gasto, :es_transferencia_o_abono)
-                                """
-                            ), row)
-                            if "id" in rr and pd.notna(rr["id"]):
-                                cx.execute(text("DELETE FROM movimientos_ignorados WHERE id = :id"), {"id": int(rr["id"])})
-                        restored += 1
-                else:
-                    for _, rr in subdf.iterrows():
-                        uk = rr.get("unique_key")
-                        payload = rr.get("payload")
-                        if not payload:
-                            continue
-                        row = json.loads(payload)
-                        conn.execute("DELETE FROM movimientos WHERE unique_key = ?", (uk,))
-                        conn.execute(
-                            """
-                            INSERT INTO movimientos (unique_key, fecha, detalle, detalle_norm, monto, categoria, nota_usuario, monto_real, es_gasto, es_transferencia_o_abono)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                            """,
-                            (
-                                row.get("unique_key"), row.get("fecha"), row.get("detalle"), row.get("detalle_norm"),
-                                row.get("monto"), row.get("categoria"), row.get("nota_usuario"), row.get("monto_real"),
-                                row.get("es_gasto"), row.get("es_transferencia_o_abono"),
-                            ),
-                        )
-                        if "id" in rr and pd.notna(rr["id"]):
-                            conn.execute("DELETE FROM movimientos_ignorados WHERE id = ?", (int(rr["id"]),))
-                        conn.commit()
-                        restored += 1
-                return restored
-
             with col_restore:
                 if st.button("Reincorporar seleccionados") and sel_ids:
-                    sub = ignored_df[ignored_df["id"].astype("Int64").isin(sel_ids)]
-                    restored = _restore_rows(sub)
+                    restored = restore_ignored(conn, sel_ids)
                     st.success(f"Reincorporados {restored} movimientos.")
                     scroll_and_rerun()
 
             with col_restore_all:
                 if st.button("Reincorporar TODOS"):
-                    restored = _restore_rows(ignored_df)
+                    restored = restore_ignored(conn)
                     st.success(f"Reincorporados {restored} movimientos.")
                     scroll_and_rerun()
 
             with col_clear:
                 if st.button("Vaciar lista de ignorados"):
                     try:
-                        if isinstance(conn, dict) and conn.get("pg"):
-                            engine = conn["engine"]
-                            with engine.begin() as cx:
-                                cx.execute(text("DELETE FROM movimientos_ignorados"))
-                        else:
-                            conn.execute("DELETE FROM movimientos_ignorados")
-                            conn.commit()
+                        clear_ignored(conn)
                         st.success("Lista de ignorados vaciada.")
                         scroll_and_rerun()
                     except Exception as e:
@@ -2271,6 +2078,8 @@ with st.expander("Movimientos ignorados"):
 # === Diagnóstico rápido de la Base de Datos ===
 with st.expander("🔎 Diagnóstico de Base de Datos"):
     try:
+        usuario = get_usuario(conn)
+        st.write(f"**Usuario:** {usuario}")
         # Identificar backend
         if isinstance(conn, dict) and conn.get("pg"):
             engine = conn["engine"]
@@ -2285,8 +2094,8 @@ with st.expander("🔎 Diagnóstico de Base de Datos"):
 
             # Conteos clave
             with engine.connect() as cx:
-                n_mov = cx.execute(text("SELECT COUNT(*) FROM movimientos")).scalar()
-                n_ign = cx.execute(text("SELECT COUNT(*) FROM movimientos_ignorados")).scalar() if cx.execute(text("SELECT to_regclass('public.movimientos_ignorados')")).scalar() == 'movimientos_ignorados' else 0
+                n_mov = cx.execute(text("SELECT COUNT(*) FROM movimientos WHERE usuario = :u"), {"u": usuario}).scalar()
+                n_ign = cx.execute(text("SELECT COUNT(*) FROM movimientos_ignorados WHERE usuario = :u"), {"u": usuario}).scalar() if cx.execute(text("SELECT to_regclass('public.movimientos_ignorados')")).scalar() == 'movimientos_ignorados' else 0
                 # Columnas presentes
                 cols = [r[0] for r in cx.execute(text("SELECT column_name FROM information_schema.columns WHERE table_name='movimientos' ORDER BY ordinal_position")).fetchall()]
         else:
@@ -2300,9 +2109,9 @@ with st.expander("🔎 Diagnóstico de Base de Datos"):
             st.code(str(db_path), language=None)
 
             # Conteos clave
-            n_mov = pd.read_sql_query("SELECT COUNT(*) as c FROM movimientos", conn)["c"].iloc[0]
+            n_mov = pd.read_sql_query("SELECT COUNT(*) as c FROM movimientos WHERE usuario = ?", conn, params=(usuario,))["c"].iloc[0]
             try:
-                n_ign = pd.read_sql_query("SELECT COUNT(*) as c FROM movimientos_ignorados", conn)["c"].iloc[0]
+                n_ign = pd.read_sql_query("SELECT COUNT(*) as c FROM movimientos_ignorados WHERE usuario = ?", conn, params=(usuario,))["c"].iloc[0]
             except Exception:
                 n_ign = 0
             # Columnas presentes
@@ -2323,9 +2132,13 @@ with st.expander("🔎 Diagnóstico de Base de Datos"):
         try:
             if backend == "Postgres":
                 with engine.connect() as cx:
-                    sample_df = pd.read_sql_query(text("SELECT * FROM movimientos ORDER BY fecha DESC LIMIT 5"), cx)
+                    sample_df = pd.read_sql_query(
+                        text("SELECT * FROM movimientos WHERE usuario = :u ORDER BY fecha DESC LIMIT 5"), cx, params={"u": usuario}
+                    )
             else:
-                sample_df = pd.read_sql_query("SELECT * FROM movimientos ORDER BY fecha DESC LIMIT 5", conn)
+                sample_df = pd.read_sql_query(
+                    "SELECT * FROM movimientos WHERE usuario = ? ORDER BY fecha DESC LIMIT 5", conn, params=(usuario,)
+                )
             st.dataframe(sample_df, use_container_width=True)
         except Exception as e:
             st.info(f"No se pudo leer muestra: {e}")
@@ -2336,12 +2149,7 @@ with st.expander("🔎 Diagnóstico de Base de Datos"):
         with colx:
             if st.button("🧹 Vaciar movimientos (DELETE)"):
                 try:
-                    if backend == "Postgres":
-                        with engine.begin() as cx:
-                            cx.execute(text("DELETE FROM movimientos"))
-                    else:
-                        conn.execute("DELETE FROM movimientos")
-                        conn.commit()
+                    clear_transactions(conn)
                     st.success("Tabla 'movimientos' vaciada. Sube tu CSV nuevamente.")
                     scroll_and_rerun()
                 except Exception as e:
@@ -2351,9 +2159,9 @@ with st.expander("🔎 Diagnóstico de Base de Datos"):
                 try:
                     if backend == "Postgres":
                         with engine.begin() as cx:
-                            cx.execute(text("DELETE FROM movimientos_ignorados"))
+                            cx.execute(text("DELETE FROM movimientos_ignorados WHERE usuario = :u"), {"u": usuario})
                     else:
-                        conn.execute("DELETE FROM movimientos_ignorados")
+                        conn.execute("DELETE FROM movimientos_ignorados WHERE usuario = ?", (usuario,))
                         conn.commit()
                     st.success("Tabla 'movimientos_ignorados' vaciada.")
                     scroll_and_rerun()
@@ -2366,13 +2174,10 @@ with st.expander("🔎 Diagnóstico de Base de Datos"):
 # === Exportar base completa (backup) ===
 st.markdown("### Exportar base de datos (backup)")
 try:
-    # Leer TODA la tabla movimientos sin filtros de UI
-    if isinstance(conn, dict) and conn.get("pg"):
-        engine = conn["engine"]
-        with engine.connect() as cx:
-            df_all = pd.read_sql_query(text("SELECT * FROM movimientos ORDER BY fecha"), cx)
-    else:
-        df_all = pd.read_sql_query("SELECT * FROM movimientos ORDER BY fecha", conn)
+    # Leer TODA la tabla movimientos sin filtros de UI (con el nombre de categoría resuelto)
+    df_all = load_all(conn)
+    if not df_all.empty:
+        df_all = df_all.sort_values("fecha", kind="stable")
 
     if df_all is not None and not df_all.empty:
         csv_bytes = df_all.to_csv(index=False).encode("utf-8")
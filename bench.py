@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+"""
+Benchmarks de rendimiento para Facto$
+
+Uso:
+    python bench.py particiones --filas 1000000 --meses 36   (requiere DATABASE_URL de Postgres)
+    python bench.py lotes --filas 20000                      (SQLite local o Postgres)
+    python bench.py sugerencias --pendientes 5000            (SQLite local o Postgres)
+    python bench.py reembolsos --filas 100000                (en memoria, update_master.py)
+"""
+
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Agregar el directorio actual al path para importar db
+sys.path.insert(0, str(Path(__file__).parent))
+
+import classifier
+import db
+import suggest
+import update_master
+
+
+def _timeit(fn, reps: int, setup=None) -> float:
+    """Mediana en milisegundos de `reps` ejecuciones de fn() (setup() corre antes de cada una, fuera del tiempo)."""
+    samples = []
+    for _ in range(reps):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000.0)
+    return statistics.median(samples)
+
+
+def bench_particiones(args) -> None:
+    """Latencia de consultas mensuales: tabla única vs particionada por mes (tablas temporales bench_*)."""
+    conn = db.get_conn()
+    if not (isinstance(conn, dict) and conn.get("pg")):
+        print("❌ Este benchmark requiere Postgres (define DATABASE_URL)")
+        return
+    from sqlalchemy import text
+
+    engine = conn["engine"]
+    inicio = pd.Timestamp("2022-01-01")
+    meses = [inicio + pd.offsets.MonthBegin(i) for i in range(args.meses)]
+    dias = (meses[-1] + pd.offsets.MonthBegin(1) - inicio).days
+    print(f"🧪 Generando {args.filas:,} filas en {args.meses} meses...")
+    with engine.begin() as e:
+        e.execute(text("DROP TABLE IF EXISTS bench_mov_plano, bench_mov_part CASCADE"))
+        cols = "fecha TIMESTAMP, detalle_norm TEXT, monto DOUBLE PRECISION, unique_key TEXT"
+        e.execute(text(f"CREATE TABLE bench_mov_plano ({cols})"))
+        e.execute(text(f"CREATE TABLE bench_mov_part ({cols}) PARTITION BY RANGE (fecha)"))
+        for m in meses:
+            e.execute(text(db._pg_month_partition_ddl(m, table="bench_mov_part")))
+        e.execute(text(
+            """
+            INSERT INTO bench_mov_plano (fecha, detalle_norm, monto, unique_key)
+            SELECT CAST(:inicio AS DATE) + (random() * (:dias - 1))::int, 'comercio ' || (g % 500),
+                   -(random() * 50000)::int, 'k:' || g
+            FROM generate_series(1, :n) AS g
+            """
+        ), {"inicio": inicio.date(), "dias": dias, "n": args.filas})
+        e.execute(text("INSERT INTO bench_mov_part SELECT * FROM bench_mov_plano"))
+        for t in ("bench_mov_plano", "bench_mov_part"):
+            e.execute(text(f"CREATE INDEX ON {t} (fecha)"))
+            e.execute(text(f"CREATE INDEX ON {t} (detalle_norm)"))
+            e.execute(text(f"ANALYZE {t}"))
+
+    consultas = {
+        "resumen mensual": (
+            "SELECT detalle_norm, SUM(ABS(monto)) FROM {t} "
+            "WHERE fecha >= :d AND fecha < :h GROUP BY detalle_norm"
+        ),
+        "carga del mes": "SELECT * FROM {t} WHERE fecha >= :d AND fecha < :h",
+        "pre-check dedup": (
+            "SELECT 1 FROM {t} WHERE fecha >= :d AND fecha < CAST(:d AS DATE) + 1 "
+            "AND detalle_norm = 'comercio 7' LIMIT 1"
+        ),
+    }
+    print(f"\n{'consulta':<18}{'sin partición (ms)':>20}{'particionada (ms)':>20}")
+    try:
+        for nombre, sql in consultas.items():
+            res = {}
+            for t in ("bench_mov_plano", "bench_mov_part"):
+                q = text(sql.format(t=t))
+
+                def run():
+                    with engine.connect() as cx:
+                        for m in meses:
+                            cx.execute(q, {"d": m.date(), "h": (m + pd.offsets.MonthBegin(1)).date()}).fetchall()
+
+                res[t] = _timeit(run, args.reps) / len(meses)
+            print(f"{nombre:<18}{res['bench_mov_plano']:>20.2f}{res['bench_mov_part']:>20.2f}")
+    finally:
+        if not args.keep:
+            with engine.begin() as e:
+                e.execute(text("DROP TABLE IF EXISTS bench_mov_plano, bench_mov_part CASCADE"))
+
+
+BENCH_USUARIO = "__bench__"
+
+
+def bench_lotes(args) -> None:
+    """Escrituras y búsquedas multi-fila: fila a fila / placeholders generados vs ejecutor por lotes de db."""
+    conn = db.get_conn(usuario=BENCH_USUARIO)
+    db.init_db(conn)
+    db.replace_categories(conn, ["Bench"])
+    pg = isinstance(conn, dict) and conn.get("pg")
+    from sqlalchemy import text
+
+    u = BENCH_USUARIO
+    cat_id = db.get_categoria_ids(conn)["Bench"]
+    keys = [f"k:bench{i:08d}" for i in range(args.filas)]
+    mapa = pd.DataFrame({"detalle_norm": [f"comercio {i}" for i in range(args.filas)], "categoria": "Bench"})
+
+    def sql(q_pg: str, q_sqlite: str, params):
+        """Ejecuta en el motor activo (forma anterior: una sentencia por llamada)."""
+        if pg:
+            with conn["engine"].begin() as e:
+                return e.execute(text(q_pg), params).fetchall() if q_pg.startswith("SELECT") else e.execute(text(q_pg), params)
+        with conn:
+            cur = conn.execute(q_sqlite, params)
+            return cur.fetchall() if q_sqlite.startswith("SELECT") else cur
+
+    movs = [{
+        "id": None, "fecha": (pd.Timestamp("2024-01-01") + pd.Timedelta(days=i % 365)).date().isoformat(),
+        "detalle": f"COMERCIO {i}", "monto": -1000.0 - i, "es_gasto": True, "es_transferencia_o_abono": False,
+        "es_compartido_posible": None, "fraccion_mia_sugerida": None, "monto_mio_estimado": None,
+        "categoria_sugerida": None, "detalle_norm": f"comercio {i}", "monto_real": 1000.0 + i, "categoria": "Bench",
+        "categoria_id": cat_id, "nota_usuario": None, "unique_key": k, "es_entre_cuentas": False, "es_abono": False,
+    } for i, k in enumerate(keys)]
+
+    def limpiar():
+        for t in ("movimientos_borrados", "categoria_map", "movimientos", "movimientos_ignorados"):
+            sql(f"DELETE FROM {t} WHERE usuario = :u", f"DELETE FROM {t} WHERE usuario = :u", {"u": u})
+
+    # --- Forma anterior ---
+    def tombstones_fila_a_fila():
+        if pg:
+            with conn["engine"].begin() as e:
+                for k in keys:
+                    e.execute(text(
+                        "INSERT INTO movimientos_borrados (usuario, unique_key) VALUES (:u, :uk) "
+                        "ON CONFLICT (usuario, unique_key) DO NOTHING"
+                    ), {"u": u, "uk": k})
+            return
+        with conn:
+            for k in keys:
+                conn.execute("INSERT OR IGNORE INTO movimientos_borrados (usuario, unique_key) VALUES (?, ?)", (u, k))
+
+    def movimientos_fila_a_fila():
+        """Forma anterior de upsert_transactions: chequeo de firma e INSERT por fila."""
+        cols = db._MOVIMIENTOS_INSERT_COLS
+        existe = (
+            "SELECT 1 FROM movimientos WHERE usuario = :u AND fecha >= CAST(:f AS DATE) AND fecha < CAST(:f AS DATE) + 1 "
+            "AND detalle_norm = :dn AND ABS(COALESCE(monto, 0)) = :mc LIMIT 1"
+        ) if pg else (
+            "SELECT 1 FROM movimientos WHERE usuario = :u AND fecha >= :f AND fecha < date(:f, '+1 day') "
+            "AND detalle_norm = :dn AND ABS(COALESCE(monto, 0)) = :mc LIMIT 1"
+        )
+        insertar = f"INSERT INTO movimientos ({', '.join(cols)}) VALUES ({', '.join(':' + c for c in cols)}) ON CONFLICT DO NOTHING"
+        ignorar = db._SQL_IGNORED_INSERT_PG if pg else db._SQL_IGNORED_INSERT_SQLITE
+
+        def filas(ex):
+            for r in movs:
+                if ex(existe, {"u": u, "f": r["fecha"], "dn": r["detalle_norm"], "mc": round(abs(r["monto"]), 2)}).fetchone():
+                    ex(ignorar, db._ignored_params(r, u))
+                    continue
+                ex(insertar, {**r, "usuario": u, "comercio_id": None})
+        if pg:
+            with conn["engine"].begin() as e:
+                filas(lambda q, p: e.execute(text(q), p))
+            return
+        with conn:
+            filas(conn.execute)
+
+    def movimientos_lote():
+        if pg:
+            with conn["engine"].begin() as e:
+                db._insertar_lote(e, u, movs, {})
+            return
+        with conn:
+            db._insertar_lote(conn, u, movs, {})
+
+    ediciones = pd.DataFrame({"unique_key": keys, "categoria": "Bench", "nota_usuario": [f"nota {i}" for i in range(len(keys))]})
+
+    def con_movimientos():
+        limpiar()
+        movimientos_lote()
+
+    def ediciones_fila_a_fila():
+        """Forma anterior de apply_edits: un UPDATE por fila (en Postgres, cada uno en su transacción)."""
+        q = "UPDATE movimientos SET categoria_id = :c, nota_usuario = :nota WHERE usuario = :u AND unique_key = :uk"
+        for k, nota in zip(ediciones["unique_key"], ediciones["nota_usuario"]):
+            if pg:
+                with conn["engine"].begin() as e:
+                    e.execute(text(q), {"c": cat_id, "nota": nota, "u": u, "uk": k})
+            else:
+                conn.execute(q, {"c": cat_id, "nota": nota, "u": u, "uk": k})
+        if not pg:
+            conn.commit()
+
+    def mapa_executemany():
+        rows = [{"u": u, "dn": dn, "c": cat_id} for dn in mapa["detalle_norm"]]
+        q = (
+            "INSERT INTO categoria_map(usuario, detalle_norm, categoria_id) VALUES(:u, :dn, :c) "
+            "ON CONFLICT(usuario, detalle_norm) DO UPDATE SET categoria_id=excluded.categoria_id"
+        )
+        if pg:
+            with conn["engine"].begin() as e:
+                e.execute(text(q), rows)
+            return
+        with conn:
+            conn.executemany(q, rows)
+
+    def busqueda_placeholders():
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            params = {f"uk{j}": k for j, k in enumerate(chunk)}
+            params["u"] = u
+            ph = ", ".join(f":uk{j}" for j in range(len(chunk)))
+            q = f"SELECT unique_key FROM movimientos_borrados WHERE usuario = :u AND unique_key IN ({ph})"
+            sql(q, q, params)
+
+    # --- Ejecutor por lotes ---
+    def tombstones_lote():
+        if pg:
+            with conn["engine"].begin() as e:
+                db._insert_rows(e, "movimientos_borrados", ["usuario", "unique_key"], [(u, k) for k in keys],
+                                "ON CONFLICT (usuario, unique_key) DO NOTHING")
+            return
+        with conn:
+            db._insert_rows(conn, "movimientos_borrados", ["usuario", "unique_key"], [(u, k) for k in keys],
+                            "ON CONFLICT (usuario, unique_key) DO NOTHING")
+
+    casos = [
+        ("insertar tombstones", limpiar, tombstones_fila_a_fila, tombstones_lote),
+        ("upsert categoria_map", limpiar, mapa_executemany, lambda: db.update_categoria_map_from_df(conn, mapa)),
+        ("buscar tombstones", tombstones_lote, busqueda_placeholders, lambda: db._tombstoned_keys(conn, keys)),
+        ("insertar movimientos", limpiar, movimientos_fila_a_fila, movimientos_lote),
+        ("editar movimientos", con_movimientos, ediciones_fila_a_fila, lambda: db.apply_edits(conn, ediciones)),
+    ]
+    print(f"🧪 {'Postgres' if pg else 'SQLite'}, {args.filas:,} filas por operación")
+    print(f"\n{'operación':<22}{'anterior (ms)':>16}{'por lotes (ms)':>16}{'x':>8}")
+    try:
+        for nombre, setup, anterior, lote in casos:
+            t_old = _timeit(anterior, args.reps, setup=setup)
+            t_new = _timeit(lote, args.reps, setup=setup)
+            print(f"{nombre:<22}{t_old:>16.1f}{t_new:>16.1f}{t_old / max(t_new, 1e-9):>8.1f}")
+    finally:
+        limpiar()
+        db.replace_categories(conn, [])
+
+
+def _sugerencias_fila_a_fila(df, conn, hist_df):
+    """Forma anterior de build_suggestions_df: iterrows, deduplicación contra la lista de resultados y similitud por fila."""
+    sug_df = df[(df["categoria"].isna()) | (df["categoria"] == "") | (df["categoria"] == "Sin categoría")]
+    exact_map = db.lookup_categoria_map(conn, sorted(set(sug_df["detalle_norm"].dropna().astype(str))))
+    results, pending = [], []
+    for _, row in sug_df.iterrows():
+        dn = str(row.get("detalle_norm") or "")
+        if dn and exact_map.get(dn):
+            results.append({"unique_key": row["unique_key"], "detalle_norm": dn, "sugerida": exact_map[dn], "fuente": "Mapa exacto"})
+        elif dn:
+            pending.append(dn)
+    dom_map = suggest._dominant_categories(conn, sorted(set(pending)))
+    for _, row in sug_df.iterrows():
+        dn = str(row.get("detalle_norm") or "")
+        if not dn or any(r["detalle_norm"] == dn and r["unique_key"] == row["unique_key"] for r in results):
+            continue
+        cat, pct = dom_map.get(dn, (None, 0.0))
+        if cat and pct >= 70.0:
+            results.append({"unique_key": row["unique_key"], "detalle_norm": dn, "sugerida": cat, "fuente": "Historial dominante"})
+            continue
+        normalized = dn.strip().upper()
+        matches = hist_df[hist_df["detalle_norm_cmp"] == normalized]
+        if matches.empty and len(normalized) >= 4:
+            matches = hist_df[hist_df["detalle_norm_cmp"].str.contains(normalized[:4], regex=False, na=False)]
+        m = abs(float(pd.to_numeric(row.get("monto"), errors="coerce") or 0.0))
+        if not matches.empty and m > 0:
+            tol = max(m * 0.25, 1000)
+            h = pd.to_numeric(matches["monto"], errors="coerce").fillna(0).abs()
+            if ((h >= m - tol) & (h <= m + tol)).any():
+                matches = matches[(h >= m - tol) & (h <= m + tol)]
+        if not matches.empty:
+            counts = matches.groupby("categoria").size().sort_values(ascending=False, kind="stable").head(3)
+            score = counts.iloc[0] / counts.sum()
+            results.append({"unique_key": row["unique_key"], "detalle_norm": dn, "sugerida": counts.index[0],
+                            "fuente": f"Nombres similares ({score:.2f})"})
+            continue
+        results.append({"unique_key": row["unique_key"], "detalle_norm": dn, "sugerida": "Sin categoría", "fuente": "Sin sugerencia"})
+    return pd.DataFrame(results)
+
+
+def bench_sugerencias(args) -> None:
+    """build_suggestions_df: recorrido fila a fila (cuadrático) vs pipeline vectorizado de suggest.py."""
+    conn = db.get_conn(usuario=BENCH_USUARIO)
+    db.init_db(conn)
+    pg = isinstance(conn, dict) and conn.get("pg")
+    rng = np.random.default_rng(7)
+    categorias = ["Supermercado", "Transporte", "Restaurantes", "Salud", "Hogar", "Ocio"]
+    db.replace_categories(conn, categorias)
+
+    # Historial categorizado: cada comercio tiene una categoría principal y algo de ruido
+    # Nombres con letras: la clave canónica descarta números de sucursal
+    letras = lambda i: "".join(chr(65 + (i // 26 ** k) % 26) for k in range(3))
+    comercios = [f"COMERCIO {letras(i)} SANTIAGO" for i in range(args.comercios)]
+    principal = rng.integers(0, len(categorias), len(comercios))
+    idx = rng.integers(0, len(comercios), args.historial)
+    ruido = rng.random(args.historial) < 0.2
+    cat_idx = np.where(ruido, rng.integers(0, len(categorias), args.historial), principal[idx])
+    fechas = pd.Timestamp("2023-01-01") + pd.to_timedelta(rng.integers(0, 700, args.historial + args.pendientes), unit="D")
+    hist = pd.DataFrame({
+        "fecha": fechas[:args.historial],
+        "detalle": [comercios[i] for i in idx],
+        "monto": -rng.integers(1000, 80000, args.historial),
+        "categoria": [categorias[c] for c in cat_idx],
+    })
+    # Pendientes: comercios conocidos, variantes con sufijo (prefijo común) y desconocidos
+    tipo = rng.random(args.pendientes)
+    pidx = rng.integers(0, len(comercios), args.pendientes)
+    detalles = [
+        comercios[i] if t < 0.5 else (f"COMERCIO {letras(i)}X SUC" if t < 0.85 else f"TIENDA NUEVA {letras(i)}")
+        for t, i in zip(tipo, pidx)
+    ]
+    pend = pd.DataFrame({
+        "fecha": fechas[args.historial:],
+        "detalle": detalles,
+        "monto": -rng.integers(1000, 80000, args.pendientes),
+        "categoria": None,
+    })
+    print(f"🧪 {'Postgres' if pg else 'SQLite'}, {args.historial:,} movimientos categorizados, {args.pendientes:,} pendientes")
+    try:
+        db.upsert_transactions(conn, pd.concat([hist, pend], ignore_index=True))
+        # Reglas exactas para una fracción de los comercios
+        con_regla = comercios[:: 20]
+        db.update_categoria_map_from_df(conn, pd.DataFrame({
+            "detalle_norm": [db._normalize_text_basic(c) for c in con_regla],
+            "categoria": [categorias[principal[i * 20]] for i in range(len(con_regla))],
+        }))
+        df = db.load_all(conn)
+        hist_df = df.copy()
+        hist_df["detalle_norm_cmp"] = hist_df["detalle_norm"].astype(str).str.strip().str.upper()
+        hist_df = hist_df[
+            (hist_df["detalle_norm_cmp"] != "") & hist_df["categoria"].notna() & (hist_df["categoria"] != "Sin categoría")
+        ]
+
+        t_old = _timeit(lambda: _sugerencias_fila_a_fila(df, conn, hist_df), args.reps)
+        t_new = _timeit(lambda: suggest.build_suggestions_df(df, conn, hist_df=hist_df), args.reps)
+        cols = ["unique_key", "detalle_norm", "sugerida", "fuente"]
+        viejo = _sugerencias_fila_a_fila(df, conn, hist_df)[cols].reset_index(drop=True)
+        nuevo = suggest.build_suggestions_df(df, conn, hist_df=hist_df)[cols].reset_index(drop=True)
+        # La forma anterior no tenía nombres aproximados ni clasificador: esas filas eran "Sin sugerencia"
+        comparable = nuevo.copy()
+        aprox = comparable["fuente"].str.startswith(("Nombre aproximado", "Clasificador"))
+        comparable.loc[aprox, ["sugerida", "fuente"]] = ["Sin categoría", "Sin sugerencia"]
+        iguales = viejo.equals(comparable)
+        print(f"\n{'operación':<22}{'anterior (ms)':>16}{'vectorizado (ms)':>18}{'x':>8}")
+        print(f"{'sugerencias':<22}{t_old:>16.1f}{t_new:>18.1f}{t_old / max(t_new, 1e-9):>8.1f}")
+        print(f"{'✅' if iguales else '❌'} {len(nuevo):,} sugerencias, {'idénticas' if iguales else 'DISTINTAS'} a la forma anterior")
+        print(nuevo["fuente"].str.replace(r" \(.*\)", "", regex=True).value_counts().to_string())
+
+        # Similitud: construir el índice del historial (primera vez) vs reutilizarlo (misma versión de datos)
+        pend_df = df[df["categoria"].isna() | (df["categoria"] == "") | (df["categoria"] == "Sin categoría")]
+        similitud = lambda: suggest.suggest_by_similarity(pend_df, hist_df)
+        t_frio = _timeit(similitud, args.reps, setup=suggest._INDEX_CACHE.clear)
+        t_cache = _timeit(similitud, args.reps)
+        print(f"\n{'similitud':<22}{'índice nuevo (ms)':>18}{'en caché (ms)':>16}")
+        print(f"{f'{len(pend_df):,} pendientes':<22}{t_frio:>18.1f}{t_cache:>16.1f}")
+
+        # Clasificador: entrenar desde el historial vs puntuar todos los pendientes en una pasada
+        t_train = _timeit(lambda: classifier.retrain(conn), args.reps)
+        t_score = _timeit(lambda: classifier.suggest_by_classifier(conn, pend_df), args.reps)
+        print(f"\n{'clasificador':<22}{'entrenar (ms)':>18}{'puntuar (ms)':>16}")
+        print(f"{f'{len(pend_df):,} pendientes':<22}{t_train:>18.1f}{t_score:>16.1f}")
+    finally:
+        # Hijas antes que padres (claves foráneas hacia categorias y comercios)
+        tablas = [t for t in db._TENANT_TABLES if t not in ("categorias", "comercios")] + ["comercios", "categorias"]
+        if pg:
+            from sqlalchemy import text
+
+            with conn["engine"].begin() as e:
+                for t in tablas:
+                    e.execute(text(f"DELETE FROM {t} WHERE usuario = :u"), {"u": BENCH_USUARIO})
+        else:
+            with conn:
+                for t in tablas:
+                    conn.execute(f"DELETE FROM {t} WHERE usuario = ?", (BENCH_USUARIO,))
+        db._bump_meta_version(conn)
+        classifier._MODELOS.pop(db.cache_key(conn), None)
+
+
+def _reembolsos_fila_a_fila(df, window_days, tol):
+    """Forma anterior de match_reimbursements: por cada abono, filtro booleano de todos los gastos y orden de candidatos."""
+    df = df.sort_values("fecha")
+    df["match_id"] = None
+    gastos = df[df["monto"] < 0][["id", "fecha", "monto"]]
+    abonos = df[df["monto"] > 0][["id", "fecha", "monto"]]
+    for idx, row in abonos.iterrows():
+        candidates = gastos[(gastos["fecha"] >= row["fecha"] - pd.Timedelta(days=window_days)) & (gastos["fecha"] <= row["fecha"])]
+        diff = (candidates["monto"].abs() - abs(row["monto"])).abs()
+        near = candidates[diff <= tol].assign(absdiff=diff)
+        if len(near):
+            df.loc[idx, "match_id"] = near.sort_values(["absdiff", "fecha"], ascending=[True, False])["id"].iloc[0]
+    return df
+
+
+def bench_reembolsos(args) -> None:
+    """match_reimbursements: recorrido por abono (O(abonos x gastos)) vs barrido con searchsorted."""
+    rng = np.random.default_rng(7)
+    n = args.filas
+    fechas = pd.Timestamp("2021-01-01") + pd.to_timedelta(rng.integers(0, 365 * args.anios, n), unit="D")
+    montos = -rng.integers(500, 300_000, n).astype(float)
+    abonos = rng.random(n) < args.frac_abonos
+    montos[abonos] = rng.integers(500, 300_000, int(abonos.sum()))
+    df = pd.DataFrame({"id": [f"m{i}" for i in range(n)], "fecha": fechas, "monto": montos, "detalle_norm": ""})
+    print(f"🧪 {n:,} filas, {int(abonos.sum()):,} abonos en {args.anios} años")
+
+    t_nuevo = _timeit(lambda: update_master.match_reimbursements(df.copy(), args.ventana, args.tol), args.reps)
+    res = update_master.match_reimbursements(df.copy(), args.ventana, args.tol)
+    emparejados = res["match_id"].dropna()
+
+    # El recorrido anterior es lineal en abonos: se mide sobre una muestra y se extrapola
+    muestra_ids = set(df.loc[abonos, "id"].head(args.muestra))
+    sub = df[(df["monto"] < 0) | df["id"].isin(muestra_ids)]
+    t0 = time.perf_counter()
+    _reembolsos_fila_a_fila(sub.copy(), args.ventana, args.tol)
+    t_muestra = (time.perf_counter() - t0) * 1000.0
+    t_anterior = t_muestra * abonos.sum() / max(1, len(muestra_ids))
+
+    print(f"  Barrido (searchsorted)   {t_nuevo:10.1f} ms  ({len(emparejados):,} pares, uno a uno: {emparejados.is_unique})")
+    print(f"  Fila a fila (estimado)   {t_anterior:10.1f} ms  ({len(muestra_ids):,} abonos medidos: {t_muestra:.0f} ms)")
+    print(f"  Aceleración              {t_anterior / t_nuevo:10.1f}x")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmarks de Facto$")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("particiones", help="Consultas mensuales con y sin particionamiento (Postgres)")
+    p.add_argument("--filas", type=int, default=1_000_000)
+    p.add_argument("--meses", type=int, default=36)
+    p.add_argument("--reps", type=int, default=5)
+    p.add_argument("--keep", action="store_true", help="No borrar las tablas bench_* al terminar")
+    p.set_defaults(func=bench_particiones)
+
+    p = sub.add_parser("lotes", help="Escrituras multi-fila: fila a fila vs ejecutor por lotes")
+    p.add_argument("--filas", type=int, default=20_000)
+    p.add_argument("--reps", type=int, default=5)
+    p.set_defaults(func=bench_lotes)
+
+    p = sub.add_parser("sugerencias", help="Sugerencias de categoría: fila a fila vs pipeline vectorizado")
+    p.add_argument("--pendientes", type=int, default=5_000)
+    p.add_argument("--historial", type=int, default=20_000)
+    p.add_argument("--comercios", type=int, default=800)
+    p.add_argument("--reps", type=int, default=3)
+    p.set_defaults(func=bench_sugerencias)
+
+    p = sub.add_parser("reembolsos", help="Emparejamiento de reembolsos: por abono vs barrido ordenado")
+    p.add_argument("--filas", type=int, default=100_000)
+    p.add_argument("--anios", type=int, default=4)
+    p.add_argument("--frac-abonos", type=float, default=0.1)
+    p.add_argument("--ventana", type=int, default=21)
+    p.add_argument("--tol", type=float, default=1000)
+    p.add_argument("--muestra", type=int, default=500, help="Abonos para medir el recorrido anterior")
+    p.add_argument("--reps", type=int, default=3)
+    p.set_defaults(func=bench_reembolsos)
+
+    args = ap.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+Clasificador de texto incremental: sugiere categoría para comercios que no están en el
+mapa ni se parecen a nada del historial.
+
+Naive Bayes multinomial sobre trigramas de caracteres de detalle_norm más un token por
+tramo de monto (escala log2). Cada feature se identifica por su crc32 (los tramos de monto,
+por 2^32 + tramo) y los conteos por (categoría, feature) se guardan en clasificador_conteos:
+  - cada categoría confirmada (apply_category_change o guardar la tabla) suma sus conteos
+    con un upsert en lote (y resta los de la categoría anterior),
+  - el modelo se carga de la base una vez por proceso; solo si no hay conteos se entrena
+    con el historial categorizado,
+  - las filas pendientes se puntúan todas juntas: una matriz (filas x categorías) de
+    log-probabilidades sumadas por fila con np.add.reduceat.
+"""
+
+import threading
+import zlib
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+from db import add_classifier_counts, cache_key, get_categoria_ids, load_all, load_classifier_counts
+
+NGRAMA = 3
+ALPHA = 0.5
+# Probabilidad mínima de la mejor categoría para sugerirla; la confianza se escala por
+# CONFIANZA_FACTOR para quedar bajo las fuentes basadas en el historial del comercio
+MIN_PROB = 0.6
+CONFIANZA_FACTOR = 0.75
+TOP_K = 3
+
+# Feature reservada: documentos (movimientos) por categoría, para la probabilidad a priori
+_DOCS = -1
+_MONTO_BASE = 1 << 32
+
+_LOCK = threading.Lock()
+_MODELOS: Dict[str, "NaiveBayesModel"] = {}
+
+
+def _ngramas(nombre: str) -> np.ndarray:
+    s = f" {nombre} "
+    return np.array([zlib.crc32(s[i:i + NGRAMA].encode("utf-8")) for i in range(len(s) - NGRAMA + 1)], dtype=np.int64)
+
+
+def _features(detalles: pd.Series, montos: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (fila, feature) de cada ocurrencia, ordenado por fila: trigramas del nombre (calculados
+    una vez por nombre distinto) y el tramo de monto.
+    """
+    nombres = detalles.fillna("").astype(str).str.strip().str.upper().to_numpy()
+    unicos, codes = np.unique(nombres, return_inverse=True)
+    gramas = [_ngramas(n) if n else np.empty(0, np.int64) for n in unicos]
+    largos = np.array([len(g) for g in gramas], dtype=np.int64)
+    planos = np.concatenate(gramas) if gramas else np.empty(0, np.int64)
+    inicio = np.cumsum(largos) - largos
+    # Trigramas de cada fila: tramo [inicio, inicio + largo) de su nombre en `planos`
+    lens = largos[codes]
+    pos = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens) + np.repeat(inicio[codes], lens)
+    m = np.abs(pd.to_numeric(montos, errors="coerce").fillna(0).to_numpy(dtype=float))
+    tramos = _MONTO_BASE + np.floor(np.log2(np.maximum(m, 1.0))).astype(np.int64)
+    filas = np.concatenate([np.repeat(np.arange(len(nombres)), lens), np.arange(len(nombres))])
+    feats = np.concatenate([planos[pos], tramos])
+    orden = np.argsort(filas, kind="stable")
+    return filas[orden], feats[orden]
+
+
+def _conteos(detalles: pd.Series, montos: pd.Series, categoria_ids: pd.Series, signo: float = 1.0) -> pd.DataFrame:
+    """Deltas (categoria_id, feature, n) de estos movimientos, incluida la fila de documentos."""
+    filas, feats = _features(detalles, montos)
+    cats = categoria_ids.to_numpy(dtype=np.int64)
+    return pd.concat([
+        pd.DataFrame({"categoria_id": cats[filas], "feature": feats, "n": signo}),
+        pd.DataFrame({"categoria_id": cats, "feature": _DOCS, "n": signo}),
+    ], ignore_index=True)
+
+
+class NaiveBayesModel:
+    """Modelo inmutable construido a partir de los conteos (categoria_id, feature, n)."""
+
+    def __init__(self, counts: pd.DataFrame):
+        counts = counts.groupby(["categoria_id", "feature"], as_index=False)["n"].sum()
+        self.counts = counts
+        self.clases = np.unique(counts["categoria_id"].to_numpy(dtype=np.int64))
+        docs = counts[counts["feature"] == _DOCS]
+        terms = counts[counts["feature"] != _DOCS]
+        self.features = np.unique(terms["feature"].to_numpy(dtype=np.int64))
+        ci = np.searchsorted(self.clases, terms["categoria_id"].to_numpy(dtype=np.int64))
+        fi = np.searchsorted(self.features, terms["feature"].to_numpy(dtype=np.int64))
+        conteos = np.zeros((len(self.features), len(self.clases)))
+        np.add.at(conteos, (fi, ci), terms["n"].to_numpy(dtype=float))
+        # Conteos negativos (categorías corregidas) no restan por debajo de cero
+        conteos = np.maximum(conteos, 0.0)
+        n_docs = np.zeros(len(self.clases))
+        np.add.at(n_docs, np.searchsorted(self.clases, docs["categoria_id"].to_numpy(dtype=np.int64)), docs["n"].to_numpy(dtype=float))
+        n_docs = np.maximum(n_docs, 0.0)
+        self.vacio = not n_docs.sum() or not len(self.features)
+        with np.errstate(divide="ignore"):
+            self.log_prior = np.log(n_docs / max(n_docs.sum(), 1.0))
+            self.log_prob = np.log(conteos + ALPHA) - np.log(conteos.sum(axis=0) + ALPHA * max(len(self.features), 1))
+
+    def con(self, deltas: pd.DataFrame) -> "NaiveBayesModel":
+        """Modelo con los deltas sumados."""
+        return NaiveBayesModel(pd.concat([self.counts, deltas], ignore_index=True))
+
+    def probabilidades(self, detalles: pd.Series, montos: pd.Series, clases_validas: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Probabilidad a posteriori de cada clase (columnas = self.clases) para cada fila, en
+        una sola operación. Devuelve (probabilidades, filas con alguna feature conocida).
+        """
+        n = len(detalles)
+        scores = np.tile(self.log_prior, (n, 1))
+        scores[:, ~np.isin(self.clases, clases_validas)] = -np.inf
+        filas, feats = _features(detalles, montos)
+        j = np.searchsorted(self.features, feats).clip(max=max(len(self.features) - 1, 0))
+        conocida = self.features[j] == feats if len(self.features) else np.zeros(len(feats), dtype=bool)
+        filas, j = filas[conocida], j[conocida]
+        con_datos = np.zeros(n, dtype=bool)
+        if len(filas):
+            # filas viene ordenado: una suma por tramo de fila
+            inicios = np.flatnonzero(np.r_[True, filas[1:] != filas[:-1]])
+            scores[filas[inicios]] += np.add.reduceat(self.log_prob[j], inicios, axis=0)
+            con_datos[filas[inicios]] = True
+        with np.errstate(invalid="ignore"):
+            scores -= scores.max(axis=1, keepdims=True)
+            probs = np.exp(scores)
+            probs /= probs.sum(axis=1, keepdims=True)
+        return np.nan_to_num(probs), con_datos
+
+
+def _modelo(conn) -> Tuple[NaiveBayesModel, bool]:
+    """Modelo de la conexión (caché del proceso). Devuelve (modelo, si se acaba de entrenar desde el historial)."""
+    key = cache_key(conn)
+    with _LOCK:
+        modelo = _MODELOS.get(key)
+    if modelo is not None:
+        return modelo, False
+    counts = load_classifier_counts(conn)
+    entrenado = counts.empty
+    if entrenado:
+        counts = _conteos_historial(conn)
+        if not counts.empty:
+            add_classifier_counts(conn, counts, replace=True)
+    modelo = NaiveBayesModel(counts)
+    with _LOCK:
+        _MODELOS[key] = modelo
+    return modelo, entrenado
+
+
+def _conteos_historial(conn) -> pd.DataFrame:
+    df = load_all(conn)
+    ids = get_categoria_ids(conn)
+    if df.empty:
+        return pd.DataFrame(columns=["categoria_id", "feature", "n"])
+    cat_ids = df["categoria"].map({k: v for k, v in ids.items() if k != "Sin categoría"})
+    df = df[cat_ids.notna() & df["detalle_norm"].fillna("").astype(str).str.strip().ne("")]
+    if df.empty:
+        return pd.DataFrame(columns=["categoria_id", "feature", "n"])
+    return _conteos(df["detalle_norm"], df["monto"], cat_ids[df.index].astype(np.int64))
+
+
+def retrain(conn) -> int:
+    """Reentrena el clasificador del usuario desde el historial categorizado. Devuelve las filas de conteos."""
+    counts = _conteos_historial(conn)
+    n = add_classifier_counts(conn, counts, replace=True)
+    with _LOCK:
+        _MODELOS[cache_key(conn)] = NaiveBayesModel(counts)
+    return n
+
+
+def learn_categories(conn, cambios: pd.DataFrame) -> int:
+    """
+    Actualiza el clasificador con categorías confirmadas. `cambios`: detalle_norm, monto,
+    categoria y opcionalmente categoria_anterior (sus conteos se restan). Las filas en
+    "Sin categoría" no enseñan nada. Devuelve los movimientos aprendidos.
+    """
+    if cambios is None or cambios.empty:
+        return 0
+    _, entrenado = _modelo(conn)
+    if entrenado:
+        # El historial ya incluye estas categorías
+        return 0
+    ids = {k: v for k, v in get_categoria_ids(conn).items() if k != "Sin categoría"}
+    cambios = cambios[cambios["detalle_norm"].fillna("").astype(str).str.strip().ne("")]
+    nueva = cambios["categoria"].map(ids)
+    anterior = cambios["categoria_anterior"].map(ids) if "categoria_anterior" in cambios.columns else pd.Series(np.nan, index=cambios.index)
+    cambio = nueva.fillna(-1) != anterior.fillna(-1)
+    partes = []
+    suma = cambio & nueva.notna()
+    if suma.any():
+        partes.append(_conteos(cambios.loc[suma, "detalle_norm"], cambios.loc[suma, "monto"], nueva[suma].astype(np.int64)))
+    resta = cambio & anterior.notna()
+    if resta.any():
+        partes.append(_conteos(cambios.loc[resta, "detalle_norm"], cambios.loc[resta, "monto"], anterior[resta].astype(np.int64), -1.0))
+    if not partes:
+        return 0
+    deltas = pd.concat(partes, ignore_index=True)
+    add_classifier_counts(conn, deltas)
+    key = cache_key(conn)
+    with _LOCK:
+        if key in _MODELOS:
+            _MODELOS[key] = _MODELOS[key].con(deltas)
+    return int(suma.sum())
+
+
+def suggest_by_classifier(conn, pendientes: pd.DataFrame, top_k: int = TOP_K) -> pd.DataFrame:
+    """
+    Puntúa todas las filas pendientes (detalle_norm, monto) en lote. Devuelve, solo para las
+    filas cuya mejor categoría supera MIN_PROB: sugerida, confianza (probabilidad x
+    CONFIANZA_FACTOR) y alternativas_sim (top_k categorías con su probabilidad).
+    """
+    vacio = pd.DataFrame({
+        "sugerida": pd.Series(dtype=object), "confianza": pd.Series(dtype=float), "alternativas_sim": pd.Series(dtype=object),
+    })
+    if pendientes.empty:
+        return vacio
+    modelo, _ = _modelo(conn)
+    if modelo.vacio:
+        return vacio
+    nombres = {v: k for k, v in get_categoria_ids(conn).items() if k != "Sin categoría"}
+    probs, con_datos = modelo.probabilidades(
+        pendientes["detalle_norm"], pendientes["monto"], np.array(list(nombres), dtype=np.int64)
+    )
+    k = min(top_k, probs.shape[1])
+    top = np.argsort(-probs, axis=1, kind="stable")[:, :k]
+    top_p = np.take_along_axis(probs, top, axis=1)
+    ok = con_datos & (top_p[:, 0] >= MIN_PROB)
+    if not ok.any():
+        return vacio
+    cats = modelo.clases[top[ok]]
+    alternativas = [
+        [{"categoria": nombres[int(c)], "score": float(p)} for c, p in zip(fila_c, fila_p) if p >= 0.01]
+        for fila_c, fila_p in zip(cats, top_p[ok])
+    ]
+    return pd.DataFrame({
+        "sugerida": [a[0]["categoria"] for a in alternativas],
+        "confianza": top_p[ok, 0] * CONFIANZA_FACTOR,
+        "alternativas_sim": alternativas,
+    }, index=pendientes.index[ok])
@@ -1,12 +1,19 @@
 import os
 import sqlite3
+import threading
+import functools
 from typing import Tuple, Any, List, Optional, Dict
 
 import pandas as pd
 import numpy as np
 import hashlib
+import json
 import unicodedata
 import re
+
+from matching import match_pairs
+from rules import flag_rules, merchant_rules
+
 try:
     from sqlalchemy import create_engine, text
 except Exception:  # sqlalchemy is optional locally
@@ -16,6 +23,315 @@ except Exception:  # sqlalchemy is optional locally
 
 DB_PATH_DEFAULT = os.path.join("data", "gastos.db")
 
+# Columnas tipadas de movimientos_ignorados (junto al payload crudo)
+_IGNORED_TYPED_COLS_PG = [
+    ("fecha", "TIMESTAMP"),
+    ("detalle", "TEXT"),
+    ("detalle_norm", "TEXT"),
+    ("monto", "DOUBLE PRECISION"),
+    ("monto_real", "DOUBLE PRECISION"),
+    ("categoria", "TEXT"),
+]
+_IGNORED_TYPED_COLS_SQLITE = [
+    ("fecha", "TEXT"),
+    ("detalle", "TEXT"),
+    ("detalle_norm", "TEXT"),
+    ("monto", "REAL"),
+    ("monto_real", "REAL"),
+    ("categoria", "TEXT"),
+]
+
+# Sugerencia persistida en movimientos (categoria_sugerida ya existe): (columna, tipo PG, tipo SQLite)
+_SUGERENCIA_COLS = [
+    ("sugerencia_fuente", "TEXT", "TEXT"),
+    ("sugerencia_confianza", "DOUBLE PRECISION", "REAL"),
+    ("sugerencia_alternativas", "TEXT", "TEXT"),
+]
+
+# Cola de pendientes: movimientos.pendiente marca las filas sin categoría o en "Sin categoría".
+# La mantienen triggers en cada INSERT y en cada cambio de categoria_id (y al renombrar una
+# categoría); el índice parcial idx_movimientos_usuario_pendientes solo contiene esas filas.
+_PENDIENTE_EXPR = "(categoria_id IS NULL OR categoria_id IN (SELECT c.id FROM categorias c WHERE c.nombre = 'Sin categoría'))"
+
+_SQLITE_PENDIENTE_TRIGGERS = {
+    "trg_movimientos_pendiente_insert": f"""
+        CREATE TRIGGER trg_movimientos_pendiente_insert AFTER INSERT ON movimientos
+        BEGIN
+            UPDATE movimientos SET pendiente = {_PENDIENTE_EXPR.replace("categoria_id", "NEW.categoria_id")} WHERE rowid = NEW.rowid;
+        END
+    """,
+    "trg_movimientos_pendiente_update": f"""
+        CREATE TRIGGER trg_movimientos_pendiente_update AFTER UPDATE OF categoria_id ON movimientos
+        BEGIN
+            UPDATE movimientos SET pendiente = {_PENDIENTE_EXPR.replace("categoria_id", "NEW.categoria_id")} WHERE rowid = NEW.rowid;
+        END
+    """,
+    "trg_categorias_pendiente": """
+        CREATE TRIGGER trg_categorias_pendiente AFTER UPDATE OF nombre ON categorias
+        BEGIN
+            UPDATE movimientos SET pendiente = (NEW.nombre = 'Sin categoría') WHERE usuario = NEW.usuario AND categoria_id = NEW.id;
+        END
+    """,
+}
+
+_PG_PENDIENTE_TRIGGERS = [
+    """
+    CREATE OR REPLACE FUNCTION movimientos_pendiente() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        NEW.pendiente := NEW.categoria_id IS NULL
+            OR EXISTS (SELECT 1 FROM categorias c WHERE c.id = NEW.categoria_id AND c.nombre = 'Sin categoría');
+        RETURN NEW;
+    END
+    $$
+    """,
+    "DROP TRIGGER IF EXISTS trg_movimientos_pendiente ON movimientos",
+    "CREATE TRIGGER trg_movimientos_pendiente BEFORE INSERT OR UPDATE OF categoria_id ON movimientos "
+    "FOR EACH ROW EXECUTE FUNCTION movimientos_pendiente()",
+    """
+    CREATE OR REPLACE FUNCTION categorias_pendiente() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE movimientos SET pendiente = (NEW.nombre = 'Sin categoría') WHERE usuario = NEW.usuario AND categoria_id = NEW.id;
+        RETURN NULL;
+    END
+    $$
+    """,
+    "DROP TRIGGER IF EXISTS trg_categorias_pendiente ON categorias",
+    "CREATE TRIGGER trg_categorias_pendiente AFTER UPDATE OF nombre ON categorias "
+    "FOR EACH ROW EXECUTE FUNCTION categorias_pendiente()",
+]
+
+
+# Movimientos particionados por mes (partition_movimientos_by_month): un índice único sobre la
+# tabla particionada debe incluir la clave de partición (fecha, TIMESTAMP), así que la unicidad
+# de (usuario, unique_key) se impone con la tabla movimientos_claves. El trigger BEFORE INSERT
+# reclama la clave ahí (ON CONFLICT con destino) y descarta la fila si ya existía, igual que
+# ON CONFLICT DO NOTHING; el trigger de DELETE libera las claves de las filas borradas.
+_PG_CLAVES_TRIGGERS = [
+    "CREATE TABLE IF NOT EXISTS movimientos_claves (usuario TEXT NOT NULL, unique_key TEXT NOT NULL, "
+    "PRIMARY KEY (usuario, unique_key))",
+    """
+    CREATE OR REPLACE FUNCTION movimientos_reclamar_clave() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF NEW.unique_key IS NULL THEN
+            RETURN NEW;
+        END IF;
+        INSERT INTO movimientos_claves (usuario, unique_key) VALUES (NEW.usuario, NEW.unique_key)
+        ON CONFLICT (usuario, unique_key) DO NOTHING;
+        IF NOT FOUND THEN
+            RETURN NULL;
+        END IF;
+        RETURN NEW;
+    END
+    $$
+    """,
+    "DROP TRIGGER IF EXISTS trg_movimientos_clave ON movimientos",
+    # Se dispara antes que trg_movimientos_pendiente (orden alfabético)
+    "CREATE TRIGGER trg_movimientos_clave BEFORE INSERT ON movimientos "
+    "FOR EACH ROW EXECUTE FUNCTION movimientos_reclamar_clave()",
+    """
+    CREATE OR REPLACE FUNCTION movimientos_liberar_claves() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        DELETE FROM movimientos_claves k USING borradas b
+        WHERE k.usuario = b.usuario AND k.unique_key = b.unique_key;
+        RETURN NULL;
+    END
+    $$
+    """,
+    "DROP TRIGGER IF EXISTS trg_movimientos_liberar_claves ON movimientos",
+    "CREATE TRIGGER trg_movimientos_liberar_claves AFTER DELETE ON movimientos "
+    "REFERENCING OLD TABLE AS borradas FOR EACH STATEMENT EXECUTE FUNCTION movimientos_liberar_claves()",
+]
+
+
+# Índices obsoletos: previos al multiusuario o sobre columnas de texto ya reemplazadas por ids
+_OBSOLETE_INDEXES = [
+    "idx_movimientos_unique_key",
+    "idx_movimientos_default_unique_key",
+    "idx_movimientos_detalle_norm",
+    "idx_movimientos_fecha",
+    "idx_movimientos_fecha_ts",
+    "idx_movimientos_categoria",
+    "idx_mov_ign_unique_key",
+    "idx_mov_ign_created_at",
+    # categoria TEXT -> categoria_id
+    "idx_movimientos_usuario_categoria",
+    # detalle_norm TEXT -> comercio_id
+    "idx_movimientos_usuario_detalle_norm",
+    # comercios por clave canónica (antes uno por detalle_norm)
+    "idx_comercios_usuario_detalle_norm",
+]
+
+# Índices compuestos que parten por usuario (comunes a ambos motores; la unicidad de
+# movimientos se crea aparte porque depende del particionamiento en Postgres)
+_TENANT_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_movimientos_usuario_comercio_id ON movimientos(usuario, comercio_id)",
+    "CREATE INDEX IF NOT EXISTS idx_movimientos_usuario_fecha ON movimientos(usuario, fecha)",
+    "CREATE INDEX IF NOT EXISTS idx_movimientos_usuario_categoria_id ON movimientos(usuario, categoria_id)",
+    "CREATE INDEX IF NOT EXISTS idx_movimientos_usuario_pendientes ON movimientos(usuario, fecha) WHERE pendiente",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_mov_ign_usuario_unique_key ON movimientos_ignorados(usuario, unique_key)",
+    "CREATE INDEX IF NOT EXISTS idx_mov_ign_usuario_created_at ON movimientos_ignorados(usuario, created_at)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_mov_borrados_usuario_unique_key ON movimientos_borrados(usuario, unique_key)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_categorias_usuario_nombre ON categorias(usuario, nombre)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_categoria_map_usuario_detalle_norm ON categoria_map(usuario, detalle_norm)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_comercios_usuario_clave ON comercios(usuario, clave)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_comercio_categoria_stats_usuario_comercio "
+    "ON comercio_categoria_stats(usuario, comercio_id, categoria_id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_clasificador_conteos_usuario_categoria_feature "
+    "ON clasificador_conteos(usuario, categoria_id, feature)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_reembolsos_usuario_gasto_uk ON reembolsos(usuario, gasto_uk)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_reembolsos_usuario_abono_uk ON reembolsos(usuario, abono_uk)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_versiones_usuario_clave ON versiones(usuario, clave)",
+]
+
+# Tablas que referencian categorias(id) y que antes guardaban el nombre en texto
+_CATEGORIA_ID_TABLES = ["movimientos", "categoria_map"]
+
+# Claves foráneas (tabla, columna, tabla referenciada); al borrar el referenciado queda NULL
+_FOREIGN_KEYS = [
+    ("movimientos", "categoria_id", "categorias"),
+    ("categoria_map", "categoria_id", "categorias"),
+    ("movimientos", "comercio_id", "comercios"),
+]
+
+
+# Esquema SQLite ({tabla} permite recrear la tabla al migrar a multiusuario)
+_SQLITE_TABLES = [
+    ("movimientos", """
+        CREATE TABLE IF NOT EXISTS {tabla} (
+            id INTEGER,
+            fecha TEXT,
+            detalle TEXT,
+            monto REAL,
+            es_gasto INTEGER,
+            es_transferencia_o_abono INTEGER,
+            es_compartido_posible INTEGER,
+            fraccion_mia_sugerida REAL,
+            monto_mio_estimado REAL,
+            categoria_sugerida TEXT,
+            detalle_norm TEXT,
+            comercio_id INTEGER REFERENCES comercios(id) ON DELETE SET NULL,
+            -- nuevos campos para flujo actual
+            monto_real REAL,
+            categoria_id INTEGER REFERENCES categorias(id) ON DELETE SET NULL,
+            nota_usuario TEXT,
+            unique_key TEXT,
+            -- sugerencia persistida (categoria_sugerida + fuente, confianza y alternativas en JSON)
+            sugerencia_fuente TEXT,
+            sugerencia_confianza REAL,
+            sugerencia_alternativas TEXT,
+            -- cola de pendientes (mantenida por triggers)
+            pendiente INTEGER NOT NULL DEFAULT 0,
+            -- transferencia entre cuentas propias (account_aliases de config.json)
+            es_entre_cuentas INTEGER,
+            -- abono por signo (monto positivo en el CSV de origen); solo estos se emparejan como reembolso
+            es_abono INTEGER,
+            usuario TEXT NOT NULL DEFAULT 'default'
+        );
+    """),
+    ("movimientos_ignorados", """
+        CREATE TABLE IF NOT EXISTS {tabla} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            unique_key TEXT,
+            fecha TEXT,
+            detalle TEXT,
+            detalle_norm TEXT,
+            monto REAL,
+            monto_real REAL,
+            categoria TEXT,
+            payload TEXT,
+            created_at TEXT DEFAULT (DATETIME('now')),
+            veces INTEGER DEFAULT 1,
+            last_seen_at TEXT,
+            usuario TEXT NOT NULL DEFAULT 'default'
+        );
+    """),
+    ("movimientos_ignorados_archivo", """
+        CREATE TABLE IF NOT EXISTS {tabla} (
+            id INTEGER,
+            unique_key TEXT,
+            fecha TEXT,
+            detalle TEXT,
+            detalle_norm TEXT,
+            monto REAL,
+            monto_real REAL,
+            categoria TEXT,
+            payload TEXT,
+            created_at TEXT,
+            veces INTEGER,
+            last_seen_at TEXT,
+            archived_at TEXT DEFAULT (DATETIME('now')),
+            usuario TEXT NOT NULL DEFAULT 'default'
+        );
+    """),
+    # Tombstones (borrados por el usuario): conjunto compacto consultado en cada carga
+    ("movimientos_borrados", """
+        CREATE TABLE IF NOT EXISTS {tabla} (
+            unique_key TEXT NOT NULL,
+            deleted_at TEXT DEFAULT (DATETIME('now')),
+            usuario TEXT NOT NULL DEFAULT 'default'
+        );
+    """),
+    ("categorias", """
+        CREATE TABLE IF NOT EXISTS {tabla} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT,
+            usuario TEXT NOT NULL DEFAULT 'default'
+        );
+    """),
+    ("categoria_map", """
+        CREATE TABLE IF NOT EXISTS {tabla} (
+            detalle_norm TEXT,
+            categoria_id INTEGER REFERENCES categorias(id) ON DELETE SET NULL,
+            usuario TEXT NOT NULL DEFAULT 'default'
+        );
+    """),
+    # Dimensión de comercios: una fila por clave canónica del usuario (detalle_norm = primera variante vista)
+    ("comercios", """
+        CREATE TABLE IF NOT EXISTS {tabla} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            detalle_norm TEXT NOT NULL,
+            clave TEXT,
+            canonical_name TEXT,
+            usuario TEXT NOT NULL DEFAULT 'default'
+        );
+    """),
+    # Movimientos por (comercio, categoría), mantenido por los escritores: categoría dominante por búsqueda puntual
+    ("comercio_categoria_stats", """
+        CREATE TABLE IF NOT EXISTS {tabla} (
+            comercio_id INTEGER NOT NULL,
+            categoria_id INTEGER NOT NULL,
+            n INTEGER NOT NULL DEFAULT 0,
+            usuario TEXT NOT NULL DEFAULT 'default'
+        );
+    """),
+    # Conteos del clasificador de texto (classifier.py): n-gramas por categoría; feature -1 = documentos
+    ("clasificador_conteos", """
+        CREATE TABLE IF NOT EXISTS {tabla} (
+            categoria_id INTEGER NOT NULL,
+            feature INTEGER NOT NULL,
+            n REAL NOT NULL DEFAULT 0,
+            usuario TEXT NOT NULL DEFAULT 'default'
+        );
+    """),
+    # Reembolsos: gasto emparejado uno a uno con el abono que lo compensa; diff = |gasto| - |abono|
+    ("reembolsos", """
+        CREATE TABLE IF NOT EXISTS {tabla} (
+            gasto_uk TEXT NOT NULL,
+            abono_uk TEXT NOT NULL,
+            diff REAL,
+            usuario TEXT NOT NULL DEFAULT 'default'
+        );
+    """),
+    # Contadores por usuario que comparten todos los procesos (ver _bump_version)
+    ("versiones", """
+        CREATE TABLE IF NOT EXISTS {tabla} (
+            clave TEXT NOT NULL,
+            valor INTEGER NOT NULL DEFAULT 0,
+            usuario TEXT NOT NULL DEFAULT 'default'
+        );
+    """),
+]
+
 
 def _pg_url() -> Optional[str]:
     url = os.environ.get("DATABASE_URL", "").strip()
@@ -30,18 +346,124 @@ def _is_pg_enabled() -> bool:
     return _pg_url() is not None and create_engine is not None
 
 
-def get_conn(db_path: str = DB_PATH_DEFAULT):
+# --- Multiusuario ---
+# Cada fila pertenece a un usuario (tenant). La conexión lleva el usuario activo y
+# todas las consultas de este módulo filtran por él.
+USUARIO_DEFAULT = "default"
+
+# Tablas con columna usuario
+_TENANT_TABLES = [
+    "movimientos",
+    "movimientos_ignorados",
+    "movimientos_ignorados_archivo",
+    "movimientos_borrados",
+    "categorias",
+    "categoria_map",
+    "comercios",
+    "comercio_categoria_stats",
+    "clasificador_conteos",
+    "reembolsos",
+    "versiones",
+]
+
+
+class _SQLiteConn(sqlite3.Connection):
+    """Conexión SQLite que recuerda el usuario al que pertenece."""
+    usuario: str = USUARIO_DEFAULT
+
+
+def _usuario_env() -> str:
+    return os.environ.get("APP_USUARIO", "").strip() or USUARIO_DEFAULT
+
+
+def get_usuario(conn) -> str:
+    if isinstance(conn, dict):
+        return conn.get("usuario") or USUARIO_DEFAULT
+    return getattr(conn, "usuario", None) or USUARIO_DEFAULT
+
+
+# Un engine (y su pool) por URL, compartido por todos los usuarios del proceso
+_ENGINES_LOCK = threading.Lock()
+_ENGINES: Dict[str, Any] = {}
+
+
+def _get_engine(url: str):
+    with _ENGINES_LOCK:
+        engine = _ENGINES.get(url)
+        if engine is None:
+            engine = create_engine(url, pool_pre_ping=True)
+            _ENGINES[url] = engine
+        return engine
+
+
+def get_conn(db_path: str = DB_PATH_DEFAULT, usuario: Optional[str] = None):
+    """
+    Conexión para `usuario` (por defecto env APP_USUARIO o "default"). En Postgres
+    las conexiones de distintos usuarios reutilizan el mismo pool.
+    """
+    usuario = (usuario or "").strip() or _usuario_env()
     url = _pg_url()
     if url and create_engine is not None:
-        engine = create_engine(url, pool_pre_ping=True)
-        return {"engine": engine, "pg": True}
+        return {"engine": _get_engine(url), "pg": True, "usuario": usuario}
     # Fallback: SQLite local
-    os.makedirs(os.path.dirname(db_path), exist_ok=True)
-    conn = sqlite3.connect(db_path, check_same_thread=False)
+    if os.path.dirname(db_path):  # ":memory:" o un archivo en el directorio actual
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path, check_same_thread=False, factory=_SQLiteConn)
+    conn.usuario = usuario
     conn.execute("PRAGMA journal_mode=WAL;")
     return conn
 
 
+# --- Ejecución por lotes ---
+# Postgres: INSERT multi-fila con psycopg2.extras.execute_values y listas como arreglo (= ANY(:keys)).
+# SQLite: executemany y listas IN en bloques bajo el límite de variables por sentencia.
+_SQLITE_MAX_VARS = 900
+_PG_PAGE_SIZE = 1000
+
+
+def _chunks(seq: List[Any], size: int):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def sqlite_in_chunks(keys: List[Any], reserved: int = 0):
+    """Bloques de keys con sus placeholders "?, ?, ..." (reserved = otras variables de la sentencia)."""
+    for chunk in _chunks(list(keys), _SQLITE_MAX_VARS - reserved):
+        yield ",".join(["?"] * len(chunk)), chunk
+
+
+def _insert_rows(cx, table: str, cols: List[str], rows: List[tuple], on_conflict: str = "") -> int:
+    """
+    INSERT de muchas filas en una sola pasada. `cx` es una conexión sqlite3 o una conexión
+    SQLAlchemy abierta (se ejecuta dentro de su transacción). Devuelve las filas afectadas.
+    """
+    if not rows:
+        return 0
+    col_list = ", ".join(cols)
+    if isinstance(cx, sqlite3.Connection):
+        cur = cx.executemany(
+            f"INSERT INTO {table} ({col_list}) VALUES ({', '.join(['?'] * len(cols))}) {on_conflict}", rows
+        )
+        return int(cur.rowcount or 0)
+    if cx.dialect.driver == "psycopg2":
+        from psycopg2.extras import execute_values
+        total = 0
+        cur = cx.connection.cursor()
+        try:
+            for chunk in _chunks(rows, _PG_PAGE_SIZE):
+                execute_values(cur, f"INSERT INTO {table} ({col_list}) VALUES %s {on_conflict}", chunk, page_size=len(chunk))
+                total += max(cur.rowcount, 0)
+        finally:
+            cur.close()
+        return total
+    # Otros drivers: executemany de SQLAlchemy (insertmanyvalues)
+    res = cx.execute(
+        text(f"INSERT INTO {table} ({col_list}) VALUES ({', '.join(f':{c}' for c in cols)}) {on_conflict}"),
+        [dict(zip(cols, r)) for r in rows],
+    )
+    return int(res.rowcount or 0)
+
+
 def init_db(conn) -> None:
     # Postgres path
     if isinstance(conn, dict) and conn.get("pg") and text is not None:
@@ -61,33 +483,70 @@ def init_db(conn) -> None:
                     monto_mio_estimado DOUBLE PRECISION,
                     categoria_sugerida TEXT,
                     detalle_norm TEXT,
+                    comercio_id INTEGER,
                     monto_real DOUBLE PRECISION,
-                    categoria TEXT,
+                    categoria_id INTEGER,
                     nota_usuario TEXT,
-                    unique_key TEXT UNIQUE
+                    unique_key TEXT,
+                    sugerencia_fuente TEXT,
+                    sugerencia_confianza DOUBLE PRECISION,
+                    sugerencia_alternativas TEXT,
+                    pendiente BOOLEAN NOT NULL DEFAULT FALSE,
+                    es_entre_cuentas BOOLEAN,
+                    es_abono BOOLEAN,
+                    usuario TEXT NOT NULL DEFAULT 'default'
                 );
                 """
             ))
-            # Ensure unique index on unique_key for movimientos
-            e.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS idx_movimientos_unique_key ON movimientos(unique_key);"))
-            # Índices de rendimiento
-            e.execute(text("CREATE INDEX IF NOT EXISTS idx_movimientos_detalle_norm ON movimientos(detalle_norm);"))
-            e.execute(text("CREATE INDEX IF NOT EXISTS idx_movimientos_fecha ON movimientos(DATE(fecha));"))
-            e.execute(text("CREATE INDEX IF NOT EXISTS idx_movimientos_categoria ON movimientos(categoria);"))
             # tablas auxiliares
-            e.execute(text("CREATE TABLE IF NOT EXISTS categorias (nombre TEXT UNIQUE);"))
-            e.execute(text("CREATE TABLE IF NOT EXISTS categoria_map (detalle_norm TEXT PRIMARY KEY, categoria TEXT);"))
+            e.execute(text("CREATE TABLE IF NOT EXISTS categorias (id SERIAL PRIMARY KEY, nombre TEXT, usuario TEXT NOT NULL DEFAULT 'default');"))
+            e.execute(text(
+                "CREATE TABLE IF NOT EXISTS categoria_map "
+                "(detalle_norm TEXT, categoria_id INTEGER, usuario TEXT NOT NULL DEFAULT 'default');"
+            ))
+            e.execute(text(
+                "CREATE TABLE IF NOT EXISTS comercios "
+                "(id SERIAL PRIMARY KEY, detalle_norm TEXT NOT NULL, clave TEXT, canonical_name TEXT, "
+                "usuario TEXT NOT NULL DEFAULT 'default');"
+            ))
+            sin_stats = e.execute(text("SELECT to_regclass('comercio_categoria_stats')")).scalar() is None
+            e.execute(text(
+                "CREATE TABLE IF NOT EXISTS comercio_categoria_stats "
+                "(comercio_id INTEGER NOT NULL, categoria_id INTEGER NOT NULL, n INTEGER NOT NULL DEFAULT 0, "
+                "usuario TEXT NOT NULL DEFAULT 'default');"
+            ))
+            e.execute(text(
+                "CREATE TABLE IF NOT EXISTS clasificador_conteos "
+                "(categoria_id INTEGER NOT NULL, feature BIGINT NOT NULL, n DOUBLE PRECISION NOT NULL DEFAULT 0, "
+                "usuario TEXT NOT NULL DEFAULT 'default');"
+            ))
+            sin_reembolsos = e.execute(text("SELECT to_regclass('reembolsos')")).scalar() is None
+            e.execute(text(
+                "CREATE TABLE IF NOT EXISTS reembolsos "
+                "(gasto_uk TEXT NOT NULL, abono_uk TEXT NOT NULL, diff DOUBLE PRECISION, usuario TEXT NOT NULL DEFAULT 'default');"
+            ))
+            e.execute(text(
+                "CREATE TABLE IF NOT EXISTS versiones "
+                "(clave TEXT NOT NULL, valor BIGINT NOT NULL DEFAULT 0, usuario TEXT NOT NULL DEFAULT 'default');"
+            ))
             e.execute(text(
                 """
                 CREATE TABLE IF NOT EXISTS movimientos_ignorados (
                     id SERIAL PRIMARY KEY,
-                    unique_key TEXT UNIQUE,
-                    payload TEXT,
-                    created_at TIMESTAMPTZ DEFAULT NOW()
+                    unique_key TEXT,
+                    fecha TIMESTAMP,
+                    detalle TEXT,
+                    detalle_norm TEXT,
+                    monto DOUBLE PRECISION,
+                    monto_real DOUBLE PRECISION,
+                    categoria TEXT,
+                    payload JSONB,
+                    created_at TIMESTAMPTZ DEFAULT NOW(),
+                    usuario TEXT NOT NULL DEFAULT 'default'
                 );
                 """
             ))
-            # --- Ensure columnas nuevas existen en PG (payload, created_at) ---
+            # --- Ensure columnas nuevas existen en PG (payload, created_at, columnas tipadas) ---
             e.execute(text(
                 """
                 DO $$
@@ -96,7 +555,7 @@ def init_db(conn) -> None:
                         SELECT 1 FROM information_schema.columns
                         WHERE table_name='movimientos_ignorados' AND column_name='payload'
                     ) THEN
-                        ALTER TABLE movimientos_ignorados ADD COLUMN payload TEXT;
+                        ALTER TABLE movimientos_ignorados ADD COLUMN payload JSONB;
                     END IF;
                     IF NOT EXISTS (
                         SELECT 1 FROM information_schema.columns
@@ -104,52 +563,209 @@ def init_db(conn) -> None:
                     ) THEN
                         ALTER TABLE movimientos_ignorados ADD COLUMN created_at TIMESTAMPTZ DEFAULT NOW();
                     END IF;
+                    -- payload TEXT heredado -> JSONB
+                    IF EXISTS (
+                        SELECT 1 FROM information_schema.columns
+                        WHERE table_name='movimientos_ignorados' AND column_name='payload' AND data_type='text'
+                    ) THEN
+                        ALTER TABLE movimientos_ignorados ALTER COLUMN payload TYPE JSONB USING NULLIF(payload, '')::jsonb;
+                    END IF;
+                END
+                $$;
+                """
+            ))
+            for col, typ in _IGNORED_TYPED_COLS_PG:
+                e.execute(text(f"ALTER TABLE movimientos_ignorados ADD COLUMN IF NOT EXISTS {col} {typ}"))
+            # Backfill de columnas tipadas para filas antiguas (solo payload)
+            e.execute(text(
+                """
+                UPDATE movimientos_ignorados SET
+                    fecha = NULLIF(payload->>'fecha', '')::timestamp,
+                    detalle = payload->>'detalle',
+                    detalle_norm = payload->>'detalle_norm',
+                    monto = NULLIF(payload->>'monto', '')::double precision,
+                    monto_real = NULLIF(payload->>'monto_real', '')::double precision,
+                    categoria = payload->>'categoria'
+                WHERE payload IS NOT NULL AND detalle_norm IS NULL AND detalle IS NULL
+                """
+            ))
+            # Contador de re-apariciones para registros de duplicado
+            e.execute(text("ALTER TABLE movimientos_ignorados ADD COLUMN IF NOT EXISTS veces INTEGER DEFAULT 1"))
+            e.execute(text("ALTER TABLE movimientos_ignorados ADD COLUMN IF NOT EXISTS last_seen_at TIMESTAMPTZ DEFAULT NOW()"))
+            e.execute(text(
+                """
+                CREATE TABLE IF NOT EXISTS movimientos_ignorados_archivo (
+                    id INTEGER,
+                    unique_key TEXT,
+                    fecha TIMESTAMP,
+                    detalle TEXT,
+                    detalle_norm TEXT,
+                    monto DOUBLE PRECISION,
+                    monto_real DOUBLE PRECISION,
+                    categoria TEXT,
+                    payload JSONB,
+                    created_at TIMESTAMPTZ,
+                    veces INTEGER,
+                    last_seen_at TIMESTAMPTZ,
+                    archived_at TIMESTAMPTZ DEFAULT NOW(),
+                    usuario TEXT NOT NULL DEFAULT 'default'
+                );
+                """
+            ))
+            # Tombstones (borrados por el usuario): conjunto compacto consultado en cada carga
+            e.execute(text(
+                """
+                CREATE TABLE IF NOT EXISTS movimientos_borrados (
+                    unique_key TEXT NOT NULL,
+                    deleted_at TIMESTAMPTZ DEFAULT NOW(),
+                    usuario TEXT NOT NULL DEFAULT 'default'
+                );
+                """
+            ))
+            # --- Multiusuario: columna usuario en tablas previas y unicidad compuesta (usuario, ...) ---
+            for tabla in _TENANT_TABLES:
+                e.execute(text(f"ALTER TABLE {tabla} ADD COLUMN IF NOT EXISTS usuario TEXT NOT NULL DEFAULT '{USUARIO_DEFAULT}'"))
+            e.execute(text(
+                """
+                DO $$
+                DECLARE r record;
+                BEGIN
+                    FOR r IN
+                        SELECT conrelid::regclass AS tabla, conname FROM pg_constraint
+                        WHERE conname IN ('movimientos_unique_key_key', 'movimientos_ignorados_unique_key_key',
+                                          'movimientos_borrados_pkey', 'categorias_nombre_key', 'categoria_map_pkey')
+                    LOOP
+                        EXECUTE format('ALTER TABLE %s DROP CONSTRAINT %I', r.tabla, r.conname);
+                    END LOOP;
                 END
                 $$;
                 """
             ))
-            # Ensure unique index on unique_key for movimientos_ignorados
-            e.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS idx_mov_ign_unique_key ON movimientos_ignorados(unique_key);"))
+            for idx in _OBSOLETE_INDEXES:
+                e.execute(text(f"DROP INDEX IF EXISTS {idx}"))
+            # --- Categorías por id: categorias.id y categoria_id (en vez del nombre) en movimientos/categoria_map ---
+            e.execute(text(
+                """
+                DO $$
+                BEGIN
+                    IF NOT EXISTS (
+                        SELECT 1 FROM information_schema.columns
+                        WHERE table_name='categorias' AND column_name='id'
+                    ) THEN
+                        ALTER TABLE categorias ADD COLUMN id SERIAL;
+                    END IF;
+                END
+                $$;
+                """
+            ))
+            e.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS idx_categorias_id ON categorias(id)"))
+            for tabla in _CATEGORIA_ID_TABLES:
+                e.execute(text(f"ALTER TABLE {tabla} ADD COLUMN IF NOT EXISTS categoria_id INTEGER"))
+                # Backfill desde el nombre; la columna de texto se conserva como categoria_previa
+                e.execute(text(
+                    f"""
+                    DO $$
+                    BEGIN
+                        IF EXISTS (
+                            SELECT 1 FROM information_schema.columns
+                            WHERE table_name='{tabla}' AND column_name='categoria'
+                        ) THEN
+                            UPDATE {tabla} t SET categoria_id = c.id FROM categorias c
+                            WHERE c.usuario = t.usuario AND c.nombre = t.categoria AND t.categoria_id IS NULL;
+                            ALTER TABLE {tabla} RENAME COLUMN categoria TO categoria_previa;
+                        END IF;
+                    END
+                    $$;
+                    """
+                ))
+            # --- Comercios: movimientos.comercio_id (entero) referencia la dimensión comercios,
+            # una fila por clave canónica (las variantes de un mismo comercio comparten id) ---
+            columnas = lambda tabla: {r[0] for r in e.execute(text(
+                "SELECT column_name FROM information_schema.columns WHERE table_name = :t"
+            ), {"t": tabla}).fetchall()}
+            sin_comercio = "comercio_id" not in columnas("movimientos")
+            sin_pendiente = "pendiente" not in columnas("movimientos")
+            sin_entre_cuentas = "es_entre_cuentas" not in columnas("movimientos")
+            sin_es_abono = "es_abono" not in columnas("movimientos")
+            sin_clave = "clave" not in columnas("comercios")
+            e.execute(text("ALTER TABLE movimientos ADD COLUMN IF NOT EXISTS comercio_id INTEGER"))
+            for col, typ, _ in _SUGERENCIA_COLS:
+                e.execute(text(f"ALTER TABLE movimientos ADD COLUMN IF NOT EXISTS {col} {typ}"))
+            e.execute(text("ALTER TABLE movimientos ADD COLUMN IF NOT EXISTS pendiente BOOLEAN NOT NULL DEFAULT FALSE"))
+            e.execute(text("ALTER TABLE movimientos ADD COLUMN IF NOT EXISTS es_entre_cuentas BOOLEAN"))
+            e.execute(text("ALTER TABLE movimientos ADD COLUMN IF NOT EXISTS es_abono BOOLEAN"))
+            for ddl in _PG_PENDIENTE_TRIGGERS:
+                e.execute(text(ddl))
+            if sin_pendiente:
+                e.execute(text(f"UPDATE movimientos SET pendiente = {_PENDIENTE_EXPR}"))
+            e.execute(text("ALTER TABLE comercios ADD COLUMN IF NOT EXISTS clave TEXT"))
+            e.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS idx_comercios_usuario_clave ON comercios(usuario, clave)"))
+            if sin_clave:
+                _recanonicalize_comercios(e)
+            if sin_comercio:
+                for (usuario,) in e.execute(text("SELECT DISTINCT usuario FROM movimientos")).fetchall():
+                    _asignar_comercios(e, usuario)
+            _pg_ensure_foreign_keys(e)
+            # En la tabla particionada la unicidad debe incluir la clave de partición
+            if _pg_is_partitioned(e):
+                e.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS idx_movimientos_usuario_unique_key ON movimientos(usuario, unique_key, fecha)"))
+                e.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS idx_movimientos_default_usuario_unique_key ON movimientos_default(usuario, unique_key)"))
+                sin_claves = e.execute(text("SELECT to_regclass('movimientos_claves')")).scalar() is None
+                for ddl in _PG_CLAVES_TRIGGERS:
+                    e.execute(text(ddl))
+                if sin_claves:
+                    # Particionada antes de existir movimientos_claves: registrar las claves actuales
+                    e.execute(text(
+                        "INSERT INTO movimientos_claves (usuario, unique_key) SELECT DISTINCT usuario, unique_key "
+                        "FROM movimientos WHERE unique_key IS NOT NULL ON CONFLICT (usuario, unique_key) DO NOTHING"
+                    ))
+            else:
+                e.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS idx_movimientos_usuario_unique_key ON movimientos(usuario, unique_key)"))
+            for ddl in _TENANT_INDEXES:
+                e.execute(text(ddl))
+            if sin_stats:
+                _refresh_comercio_stats(e, None)
+            if sin_es_abono:
+                # Pares calculados cuando el abono se deducía por palabras clave: se descartan
+                e.execute(text("DELETE FROM reembolsos"))
+            for (usuario,) in e.execute(text("SELECT DISTINCT usuario FROM movimientos")).fetchall():
+                if sin_entre_cuentas:
+                    _marcar_entre_cuentas(e, usuario)
+                if sin_reembolsos or sin_es_abono:
+                    _emparejar_reembolsos(e, usuario)
+            # Tombstones heredados (filas sin payload en movimientos_ignorados) -> movimientos_borrados
+            e.execute(text(
+                "INSERT INTO movimientos_borrados (usuario, unique_key) SELECT usuario, unique_key FROM movimientos_ignorados "
+                "WHERE payload IS NULL AND unique_key IS NOT NULL ON CONFLICT (usuario, unique_key) DO NOTHING"
+            ))
+            e.execute(text("DELETE FROM movimientos_ignorados WHERE payload IS NULL"))
         return
 
     # SQLite path
-    conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS movimientos (
-            id INTEGER,
-            fecha TEXT,
-            detalle TEXT,
-            monto REAL,
-            es_gasto INTEGER,
-            es_transferencia_o_abono INTEGER,
-            es_compartido_posible INTEGER,
-            fraccion_mia_sugerida REAL,
-            monto_mio_estimado REAL,
-            categoria_sugerida TEXT,
-            detalle_norm TEXT,
-            -- nuevos campos para flujo actual
-            monto_real REAL,
-            categoria TEXT,
-            nota_usuario TEXT,
-            unique_key TEXT UNIQUE
-        );
-        """
-    )
-    conn.commit()
-    # Ensure unique index on unique_key for movimientos in SQLite
-    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_movimientos_unique_key ON movimientos(unique_key);")
-    conn.commit()
-    # Índices de rendimiento en SQLite
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_movimientos_detalle_norm ON movimientos(detalle_norm);")
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_movimientos_fecha ON movimientos(fecha);")
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_movimientos_categoria ON movimientos(categoria);")
+    # Los triggers de la cola de pendientes se recrean al final (las tablas pueden recrearse antes)
+    for nombre in _SQLITE_PENDIENTE_TRIGGERS:
+        conn.execute(f"DROP TRIGGER IF EXISTS {nombre}")
+    sin_stats = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'comercio_categoria_stats'"
+    ).fetchone() is None
+    sin_reembolsos = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'reembolsos'"
+    ).fetchone() is None
+    for tabla, ddl in _SQLITE_TABLES:
+        conn.execute(ddl.format(tabla=tabla))
     conn.commit()
 
     existing = {r[1] for r in conn.execute("PRAGMA table_info(movimientos)").fetchall()}
+    sin_pendiente = "pendiente" not in existing
+    sin_entre_cuentas = "es_entre_cuentas" not in existing
+    sin_es_abono = "es_abono" not in existing
     for col, ddl in [
         ("monto_real", "ALTER TABLE movimientos ADD COLUMN monto_real REAL"),
-        ("categoria", "ALTER TABLE movimientos ADD COLUMN categoria TEXT"),
         ("nota_usuario", "ALTER TABLE movimientos ADD COLUMN nota_usuario TEXT"),
+        *[(col, f"ALTER TABLE movimientos ADD COLUMN {col} {typ}") for col, _, typ in _SUGERENCIA_COLS],
+        ("pendiente", "ALTER TABLE movimientos ADD COLUMN pendiente INTEGER NOT NULL DEFAULT 0"),
+        ("es_entre_cuentas", "ALTER TABLE movimientos ADD COLUMN es_entre_cuentas INTEGER"),
+        ("es_abono", "ALTER TABLE movimientos ADD COLUMN es_abono INTEGER"),
     ]:
         if col not in existing:
             try:
@@ -158,133 +774,1088 @@ def init_db(conn) -> None:
                 pass
     conn.commit()
 
+    existing_ign = {r[1] for r in conn.execute("PRAGMA table_info(movimientos_ignorados)").fetchall()}
+    for col, typ in _IGNORED_TYPED_COLS_SQLITE:
+        if col not in existing_ign:
+            try:
+                conn.execute(f"ALTER TABLE movimientos_ignorados ADD COLUMN {col} {typ}")
+            except Exception:
+                pass
+    # Backfill de columnas tipadas para filas antiguas (solo payload)
+    try:
+        conn.execute(
+            """
+            UPDATE movimientos_ignorados SET
+                fecha = json_extract(payload, '$.fecha'),
+                detalle = json_extract(payload, '$.detalle'),
+                detalle_norm = json_extract(payload, '$.detalle_norm'),
+                monto = json_extract(payload, '$.monto'),
+                monto_real = json_extract(payload, '$.monto_real'),
+                categoria = json_extract(payload, '$.categoria')
+            WHERE payload IS NOT NULL AND json_valid(payload) AND detalle_norm IS NULL AND detalle IS NULL
+            """
+        )
+    except Exception:
+        pass
+    conn.commit()
+    # Contador de re-apariciones para registros de duplicado (SQLite no admite DEFAULT no constante en ALTER)
+    existing_ign = {r[1] for r in conn.execute("PRAGMA table_info(movimientos_ignorados)").fetchall()}
+    if "veces" not in existing_ign:
+        conn.execute("ALTER TABLE movimientos_ignorados ADD COLUMN veces INTEGER DEFAULT 1")
+    if "last_seen_at" not in existing_ign:
+        conn.execute("ALTER TABLE movimientos_ignorados ADD COLUMN last_seen_at TEXT")
+    conn.commit()
+
+    ddls = dict(_SQLITE_TABLES)
+    # --- Categorías por id (antes del paso multiusuario, que recrea tablas) ---
+    # categorias sin id autoincremental: se recrea
+    cat_cols = {r[1] for r in conn.execute("PRAGMA table_info(categorias)").fetchall()}
+    if "id" not in cat_cols:
+        _sqlite_rebuild(conn, "categorias", ddls["categorias"])
+    for tabla in _CATEGORIA_ID_TABLES:
+        cols = {r[1] for r in conn.execute(f"PRAGMA table_info({tabla})").fetchall()}
+        if "categoria" not in cols:
+            continue
+        if "categoria_id" not in cols:
+            conn.execute(f"ALTER TABLE {tabla} ADD COLUMN categoria_id INTEGER REFERENCES categorias(id) ON DELETE SET NULL")
+        # Backfill desde el nombre; la columna de texto se conserva como categoria_previa
+        owner = "t.usuario" if "usuario" in cols else f"'{USUARIO_DEFAULT}'"
+        conn.execute(
+            f"UPDATE {tabla} AS t SET categoria_id = (SELECT c.id FROM categorias c "
+            f"WHERE c.usuario = {owner} AND c.nombre = t.categoria) WHERE t.categoria_id IS NULL"
+        )
+        conn.execute("DROP INDEX IF EXISTS idx_movimientos_usuario_categoria")
+        conn.execute(f"ALTER TABLE {tabla} RENAME COLUMN categoria TO categoria_previa")
+    conn.commit()
+
+    # Antes del paso multiusuario, que recrea movimientos ya con comercio_id
+    sin_comercio = "comercio_id" not in {r[1] for r in conn.execute("PRAGMA table_info(movimientos)").fetchall()}
+    sin_clave = "clave" not in {r[1] for r in conn.execute("PRAGMA table_info(comercios)").fetchall()}
+
+    # --- Multiusuario: tablas previas sin columna usuario ---
+    # Las restricciones UNIQUE/PRIMARY KEY de SQLite no se pueden alterar: se recrea la tabla
+    for tabla, ddl in _SQLITE_TABLES:
+        cols = {r[1] for r in conn.execute(f"PRAGMA table_info({tabla})").fetchall()}
+        if cols and "usuario" not in cols:
+            _sqlite_rebuild(conn, tabla, ddl)
+
+    # --- Comercios: una fila por clave canónica; backfill de movimientos.comercio_id ---
+    for idx in _OBSOLETE_INDEXES:
+        conn.execute(f"DROP INDEX IF EXISTS {idx}")
+    if "comercio_id" not in {r[1] for r in conn.execute("PRAGMA table_info(movimientos)").fetchall()}:
+        conn.execute("ALTER TABLE movimientos ADD COLUMN comercio_id INTEGER REFERENCES comercios(id) ON DELETE SET NULL")
+    if sin_clave:
+        conn.execute("ALTER TABLE comercios ADD COLUMN clave TEXT")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_comercios_usuario_clave ON comercios(usuario, clave)")
+    if sin_clave:
+        _recanonicalize_comercios(conn)
+    if sin_comercio:
+        for (usuario,) in conn.execute("SELECT DISTINCT usuario FROM movimientos").fetchall():
+            _asignar_comercios(conn, usuario)
+    conn.commit()
+
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_movimientos_usuario_unique_key ON movimientos(usuario, unique_key)")
+    for ddl in _TENANT_INDEXES:
+        conn.execute(ddl)
+    if sin_stats:
+        _refresh_comercio_stats(conn, None)
+    for ddl in _SQLITE_PENDIENTE_TRIGGERS.values():
+        conn.execute(ddl)
+    if sin_pendiente:
+        conn.execute(f"UPDATE movimientos SET pendiente = {_PENDIENTE_EXPR}")
+    if sin_es_abono:
+        # Pares calculados cuando el abono se deducía por palabras clave: se descartan
+        conn.execute("DELETE FROM reembolsos")
+    for (usuario,) in conn.execute("SELECT DISTINCT usuario FROM movimientos").fetchall():
+        if sin_entre_cuentas:
+            _marcar_entre_cuentas(conn, usuario)
+        if sin_reembolsos or sin_es_abono:
+            _emparejar_reembolsos(conn, usuario)
+    conn.commit()
+
+    # Tombstones heredados (filas sin payload en movimientos_ignorados) -> movimientos_borrados
     conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS movimientos_ignorados (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            unique_key TEXT UNIQUE,
-            payload TEXT,
-            created_at TEXT DEFAULT (DATETIME('now'))
-        );
-        """
+        "INSERT OR IGNORE INTO movimientos_borrados (usuario, unique_key) "
+        "SELECT usuario, unique_key FROM movimientos_ignorados WHERE payload IS NULL AND unique_key IS NOT NULL"
     )
+    conn.execute("DELETE FROM movimientos_ignorados WHERE payload IS NULL")
     conn.commit()
-    # Ensure unique index on unique_key for movimientos_ignorados in SQLite
-    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_mov_ign_unique_key ON movimientos_ignorados(unique_key);")
+
+
+def _sqlite_rebuild(conn, tabla: str, ddl: str) -> None:
+    """
+    Recrea `tabla` con el esquema actual copiando sus filas (columnas nuevas con su valor
+    por defecto). Las columnas que el esquema ya no define se conservan al final.
+    """
+    info = conn.execute(f"PRAGMA table_info({tabla})").fetchall()
+    cols = [r[1] for r in info]
+    previa = f"{tabla}_previa"
     conn.commit()
+    conn.execute("BEGIN")
+    try:
+        conn.execute(f"ALTER TABLE {tabla} RENAME TO {previa}")
+        conn.execute(ddl.format(tabla=tabla))
+        nuevas = {r[1] for r in conn.execute(f"PRAGMA table_info({tabla})").fetchall()}
+        for r in info:
+            if r[1] not in nuevas:
+                conn.execute(f"ALTER TABLE {tabla} ADD COLUMN {r[1]} {r[2]}")
+        comunes = ", ".join(cols)
+        conn.execute(f"INSERT INTO {tabla} ({comunes}) SELECT {comunes} FROM {previa}")
+        conn.execute(f"DROP TABLE {previa}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+# --- Caché en memoria de metadatos (categorias + categoria_map) ---
+# Cada escritor incrementa la versión "meta" del usuario en la base (tabla versiones); las
+# lecturas la consultan y recargan solo si cambió, así también ven lo escrito por otro proceso.
+# La caché es por proceso y por usuario: la clave combina base y usuario.
+_META_LOCK = threading.Lock()
+_META_CACHE: Dict[str, Dict[str, Any]] = {}
+
+
+def _meta_key(conn) -> str:
+    if isinstance(conn, dict) and conn.get("pg"):
+        return f"{conn['engine'].url}#{get_usuario(conn)}"
+    try:
+        row = conn.execute("PRAGMA database_list").fetchone()
+        # Bases en memoria (sin archivo): cada conexión es una base distinta
+        return f"sqlite:{row[2] or id(conn)}#{get_usuario(conn)}"
+    except Exception:
+        return f"sqlite:{id(conn)}#{get_usuario(conn)}"
+
+
+def _bump_meta_version(conn) -> None:
+    _bump_version(conn, "meta")
+
+
+def get_meta_version(conn) -> int:
+    return _leer_versiones(conn, ["meta"])[0]
+
+
+# --- Versiones persistidas (tabla versiones) ---
+# "meta" (categorías/mapa) y "stats" (movimientos/estadísticas) las incrementa cada escritor;
+# "sugerencias_meta" y "sugerencias_stats" son las que tenían cuando se guardaron las sugerencias.
+# Al vivir en la base, otro proceso (o un reinicio) ve los mismos valores.
+_SQL_BUMP_VERSION = (
+    "INSERT INTO versiones (usuario, clave, valor) VALUES (:u, :clave, 1) "
+    "ON CONFLICT (usuario, clave) DO UPDATE SET valor = versiones.valor + 1"
+)
+
+
+def _bump_version(conn, clave: str) -> None:
+    params = {"u": get_usuario(conn), "clave": clave}
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        with conn["engine"].begin() as e:
+            e.execute(text(_SQL_BUMP_VERSION), params)
+        return
+    with conn:
+        conn.execute(_SQL_BUMP_VERSION, params)
+
+
+def _versiones(cx, usuario: str, claves: List[str]) -> Tuple[int, ...]:
+    """Valores de las claves dadas (0 si no existen). `cx` como en _insert_rows."""
+    if isinstance(cx, sqlite3.Connection):
+        placeholders = ",".join(["?"] * len(claves))
+        found = dict(cx.execute(
+            f"SELECT clave, valor FROM versiones WHERE usuario = ? AND clave IN ({placeholders})", [usuario, *claves]
+        ).fetchall())
+    else:
+        found = dict(cx.execute(
+            text("SELECT clave, valor FROM versiones WHERE usuario = :u AND clave = ANY(:claves)"),
+            {"u": usuario, "claves": list(claves)},
+        ).fetchall())
+    return tuple(int(found.get(c, 0)) for c in claves)
+
+
+def _leer_versiones(conn, claves: List[str]) -> Tuple[int, ...]:
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        with conn["engine"].connect() as e:
+            return _versiones(e, get_usuario(conn), claves)
+    return _versiones(conn, get_usuario(conn), claves)
+
+
+def _bump_stats_version(conn) -> None:
+    _bump_version(conn, "stats")
+
+
+def get_suggestion_version(conn) -> Tuple[int, int]:
+    """(versión de categorías/mapa, versión de movimientos/estadísticas), leídas de la base."""
+    return _leer_versiones(conn, ["meta", "stats"])
+
+
+def get_saved_suggestion_version(conn) -> Tuple[int, int]:
+    """get_suggestion_version con la que se guardaron por última vez las sugerencias (save_suggestions)."""
+    return _leer_versiones(conn, ["sugerencias_meta", "sugerencias_stats"])
+
+
+def cache_key(conn) -> str:
+    """Identifica base y usuario de la conexión (clave para cachés por conexión)."""
+    return _meta_key(conn)
+
+
+def _load_meta(conn) -> Dict[str, Any]:
+    key = _meta_key(conn)
+    version = get_meta_version(conn)
+    with _META_LOCK:
+        cached = _META_CACHE.get(key)
+        if cached is not None and cached["version"] == version:
+            return cached
+        u = get_usuario(conn)
+        q_cats = "SELECT id, nombre FROM categorias WHERE usuario = {u} ORDER BY nombre"
+        q_map = (
+            "SELECT m.detalle_norm, c.nombre FROM categoria_map m "
+            "JOIN categorias c ON c.id = m.categoria_id WHERE m.usuario = {u}"
+        )
+        if isinstance(conn, dict) and conn.get("pg") and text is not None:
+            engine = conn["engine"]
+            with engine.connect() as e:
+                cat_rows = e.execute(text(q_cats.format(u=":u")), {"u": u}).fetchall()
+                map_rows = e.execute(text(q_map.format(u=":u")), {"u": u}).fetchall()
+        else:
+            cat_rows = conn.execute(q_cats.format(u="?"), (u,)).fetchall()
+            map_rows = conn.execute(q_map.format(u="?"), (u,)).fetchall()
+        cats = [r[1] for r in cat_rows]
+        ids = {r[1]: int(r[0]) for r in cat_rows}
+        # Mapa hash por detalle_norm normalizado; se ignoran reglas vacías
+        cmap: Dict[str, str] = {}
+        for dn, cat in map_rows:
+            if cat is None or str(cat).strip() == "":
+                continue
+            cmap[_normalize_text_basic(dn)] = cat
+        # Respaldo por clave canónica de comercio: para variantes del descriptor sin regla exacta
+        # (si las reglas de una clave difieren, gana la categoría más repetida)
+        cmap_clave: Dict[str, str] = {}
+        if cmap:
+            reglas = pd.DataFrame({"clave": canonicalize_merchants(pd.Series(list(cmap), dtype=object)), "cat": list(cmap.values())})
+            conteo = reglas.groupby(["clave", "cat"]).size().reset_index(name="n").sort_values("n", ascending=False, kind="stable")
+            cmap_clave = dict(conteo.drop_duplicates("clave")[["clave", "cat"]].itertuples(index=False, name=None))
+        entry = {"version": version, "categories": cats, "ids": ids, "map": cmap, "map_clave": cmap_clave}
+        _META_CACHE[key] = entry
+        return entry
+
+
+def get_categories(conn) -> List[str]:
+    return list(_load_meta(conn)["categories"])
+
+
+def get_categoria_ids(conn) -> Dict[str, int]:
+    """Nombre de categoría -> categorias.id del usuario, servido desde la caché."""
+    return dict(_load_meta(conn)["ids"])
+
+
+def get_categoria_map(conn) -> Dict[str, str]:
+    """Mapa aprendido detalle_norm (normalizado) -> categoria, servido desde la caché."""
+    return dict(_load_meta(conn)["map"])
+
+
+def lookup_categoria_map(conn, detalle_norms) -> Dict[str, str]:
+    """Resuelve en memoria las reglas exactas de categoria_map para los detalle_norm dados (clave original -> categoria)."""
+    cmap = _load_meta(conn)["map"]
+    found: Dict[str, str] = {}
+    for dn in detalle_norms:
+        cat = cmap.get(_normalize_text_basic(dn))
+        if cat is not None:
+            found[dn] = cat
+    return found
+
+
+def lookup_comercio_map(conn, detalle_norms) -> Dict[str, str]:
+    """
+    Respaldo de lookup_categoria_map por clave canónica de comercio: para los detalle_norm sin
+    regla exacta, la categoría de las reglas de variantes del mismo comercio. Es una conjetura
+    (la canonicalización puede unir comercios distintos): solo alimenta sugerencias, nunca se
+    aplica sola al ingerir.
+    """
+    meta = _load_meta(conn)
+    cmap, cmap_clave = meta["map"], meta["map_clave"]
+    sin_regla = [dn for dn in detalle_norms if _normalize_text_basic(dn) not in cmap]
+    if not sin_regla or not cmap_clave:
+        return {}
+    claves = canonicalize_merchants(pd.Series(sin_regla, dtype=object))
+    return {dn: cmap_clave[k] for dn, k in zip(sin_regla, claves) if k in cmap_clave}
+
+
+def lookup_merchant_rules(conn, detalle_norms) -> Dict[str, str]:
+    """
+    Categoría de la primera regla por subcadena de merchant_map.json contenida en cada
+    detalle_norm (autómata compilado, en caché por mtime), solo hacia categorías que el usuario
+    tiene. Alimenta la sugerencia "Regla de comercio"; no se aplica sola al ingerir.
+    """
+    reglas = merchant_rules(_MERCHANT_MAP_PATH, _normalize_text_basic)
+    dns = list(detalle_norms)
+    if not dns or not len(reglas):
+        return {}
+    ids = _load_meta(conn)["ids"]
+    por_regla = reglas.categorize(pd.Series(dns, dtype=object).map(_normalize_text_basic))
+    return {dn: cat for dn, cat in zip(dns, por_regla) if cat is not None and cat in ids}
+
+
+def replace_categories(conn, cats: List[str]) -> None:
+    # Reemplaza la lista conservando los ids de las categorías que siguen en ella;
+    # las filas de una categoría eliminada quedan sin categoría (categoria_id NULL).
+    cats = [c.strip() for c in cats if c and isinstance(c, str)]
+    u = get_usuario(conn)
+    actuales = _load_meta(conn)["ids"]
+    quitar = sorted(set(actuales) - set(cats))
+    nuevas = [(u, c) for c in dict.fromkeys(cats) if c not in actuales]
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        engine = conn["engine"]
+        with engine.begin() as e:
+            if quitar:
+                afectados = _comercio_ids_con_categorias(e, u, [actuales[c] for c in quitar])
+                e.execute(text("DELETE FROM categorias WHERE usuario = :u AND nombre = ANY(:quitar)"), {"u": u, "quitar": quitar})
+                _refresh_comercio_stats(e, u, afectados)
+            _insert_rows(e, "categorias", ["usuario", "nombre"], nuevas, "ON CONFLICT DO NOTHING")
+        _bump_meta_version(conn)
+        return
+    with conn:
+        afectados = _comercio_ids_con_categorias(conn, u, [actuales[c] for c in quitar])
+        for placeholders, chunk in sqlite_in_chunks(quitar, reserved=1):
+            ids = [r[0] for r in conn.execute(
+                f"SELECT id FROM categorias WHERE usuario = ? AND nombre IN ({placeholders})", [u, *chunk]
+            ).fetchall()]
+            _sqlite_clear_categoria_ids(conn, ids)
+            conn.execute(f"DELETE FROM categorias WHERE usuario = ? AND nombre IN ({placeholders})", [u, *chunk])
+        _refresh_comercio_stats(conn, u, afectados)
+        _insert_rows(conn, "categorias", ["usuario", "nombre"], nuevas, "ON CONFLICT DO NOTHING")
+    _bump_meta_version(conn)
+
+
+def _sqlite_clear_categoria_ids(conn, ids: List[int]) -> None:
+    """ON DELETE SET NULL explícito (SQLite no aplica claves foráneas salvo PRAGMA foreign_keys)."""
+    u = get_usuario(conn)
+    for tabla in _CATEGORIA_ID_TABLES:
+        for placeholders, chunk in sqlite_in_chunks(ids, reserved=1):
+            conn.execute(f"UPDATE {tabla} SET categoria_id = NULL WHERE usuario = ? AND categoria_id IN ({placeholders})", [u, *chunk])
+
+
+def update_categoria_map_from_df(conn, df: pd.DataFrame) -> int:
+    if df is None or df.empty:
+        return 0
+    sub = df[["detalle_norm", "categoria"]].dropna()
+    if sub.empty:
+        return 0
+    sub = sub[(sub["categoria"].notna()) & (sub["categoria"].str.strip() != "")]
+    if sub.empty:
+        return 0
+    rows_df = sub.drop_duplicates("detalle_norm").assign(usuario=get_usuario(conn))
+    # Nombre -> id; reglas hacia categorías que no existen se descartan
+    rows_df["categoria_id"] = rows_df["categoria"].map(_load_meta(conn)["ids"])
+    rows_df = rows_df[rows_df["categoria_id"].notna()]
+    if rows_df.empty:
+        return 0
+    rows_df["categoria_id"] = rows_df["categoria_id"].astype(int)
+    cols = ["usuario", "detalle_norm", "categoria_id"]
+    rows = [(u, dn, int(cid)) for u, dn, cid in rows_df[cols].itertuples(index=False, name=None)]
+    upsert = "ON CONFLICT(usuario, detalle_norm) DO UPDATE SET categoria_id=excluded.categoria_id"
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        engine = conn["engine"]
+        with engine.begin() as e:
+            n = _insert_rows(e, "categoria_map", cols, rows, upsert)
+        _bump_meta_version(conn)
+        return n
+    with conn:
+        n = _insert_rows(conn, "categoria_map", cols, rows, upsert)
+    _bump_meta_version(conn)
+    return n
+
+
+def map_categories_for_df(conn, df: pd.DataFrame) -> pd.DataFrame:
+    if df is None or df.empty:
+        return df
+    df = df.copy()
+    if "detalle_norm" not in df.columns:
+        df["detalle_norm"] = df.get("detalle", "")
+    # Normalizar a formato BD (lowercase) para que el merge con categoria_map funcione
+    df["detalle_norm"] = df["detalle_norm"].astype(str).map(_normalize_text_basic)
+    cmap = _load_meta(conn)["map"]
+    if not cmap:
+        return df
+    # Sondeo hash en memoria (sin leer categoria_map desde la base). Los respaldos por clave
+    # canónica (lookup_comercio_map) y por subcadena (lookup_merchant_rules) no se aplican aquí:
+    # son conjeturas y llegan como sugerencias
+    mapped = df["detalle_norm"].map(cmap).astype(object)
+    # Solo se usa la regla cuando la fila no trae categoría propia
+    if "categoria" in df.columns:
+        left_cat = df["categoria"]
+        mask_empty = left_cat.isna() | (left_cat.astype(str).str.strip().isin(["", "nan", "None"]))
+        df["categoria"] = np.where(mask_empty, mapped, left_cat)
+    else:
+        df["categoria"] = mapped
+    # Filas sin match: rellenar con "Sin categoría"
+    df["categoria"] = df["categoria"].fillna("Sin categoría")
+    df["categoria"] = df["categoria"].replace("", "Sin categoría")
+    return df
+
+
+def rename_category(conn, old_name: str, new_name: str) -> None:
+    if not old_name or not new_name or old_name == new_name:
+        return
+    if old_name == "Sin categoría":
+        return  # no renombrar base
+    
+    ids = _load_meta(conn)["ids"]
+    old_id, new_id = ids.get(old_name), ids.get(new_name)
+    u = get_usuario(conn)
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        engine = conn["engine"]
+        params = {"new": new_name, "old": old_name, "u": u, "old_id": old_id, "new_id": new_id}
+        with engine.begin() as e:
+            if old_id is None:
+                e.execute(text("INSERT INTO categorias(usuario, nombre) VALUES (:u, :new) ON CONFLICT DO NOTHING"), params)
+            elif new_id is None:
+                # Renombrar = actualizar una sola fila; movimientos y reglas apuntan al id
+                e.execute(text("UPDATE categorias SET nombre=:new WHERE id=:old_id"), params)
+            else:
+                # El nombre nuevo ya existe: fusionar en la categoría existente
+                afectados = _comercio_ids_con_categorias(e, u, [old_id])
+                for tabla in _CATEGORIA_ID_TABLES:
+                    e.execute(text(f"UPDATE {tabla} SET categoria_id=:new_id WHERE usuario=:u AND categoria_id=:old_id"), params)
+                e.execute(text("DELETE FROM categorias WHERE id=:old_id"), params)
+                _refresh_comercio_stats(e, u, afectados)
+        _bump_meta_version(conn)
+        return
+
+    with conn:
+        if old_id is None:
+            conn.execute("INSERT OR IGNORE INTO categorias(usuario, nombre) VALUES (?, ?)", (u, new_name))
+        elif new_id is None:
+            conn.execute("UPDATE categorias SET nombre=? WHERE id=?", (new_name, old_id))
+        else:
+            afectados = _comercio_ids_con_categorias(conn, u, [old_id])
+            for tabla in _CATEGORIA_ID_TABLES:
+                conn.execute(f"UPDATE {tabla} SET categoria_id=? WHERE usuario=? AND categoria_id=?", (new_id, u, old_id))
+            conn.execute("DELETE FROM categorias WHERE id=?", (old_id,))
+            _refresh_comercio_stats(conn, u, afectados)
+    _bump_meta_version(conn)
+
+
+# --- Dimensión de comercios ---
+# Cada comercio canónico del usuario se interna una vez en comercios; movimientos guarda el id
+# entero (comercio_id) y las agregaciones por lugar agrupan por él. Las variantes de un mismo
+# comercio en la cartola (terminal, sufijo "*...", ciudad) comparten clave y, por lo tanto, id.
+
+_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
+# Reglas por subcadena (detalle contiene CLAVE -> categoría), compartidas con update_master.py
+_MERCHANT_MAP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "merchant_map.json")
+
+# Reglas de canonicalización por defecto; config.json puede reemplazar cada una
+_MERCHANT_RULES_DEFAULT: Dict[str, Any] = {
+    "merchant_processor_prefixes": [
+        "merpago", "mercadopago", "mercado pago", "mp", "paypal", "sumup", "getnet",
+        "dlocal", "payu", "flow", "kushki", "transbank", "tbk",
+    ],
+    "merchant_location_suffixes": [
+        "santiago", "stgo", "providencia", "las condes", "nunoa", "vitacura", "la florida",
+        "maipu", "vina del mar", "valparaiso", "concepcion", "chile", "chl", "cl",
+    ],
+    "merchant_aliases": {},
+}
+
+
+def _merchant_rules() -> Dict[str, Any]:
+    """Reglas de config.json (o las por defecto), en caché por mtime y tamaño del archivo como rules.flag_rules."""
+    try:
+        st = os.stat(_CONFIG_PATH)
+        firma = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        firma = None
+    return _compilar_merchant_rules(firma)
+
+
+@functools.lru_cache(maxsize=1)
+def _compilar_merchant_rules(firma) -> Dict[str, Any]:
+    """Reglas normalizadas y compiladas a expresiones regulares (firma solo invalida la caché)."""
+    cfg: Dict[str, Any] = {}
+    try:
+        with open(_CONFIG_PATH, encoding="utf-8") as fh:
+            cfg = json.load(fh)
+    except Exception:
+        pass
+    reglas = {k: cfg.get(k, v) for k, v in _MERCHANT_RULES_DEFAULT.items()}
+
+    def alternativas(palabras) -> str:
+        norm = sorted({_normalize_text_basic(p) for p in palabras if p}, key=len, reverse=True)
+        return "|".join(re.escape(p) for p in norm) or "(?!)"
+
+    return {
+        "procesadores": {_normalize_text_basic(p) for p in reglas["merchant_processor_prefixes"]},
+        # Solo con separador detrás y algo después: "FLOW BAR" o "MP CAFE" son el nombre del comercio
+        "re_prefijo": rf"^(?:{alternativas(reglas['merchant_processor_prefixes'])})\s*[-:/|]\s*(?=\S)",
+        "re_sufijo": rf"(?:\s+(?:{alternativas(reglas['merchant_location_suffixes'])}))+$",
+        "alias": {_normalize_text_basic(k): _normalize_text_basic(v) for k, v in reglas["merchant_aliases"].items()},
+    }
+
+
+# Un sufijo de ciudad tras un conector es parte del nombre (BANCO DE CHILE)
+_RE_CONECTOR_FINAL = r"\b(?:de|del|el|la|las|los|y|en)$"
+
+
+def canonicalize_merchants(detalles) -> pd.Series:
+    """
+    Clave canónica de comercio para cada detalle (vectorizado: cada valor distinto se procesa
+    una sola vez con operaciones .str y el resultado se reparte con pd.factorize):
+      - texto normalizado (minúsculas, sin acentos, espacios colapsados),
+      - se separa en "*": tras un procesador de pagos queda el comercio (MERPAGO*LIQUIDOS OFF COME
+        -> liquidos off come); en otro caso queda la marca (LIME*VIAJE -> lime),
+      - se quita un prefijo de procesador solo si lo sigue un separador (MERPAGO - LIQUIDOS ->
+        liquidos; FLOW BAR queda igual),
+      - se quitan los números que siguen al nombre (terminal, sucursal: 7 ELEVEN 123 -> 7 eleven)
+        y los sufijos de ciudad, salvo tras un conector (BANCO DE CHILE queda igual),
+      - se aplican los alias de config.json.
+    Ningún paso quita la primera palabra; si la limpieza deja la clave vacía se usa el texto normalizado.
+    """
+    s = detalles if isinstance(detalles, pd.Series) else pd.Series(list(detalles), dtype=object)
+    if s.empty:
+        return pd.Series([], index=s.index, dtype=object)
+    codes, uniques = pd.factorize(s.fillna("").astype(str))
+    reglas = _merchant_rules()
+    base = pd.Series(uniques, dtype=object).map(_normalize_text_basic)
+    partes = base.str.split("*", n=1, expand=True)
+    antes = partes[0].str.strip()
+    despues = partes[1].fillna("").str.strip() if partes.shape[1] > 1 else pd.Series("", index=base.index)
+    tras_procesador = antes.str.replace(r"[^a-z ]", "", regex=True).str.strip().isin(reglas["procesadores"]) & (despues != "")
+    clave = (
+        antes.where(~tras_procesador, despues)
+        .str.replace(reglas["re_prefijo"], "", regex=True)
+        .str.replace(r"[^a-z0-9 ]", " ", regex=True)
+        .str.replace(r"(?<=\S)\s+\d+\b|(?<=[a-z])\d+\b", " ", regex=True)
+        .str.replace(r"\s+", " ", regex=True)
+        .str.strip()
+    )
+    sin_sufijo = clave.str.replace(reglas["re_sufijo"], "", regex=True).str.strip()
+    clave = clave.where(sin_sufijo.str.contains(_RE_CONECTOR_FINAL, regex=True), sin_sufijo)
+    if reglas["alias"]:
+        clave = clave.replace(reglas["alias"])
+    clave = clave.where(clave != "", base)
+    return pd.Series(clave.to_numpy()[codes], index=s.index, dtype=object)
+
+
+_PARAM_NOMBRE = re.compile(r"(?<![:\w]):(\w+)")
+
+
+def _executemany(cx, sql: str, rows: List[Dict[str, Any]]) -> None:
+    """
+    Una sentencia con parámetros :nombre para muchas filas (sqlite3 o conexión SQLAlchemy).
+    Con psycopg2 va por execute_batch: páginas de _PG_PAGE_SIZE filas por ida y vuelta.
+    """
+    if not rows:
+        return
+    if isinstance(cx, sqlite3.Connection):
+        cx.executemany(sql, rows)
+    elif cx.dialect.driver == "psycopg2":
+        from psycopg2.extras import execute_batch
+        cur = cx.connection.cursor()
+        try:
+            execute_batch(cur, _PARAM_NOMBRE.sub(r"%(\1)s", sql.replace("%", "%%")), rows, page_size=_PG_PAGE_SIZE)
+        finally:
+            cur.close()
+    else:
+        cx.execute(text(sql), rows)
+
+
+def _select_comercio_ids(cx, usuario: str, claves: List[str]) -> Dict[str, int]:
+    """clave -> comercios.id de los que ya existen. `cx` como en _insert_rows."""
+    if isinstance(cx, sqlite3.Connection):
+        found: Dict[str, int] = {}
+        for placeholders, chunk in sqlite_in_chunks(claves, reserved=1):
+            found.update(cx.execute(
+                f"SELECT clave, id FROM comercios WHERE usuario = ? AND clave IN ({placeholders})",
+                [usuario, *chunk],
+            ).fetchall())
+        return found
+    rows = cx.execute(
+        text("SELECT clave, id FROM comercios WHERE usuario = :u AND clave = ANY(:claves)"),
+        {"u": usuario, "claves": list(claves)},
+    ).fetchall()
+    return {r[0]: int(r[1]) for r in rows}
+
+
+def _intern_comercios(cx, usuario: str, detalle_norms) -> Dict[str, int]:
+    """
+    detalle_norm -> comercios.id: canonicaliza los valores distintos e inserta en un
+    solo lote las claves que aún no existen.
+    """
+    dns = sorted({str(dn) for dn in detalle_norms if dn})
+    if not dns:
+        return {}
+    claves = dict(zip(dns, canonicalize_merchants(pd.Series(dns, dtype=object))))
+    ids = _select_comercio_ids(cx, usuario, sorted(set(claves.values())))
+    nuevos: Dict[str, tuple] = {}
+    for dn, k in claves.items():
+        if k and k not in ids and k not in nuevos:
+            nuevos[k] = (usuario, k, dn, k.upper())
+    if nuevos:
+        _insert_rows(cx, "comercios", ["usuario", "clave", "detalle_norm", "canonical_name"], list(nuevos.values()),
+                     "ON CONFLICT (usuario, clave) DO NOTHING")
+        ids.update(_select_comercio_ids(cx, usuario, list(nuevos)))
+    return {dn: ids[k] for dn, k in claves.items() if k in ids}
+
+
+def _asignar_comercios(cx, usuario: str) -> int:
+    """Interna y asigna comercio_id a las filas del usuario que no lo tienen (restauradas o previas a la dimensión)."""
+    q = ("SELECT DISTINCT detalle_norm FROM movimientos "
+         "WHERE usuario = {u} AND comercio_id IS NULL AND detalle_norm IS NOT NULL")
+    if isinstance(cx, sqlite3.Connection):
+        dns = [r[0] for r in cx.execute(q.format(u="?"), (usuario,)).fetchall()]
+    else:
+        dns = [r[0] for r in cx.execute(text(q.format(u=":u")), {"u": usuario}).fetchall()]
+    ids = _intern_comercios(cx, usuario, dns)
+    _executemany(
+        cx,
+        "UPDATE movimientos SET comercio_id = :id WHERE usuario = :u AND comercio_id IS NULL AND detalle_norm = :dn",
+        [{"id": cid, "u": usuario, "dn": dn} for dn, cid in ids.items()],
+    )
+    _refresh_comercio_stats(cx, usuario, ids.values())
+    return len(ids)
+
+
+def _recanonicalize_comercios(cx, usuario: Optional[str] = None) -> int:
+    """
+    Recalcula la clave de los comercios (de todos los usuarios si usuario es None) y fusiona
+    los que pasan a compartir clave: movimientos se reapunta al id menor y el resto se elimina.
+    Las variantes (detalle_norm) que ya no canonicalizan a la clave de su comercio se separan
+    hacia el comercio de su clave. Devuelve comercios fusionados más variantes separadas.
+    """
+    q = "SELECT id, usuario, detalle_norm FROM comercios" + (" WHERE usuario = {u}" if usuario else "")
+    if isinstance(cx, sqlite3.Connection):
+        rows = cx.execute(q.format(u="?"), (usuario,) if usuario else ()).fetchall()
+    else:
+        rows = cx.execute(text(q.format(u=":u")), {"u": usuario}).fetchall()
+    if not rows:
+        return 0
+    df = pd.DataFrame(rows, columns=["id", "usuario", "detalle_norm"])
+    df["clave"] = canonicalize_merchants(df["detalle_norm"])
+    df["keep"] = df.groupby(["usuario", "clave"])["id"].transform("min")
+    fusion = df[df["id"] != df["keep"]]
+    keep = df[df["id"] == df["keep"]]
+    _executemany(
+        cx,
+        "UPDATE movimientos SET comercio_id = :keep WHERE usuario = :u AND comercio_id = :id",
+        [{"keep": int(r.keep), "u": r.usuario, "id": int(r.id)} for r in fusion.itertuples()],
+    )
+    _executemany(cx, "DELETE FROM comercios WHERE id = :id", [{"id": int(i)} for i in fusion["id"]])
+    # Claves en NULL primero: dos comercios pueden intercambiar clave sin chocar con el índice único
+    _executemany(cx, "UPDATE comercios SET clave = NULL WHERE id = :id", [{"id": int(i)} for i in keep["id"]])
+    _executemany(
+        cx,
+        "UPDATE comercios SET clave = :clave, canonical_name = :nombre WHERE id = :id",
+        [{"clave": r.clave, "nombre": r.clave.upper(), "id": int(r.id)} for r in keep.itertuples()],
+    )
+    # Los conteos de los comercios fusionados pasan al que se conserva
+    for u, g in fusion.groupby("usuario"):
+        _refresh_comercio_stats(cx, u, [*g["id"], *g["keep"]])
+    # Variantes que con las reglas actuales ya no comparten clave con su comercio (se unieron con
+    # reglas más agresivas): sus filas pasan al comercio de su propia clave
+    q = ("SELECT DISTINCT m.usuario, m.detalle_norm, m.comercio_id, c.clave FROM movimientos m "
+         "JOIN comercios c ON c.id = m.comercio_id WHERE m.detalle_norm IS NOT NULL"
+         + (" AND m.usuario = {u}" if usuario else ""))
+    if isinstance(cx, sqlite3.Connection):
+        rows = cx.execute(q.format(u="?"), (usuario,) if usuario else ()).fetchall()
+    else:
+        rows = cx.execute(text(q.format(u=":u")), {"u": usuario}).fetchall()
+    filas = pd.DataFrame(rows, columns=["usuario", "detalle_norm", "comercio_id", "clave"])
+    filas = filas[canonicalize_merchants(filas["detalle_norm"]) != filas["clave"]]
+    for u, g in filas.groupby("usuario"):
+        ids = _intern_comercios(cx, u, g["detalle_norm"])
+        _executemany(
+            cx,
+            "UPDATE movimientos SET comercio_id = :id WHERE usuario = :u AND detalle_norm = :dn",
+            [{"id": ids[dn], "u": u, "dn": dn} for dn in g["detalle_norm"] if dn in ids],
+        )
+        _refresh_comercio_stats(cx, u, [*g["comercio_id"], *ids.values()])
+    return len(fusion) + len(filas)
+
+
+def recanonicalize_comercios(conn) -> int:
+    """
+    Tras cambiar las reglas merchant_* de config.json (o la canonicalización): recalcula las
+    claves de los comercios del usuario, fusionando y separando variantes. Devuelve los cambios.
+    """
+    u = get_usuario(conn)
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        with conn["engine"].begin() as e:
+            n = _recanonicalize_comercios(e, u)
+    else:
+        with conn:
+            n = _recanonicalize_comercios(conn, u)
+    _bump_meta_version(conn)
+    return n
+
+
+def intern_comercios(conn, detalle_norms) -> Dict[str, int]:
+    """Variante pública de _intern_comercios para inserciones fuera de upsert_transactions."""
+    u = get_usuario(conn)
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        with conn["engine"].begin() as e:
+            return _intern_comercios(e, u, detalle_norms)
+    with conn:
+        return _intern_comercios(conn, u, detalle_norms)
+
+
+def get_comercio_ids(conn, detalle_norms) -> Dict[str, int]:
+    """detalle_norm -> comercios.id según su clave canónica (sin crear los que faltan)."""
+    dns = sorted({str(dn) for dn in detalle_norms if dn})
+    if not dns:
+        return {}
+    claves = dict(zip(dns, canonicalize_merchants(pd.Series(dns, dtype=object))))
+    u = get_usuario(conn)
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        with conn["engine"].connect() as e:
+            ids = _select_comercio_ids(e, u, sorted(set(claves.values())))
+    else:
+        ids = _select_comercio_ids(conn, u, sorted(set(claves.values())))
+    return {dn: ids[k] for dn, k in claves.items() if k in ids}
+
+
+# --- Estadística comercio -> categoría ---
+# comercio_categoria_stats guarda cuántos movimientos de cada comercio hay en cada categoría.
+# Cada escritor de movimientos recalcula solo los comercios que tocó (las filas de un comercio
+# están en el índice (usuario, comercio_id)), así la categoría dominante es una búsqueda puntual.
+
+def _refresh_comercio_stats(cx, usuario: Optional[str], comercio_ids=None) -> None:
+    """
+    Recalcula desde movimientos los conteos de los comercios dados del usuario (todos si
+    comercio_ids es None; todos los usuarios si además usuario es None). `cx` como en _insert_rows.
+    """
+    if comercio_ids is not None:
+        comercio_ids = sorted({int(c) for c in comercio_ids if c is not None and not pd.isna(c)})
+        if not comercio_ids:
+            return
+    sqlite = isinstance(cx, sqlite3.Connection)
+    por_usuario = "" if usuario is None else (" AND usuario = ?" if sqlite else " AND usuario = :u")
+    borrar = "DELETE FROM comercio_categoria_stats WHERE comercio_id IS NOT NULL{filtro}"
+    agregar = (
+        "INSERT INTO comercio_categoria_stats (usuario, comercio_id, categoria_id, n) "
+        "SELECT usuario, comercio_id, categoria_id, COUNT(*) FROM movimientos "
+        "WHERE comercio_id IS NOT NULL AND categoria_id IS NOT NULL{filtro} "
+        "GROUP BY usuario, comercio_id, categoria_id"
+    )
+    if sqlite:
+        base = [] if usuario is None else [usuario]
+        if comercio_ids is None:
+            batches = [(por_usuario, base)]
+        else:
+            batches = [
+                (f"{por_usuario} AND comercio_id IN ({placeholders})", [*base, *chunk])
+                for placeholders, chunk in sqlite_in_chunks(comercio_ids, reserved=1)
+            ]
+        for filtro, args in batches:
+            cx.execute(borrar.format(filtro=filtro), args)
+            cx.execute(agregar.format(filtro=filtro), args)
+        return
+    filtro = por_usuario + ("" if comercio_ids is None else " AND comercio_id = ANY(:ids)")
+    params = {"u": usuario, "ids": comercio_ids}
+    cx.execute(text(borrar.format(filtro=filtro)), params)
+    cx.execute(text(agregar.format(filtro=filtro)), params)
+
+
+def _comercio_ids_de_filas(cx, usuario: str, col: str, keys: List[Any]) -> List[int]:
+    """comercio_id de las filas de movimientos del usuario con col (unique_key o id) en keys."""
+    if not keys:
+        return []
+    if isinstance(cx, sqlite3.Connection):
+        found: List[int] = []
+        for placeholders, chunk in sqlite_in_chunks(keys, reserved=1):
+            found += [r[0] for r in cx.execute(
+                f"SELECT DISTINCT comercio_id FROM movimientos WHERE usuario = ? AND {col} IN ({placeholders})",
+                [usuario, *chunk],
+            ).fetchall()]
+        return found
+    return [r[0] for r in cx.execute(
+        text(f"SELECT DISTINCT comercio_id FROM movimientos WHERE usuario = :u AND {col} = ANY(:keys)"),
+        {"u": usuario, "keys": list(keys)},
+    ).fetchall()]
+
+
+def _comercio_ids_con_categorias(cx, usuario: str, categoria_ids: List[int]) -> List[int]:
+    """Comercios del usuario con movimientos en alguna de las categorías dadas (según la estadística)."""
+    if not categoria_ids:
+        return []
+    if isinstance(cx, sqlite3.Connection):
+        found: List[int] = []
+        for placeholders, chunk in sqlite_in_chunks(categoria_ids, reserved=1):
+            found += [r[0] for r in cx.execute(
+                f"SELECT DISTINCT comercio_id FROM comercio_categoria_stats WHERE usuario = ? AND categoria_id IN ({placeholders})",
+                [usuario, *chunk],
+            ).fetchall()]
+        return found
+    return [r[0] for r in cx.execute(
+        text("SELECT DISTINCT comercio_id FROM comercio_categoria_stats WHERE usuario = :u AND categoria_id = ANY(:ids)"),
+        {"u": usuario, "ids": list(categoria_ids)},
+    ).fetchall()]
+
+
+def refresh_comercio_stats(conn, comercio_ids=None) -> None:
+    """Recalcula la estadística de los comercios dados del usuario (todos si es None) tras escribir movimientos fuera de db.py."""
+    u = get_usuario(conn)
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        with conn["engine"].begin() as e:
+            _refresh_comercio_stats(e, u, comercio_ids)
+    else:
+        with conn:
+            _refresh_comercio_stats(conn, u, comercio_ids)
+    _bump_stats_version(conn)
 
-    conn.execute("CREATE TABLE IF NOT EXISTS categorias (nombre TEXT UNIQUE);")
-    conn.execute("CREATE TABLE IF NOT EXISTS categoria_map (detalle_norm TEXT PRIMARY KEY, categoria TEXT);")
-    conn.commit()
 
-def get_categories(conn) -> List[str]:
+def rebuild_comercio_stats(conn) -> int:
+    """Reconstruye comercio_categoria_stats de todos los usuarios desde movimientos. Devuelve las filas resultantes."""
+    q = "SELECT COUNT(*) FROM comercio_categoria_stats"
     if isinstance(conn, dict) and conn.get("pg") and text is not None:
-        engine = conn["engine"]
-        with engine.begin() as e:
-            rows = e.execute(text("SELECT nombre FROM categorias ORDER BY nombre")).fetchall()
-        return [r[0] for r in rows]
-    cur = conn.execute("SELECT nombre FROM categorias ORDER BY nombre")
-    return [r[0] for r in cur.fetchall()]
+        with conn["engine"].begin() as e:
+            _refresh_comercio_stats(e, None)
+            n = int(e.execute(text(q)).scalar() or 0)
+    else:
+        with conn:
+            _refresh_comercio_stats(conn, None)
+            n = int(conn.execute(q).fetchone()[0])
+    _bump_stats_version(conn)
+    return n
 
 
-def replace_categories(conn, cats: List[str]) -> None:
-    # Replace entire list atomically
-    cats = [c.strip() for c in cats if c and isinstance(c, str)]
+def get_dominant_categories(conn, comercio_ids) -> Dict[int, Tuple[str, float]]:
+    """
+    comercio_id -> (categoría más frecuente, % de los movimientos categorizados del comercio),
+    leído de comercio_categoria_stats ("Sin categoría" no cuenta). Empates: por nombre.
+    """
+    ids = sorted({int(c) for c in comercio_ids if c is not None})
+    if not ids:
+        return {}
+    u = get_usuario(conn)
+    q = (
+        "SELECT s.comercio_id, c.nombre, s.n FROM comercio_categoria_stats s "
+        "JOIN categorias c ON c.id = s.categoria_id "
+        "WHERE s.usuario = {u} AND c.nombre != 'Sin categoría' AND s.comercio_id {ids}"
+    )
     if isinstance(conn, dict) and conn.get("pg") and text is not None:
-        engine = conn["engine"]
-        with engine.begin() as e:
-            e.execute(text("DELETE FROM categorias"))
-            if cats:
-                e.execute(text("INSERT INTO categorias(nombre) VALUES (:n) ON CONFLICT DO NOTHING"), [{"n": c} for c in cats])
-        return
-    with conn:
-        conn.execute("DELETE FROM categorias")
-        if cats:
-            conn.executemany("INSERT OR IGNORE INTO categorias(nombre) VALUES (?)", [(c,) for c in cats])
+        with conn["engine"].connect() as e:
+            rows = e.execute(text(q.format(u=":u", ids="= ANY(:ids)")), {"u": u, "ids": ids}).fetchall()
+    else:
+        rows = []
+        for placeholders, chunk in sqlite_in_chunks(ids, reserved=1):
+            rows += conn.execute(q.format(u="?", ids=f"IN ({placeholders})"), [u, *chunk]).fetchall()
+    if not rows:
+        return {}
+    df = pd.DataFrame(rows, columns=["comercio_id", "categoria", "n"])
+    df["pct"] = df["n"] * 100.0 / df.groupby("comercio_id")["n"].transform("sum")
+    df = df[df["n"] > 0].sort_values(["comercio_id", "n", "categoria"], ascending=[True, False, True])
+    top = df.drop_duplicates("comercio_id")
+    return {int(cid): (cat, float(pct)) for cid, cat, pct in top[["comercio_id", "categoria", "pct"]].itertuples(index=False, name=None)}
+
+
+# --- Conteos del clasificador de texto ---
+def load_classifier_counts(conn) -> pd.DataFrame:
+    """Conteos (categoria_id, feature, n) del clasificador del usuario."""
+    q = "SELECT categoria_id, feature, n FROM clasificador_conteos WHERE usuario = {u}"
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        with conn["engine"].connect() as e:
+            return pd.read_sql_query(text(q.format(u=":u")), e, params={"u": get_usuario(conn)})
+    return pd.read_sql_query(q.format(u="?"), conn, params=[get_usuario(conn)])
 
 
-def update_categoria_map_from_df(conn, df: pd.DataFrame) -> int:
-    if df is None or df.empty:
-        return 0
-    sub = df[["detalle_norm", "categoria"]].dropna()
-    if sub.empty:
-        return 0
-    sub = sub[(sub["categoria"].notna()) & (sub["categoria"].str.strip() != "")]
-    if sub.empty:
-        return 0
-    rows_df = sub.drop_duplicates("detalle_norm")
-    if isinstance(conn, dict) and conn.get("pg") and text is not None:
-        engine = conn["engine"]
-        with engine.begin() as e:
-            res = e.execute(
-                text(
-                    "INSERT INTO categoria_map(detalle_norm, categoria) VALUES(:detalle_norm, :categoria) "
-                    "ON CONFLICT(detalle_norm) DO UPDATE SET categoria=EXCLUDED.categoria"
-                ),
-                rows_df.to_dict(orient="records"),
-            )
-            return res.rowcount or 0
-    cur = conn.executemany(
-        "INSERT INTO categoria_map(detalle_norm, categoria) VALUES(?, ?) ON CONFLICT(detalle_norm) DO UPDATE SET categoria=excluded.categoria",
-        rows_df.values.tolist(),
+def add_classifier_counts(conn, counts: pd.DataFrame, replace: bool = False) -> int:
+    """
+    Suma los deltas de `counts` (categoria_id, feature, n) a los conteos del clasificador del
+    usuario con un upsert en lote; con replace=True los reemplaza por completo. Devuelve las
+    filas escritas.
+    """
+    u = get_usuario(conn)
+    agg = counts.groupby(["categoria_id", "feature"], as_index=False)["n"].sum()
+    rows = [(int(c), int(f), float(n), u) for c, f, n in agg.itertuples(index=False, name=None)]
+    cols = ["categoria_id", "feature", "n", "usuario"]
+    upsert = (
+        "ON CONFLICT(usuario, categoria_id, feature) "
+        "DO UPDATE SET n = clasificador_conteos.n + excluded.n"
     )
-    conn.commit()
-    return cur.rowcount or 0
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        with conn["engine"].begin() as e:
+            if replace:
+                e.execute(text("DELETE FROM clasificador_conteos WHERE usuario = :u"), {"u": u})
+            return _insert_rows(e, "clasificador_conteos", cols, rows, upsert)
+    with conn:
+        if replace:
+            conn.execute("DELETE FROM clasificador_conteos WHERE usuario = ?", (u,))
+        return _insert_rows(conn, "clasificador_conteos", cols, rows, upsert)
 
 
-def map_categories_for_df(conn, df: pd.DataFrame) -> pd.DataFrame:
-    if df is None or df.empty:
-        return df
-    df = df.copy()
-    if "detalle_norm" not in df.columns:
-        df["detalle_norm"] = df.get("detalle", "")
-    # Normalizar a formato BD (lowercase) para que el merge con categoria_map funcione
-    df["detalle_norm"] = df["detalle_norm"].astype(str).map(_normalize_text_basic)
-    if isinstance(conn, dict) and conn.get("pg"):
-        engine = conn["engine"]
-        mp = pd.read_sql_query("SELECT detalle_norm, categoria FROM categoria_map", engine)
+def save_suggestions(conn, sug_df: pd.DataFrame, version: Optional[Tuple[int, int]] = None) -> int:
+    """
+    Guarda en movimientos la sugerencia de cada unique_key de `sug_df` (columnas de
+    suggest.SUGGESTION_COLUMNS): categoria_sugerida, sugerencia_fuente, sugerencia_confianza
+    y las alternativas como JSON. Solo toca filas que siguen pendientes: una fila categorizada
+    mientras se calculaban las sugerencias no se sobrescribe.
+
+    Con `version` (get_suggestion_version usada para calcularlas) se comprueba dentro de la misma
+    transacción que siga vigente: si otro escritor la cambió no se guarda nada (devuelve 0); si
+    no, se registra como la versión de las sugerencias guardadas. Devuelve las filas enviadas.
+    """
+    u = get_usuario(conn)
+    df = sug_df.drop_duplicates("unique_key", keep="first") if sug_df is not None and not sug_df.empty else pd.DataFrame()
+    if df.empty and version is None:
+        return 0
+    rows = [
+        {
+            "u": u,
+            "uk": str(uk),
+            "sug": None if pd.isna(sug) else str(sug),
+            "fuente": None if pd.isna(fuente) else str(fuente),
+            "conf": None if pd.isna(conf) else float(conf),
+            "alts": json.dumps(alts if isinstance(alts, list) else [], ensure_ascii=False, default=float),
+        }
+        for uk, sug, fuente, conf, alts in (
+            df[["unique_key", "sugerida", "fuente", "confianza", "alternativas_sim"]].itertuples(index=False, name=None)
+            if not df.empty else []
+        )
+    ]
+    sql = (
+        "UPDATE movimientos SET categoria_sugerida = :sug, sugerencia_fuente = :fuente, "
+        "sugerencia_confianza = :conf, sugerencia_alternativas = :alts "
+        "WHERE usuario = :u AND unique_key = :uk AND pendiente"
+    )
+    sellos = [
+        {"u": u, "clave": "sugerencias_meta", "valor": version[0]},
+        {"u": u, "clave": "sugerencias_stats", "valor": version[1]},
+    ] if version is not None else []
+    sellar = (
+        "INSERT INTO versiones (usuario, clave, valor) VALUES (:u, :clave, :valor) "
+        "ON CONFLICT (usuario, clave) DO UPDATE SET valor = excluded.valor"
+    )
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        with conn["engine"].begin() as e:
+            if version is not None and _versiones(e, u, ["meta", "stats"]) != tuple(version):
+                return 0
+            _executemany(e, sql, rows)
+            _executemany(e, sellar, sellos)
     else:
-        mp = pd.read_sql_query("SELECT detalle_norm, categoria FROM categoria_map", conn)
-    if mp.empty:
-        return df
-    merged = df.merge(mp, on="detalle_norm", how="left", suffixes=(None, "_map"))
-    # Tras el merge: si df no tenía "categoria", solo existe "categoria" (de mp). Si df tenía "categoria",
-    # existe "categoria" y "categoria_map" (de mp). Solo usar categoria_map cuando exista.
-    if "categoria_map" in merged.columns:
-        left_cat = merged.get("categoria", pd.Series(dtype=object))
-        mask_empty = left_cat.isna() | (left_cat.astype(str).str.strip().isin(["", "nan", "None"]))
-        merged["categoria"] = np.where(mask_empty, merged["categoria_map"], left_cat)
-        merged = merged.drop(columns=["categoria_map"])
-    elif "categoria" not in merged.columns:
-        merged["categoria"] = np.nan
-    # Filas sin match: rellenar con "Sin categoría"
-    merged["categoria"] = merged["categoria"].fillna("Sin categoría")
-    merged["categoria"] = merged["categoria"].replace("", "Sin categoría")
-    return merged
+        with conn:
+            if version is not None and _versiones(conn, u, ["meta", "stats"]) != tuple(version):
+                return 0
+            _executemany(conn, sql, rows)
+            _executemany(conn, sellar, sellos)
+    return len(rows)
+
+
+def _filtro_sugerencias(pg: bool, min_confianza: Optional[float], fuente: Optional[str]) -> Tuple[str, Dict[str, Any]]:
+    """Condición extra sobre la cola de pendientes: confianza mínima y fuente (por prefijo, sin el puntaje)."""
+    conds, params = [], {}
+    if min_confianza is not None or fuente:
+        conds.append("categoria_sugerida != 'Sin categoría'")
+    if min_confianza is not None:
+        conds.append("sugerencia_confianza >= {conf}")
+        params["conf"] = float(min_confianza)
+    if fuente:
+        conds.append("sugerencia_fuente LIKE {fuente}")
+        params["fuente"] = f"{fuente}%"
+    sql = "".join(f" AND {c}" for c in conds)
+    return sql.format(**{k: (f":{k}" if pg else "?") for k in params}), params
+
+
+def count_pending(conn, min_confianza: Optional[float] = None, fuente: Optional[str] = None) -> int:
+    """
+    Cantidad de movimientos pendientes de categoría del usuario (sobre el índice parcial),
+    opcionalmente solo los con sugerencia de confianza >= min_confianza y/o de esa fuente.
+    """
+    pg = isinstance(conn, dict) and conn.get("pg") and text is not None
+    extra, params = _filtro_sugerencias(bool(pg), min_confianza, fuente)
+    q = f"SELECT COUNT(*) FROM movimientos WHERE usuario = {{u}} AND pendiente{extra}"
+    if pg:
+        with conn["engine"].connect() as e:
+            return int(e.execute(text(q.format(u=":u")), {"u": get_usuario(conn), **params}).scalar() or 0)
+    return int(conn.execute(q.format(u="?"), [get_usuario(conn), *params.values()]).fetchone()[0])
 
 
-def rename_category(conn, old_name: str, new_name: str) -> None:
-    if not old_name or not new_name or old_name == new_name:
-        return
-    if old_name == "Sin categoría":
-        return  # no renombrar base
-    
+def accept_suggestions(conn, min_confianza: float = 0.0, fuente: Optional[str] = None) -> pd.DataFrame:
+    """
+    Aplica en una sola transacción las sugerencias guardadas de la cola de pendientes con
+    confianza >= min_confianza (y fuente que empieza por `fuente`, p. ej. "Mapa exacto"):
+    un UPDATE por conjunto (categoria_id desde categoria_sugerida) y un upsert de
+    categoria_map con sus detalle_norm. Las sugeridas que no son una categoría del usuario
+    se omiten. Devuelve las filas aplicadas (unique_key, detalle_norm, monto, categoria).
+    """
+    u = get_usuario(conn)
+    pg = bool(isinstance(conn, dict) and conn.get("pg") and text is not None)
+    extra, params = _filtro_sugerencias(pg, min_confianza, fuente)
+    p = ":u" if pg else "?"
+    cond = f"movimientos.usuario = {p} AND movimientos.pendiente{extra}"
+    join = "JOIN categorias c ON c.usuario = movimientos.usuario AND c.nombre = movimientos.categoria_sugerida"
+    select = (
+        "SELECT movimientos.unique_key, movimientos.detalle_norm, movimientos.monto, movimientos.comercio_id, "
+        f"c.nombre AS categoria, c.id AS categoria_id FROM movimientos {join} WHERE {cond}"
+    )
+    update = (
+        "UPDATE movimientos SET categoria_id = (SELECT c.id FROM categorias c WHERE c.usuario = movimientos.usuario "
+        f"AND c.nombre = movimientos.categoria_sugerida) WHERE {cond} "
+        f"AND EXISTS (SELECT 1 FROM categorias c WHERE c.usuario = movimientos.usuario AND c.nombre = movimientos.categoria_sugerida)"
+    )
+    map_cols = ["usuario", "detalle_norm", "categoria_id"]
+    map_upsert = "ON CONFLICT(usuario, detalle_norm) DO UPDATE SET categoria_id=excluded.categoria_id"
+
+    def _reglas(df: pd.DataFrame) -> List[tuple]:
+        reglas = df[df["detalle_norm"].fillna("").astype(str).str.strip() != ""].drop_duplicates("detalle_norm", keep="last")
+        return [(u, dn, int(cid)) for dn, cid in reglas[["detalle_norm", "categoria_id"]].itertuples(index=False, name=None)]
+
+    if pg:
+        with conn["engine"].begin() as e:
+            aplicadas = pd.read_sql_query(text(select), e, params={"u": u, **params})
+            if not aplicadas.empty:
+                e.execute(text(update), {"u": u, **params})
+                _insert_rows(e, "categoria_map", map_cols, _reglas(aplicadas), map_upsert)
+                _refresh_comercio_stats(e, u, aplicadas["comercio_id"].dropna().astype(int).tolist())
+    else:
+        args = [u, *params.values()]
+        with conn:
+            aplicadas = pd.read_sql_query(select, conn, params=args)
+            if not aplicadas.empty:
+                conn.execute(update, args)
+                _insert_rows(conn, "categoria_map", map_cols, _reglas(aplicadas), map_upsert)
+                _refresh_comercio_stats(conn, u, aplicadas["comercio_id"].dropna().astype(int).tolist())
+    if not aplicadas.empty:
+        _bump_meta_version(conn)
+        _bump_stats_version(conn)
+    return aplicadas[["unique_key", "detalle_norm", "monto", "categoria"]]
+
+
+def load_suggestions(
+    conn, unique_keys: Optional[List[str]] = None, limit: Optional[int] = None, offset: int = 0
+) -> pd.DataFrame:
+    """
+    Cola de pendientes: movimientos del usuario sin categoría o en "Sin categoría", con su
+    sugerencia guardada, del más reciente al más antiguo. Se restringe a `unique_keys` o se
+    pagina con limit/offset. sugerencia_fuente es NULL en los que aún no tienen sugerencia.
+    """
+    u = get_usuario(conn)
+    q = (
+        "SELECT m.unique_key, m.fecha, m.detalle, m.detalle_norm, m.monto, m.categoria_sugerida, m.sugerencia_fuente, "
+        "m.sugerencia_confianza, m.sugerencia_alternativas FROM movimientos m "
+        "WHERE m.usuario = {u} AND m.pendiente{keys} ORDER BY m.fecha DESC, m.unique_key{page}"
+    )
     if isinstance(conn, dict) and conn.get("pg") and text is not None:
-        engine = conn["engine"]
-        with engine.begin() as e:
-            e.execute(text("UPDATE categorias SET nombre=:new WHERE nombre=:old"), {"new": new_name, "old": old_name})
-            e.execute(text("INSERT INTO categorias(nombre) VALUES (:n) ON CONFLICT DO NOTHING"), {"n": new_name})
-            e.execute(text("DELETE FROM categorias WHERE nombre=:old"), {"old": old_name})
-            e.execute(text("UPDATE movimientos SET categoria=:new WHERE categoria=:old"), {"new": new_name, "old": old_name})
-            e.execute(text("UPDATE categoria_map SET categoria=:new WHERE categoria=:old"), {"new": new_name, "old": old_name})
-        return
-    
-    with conn:
-        conn.execute("UPDATE categorias SET nombre=? WHERE nombre=?", (new_name, old_name))
-        conn.execute("INSERT OR IGNORE INTO categorias(nombre) VALUES (?)", (new_name,))
-        conn.execute("DELETE FROM categorias WHERE nombre=?", (old_name,))
-        conn.execute("UPDATE movimientos SET categoria=? WHERE categoria=?", (new_name, old_name))
-        conn.execute("UPDATE categoria_map SET categoria=? WHERE categoria=?", (new_name, old_name))
+        params: Dict[str, Any] = {"u": u}
+        keys = page = ""
+        if unique_keys is not None:
+            params["uks"] = [str(k) for k in unique_keys]
+            keys = " AND m.unique_key = ANY(:uks)"
+        if limit is not None:
+            params.update(lim=int(limit), off=int(offset))
+            page = " LIMIT :lim OFFSET :off"
+        with conn["engine"].connect() as e:
+            return pd.read_sql_query(text(q.format(u=":u", keys=keys, page=page)), e, params=params)
+    if unique_keys is None:
+        if limit is None:
+            return pd.read_sql_query(q.format(u="?", keys="", page=""), conn, params=[u])
+        return pd.read_sql_query(q.format(u="?", keys="", page=" LIMIT ? OFFSET ?"), conn, params=[u, int(limit), int(offset)])
+    partes = [
+        pd.read_sql_query(q.format(u="?", keys=f" AND m.unique_key IN ({placeholders})", page=""), conn, params=[u, *chunk])
+        for placeholders, chunk in sqlite_in_chunks([str(k) for k in unique_keys], reserved=1)
+    ]
+    if not partes:
+        return pd.read_sql_query(q.format(u="?", keys=" AND 0", page=""), conn, params=[u])
+    if len(partes) == 1:
+        return partes[0]
+    return pd.concat(partes, ignore_index=True).sort_values(["fecha", "unique_key"], ascending=[False, True], ignore_index=True)
 
 
 
@@ -354,6 +1925,196 @@ def _compute_unique_key_row(row: pd.Series) -> str:
     return _stable_sig_key(f, dn, mc_val)
 
 
+_SQL_IGNORED_INSERT_PG = (
+    "INSERT INTO movimientos_ignorados (usuario, unique_key, fecha, detalle, detalle_norm, monto, monto_real, categoria, payload) "
+    "VALUES (:u, :uk, :fecha, :detalle, :detalle_norm, :monto, :monto_real, :categoria, CAST(:payload AS JSONB)) "
+    "ON CONFLICT (usuario, unique_key) DO UPDATE SET veces = COALESCE(movimientos_ignorados.veces, 1) + 1, last_seen_at = NOW()"
+)
+_SQL_IGNORED_INSERT_SQLITE = (
+    "INSERT INTO movimientos_ignorados (usuario, unique_key, fecha, detalle, detalle_norm, monto, monto_real, categoria, payload, last_seen_at) "
+    "VALUES (:u, :uk, :fecha, :detalle, :detalle_norm, :monto, :monto_real, :categoria, :payload, DATETIME('now')) "
+    "ON CONFLICT(usuario, unique_key) DO UPDATE SET veces = COALESCE(veces, 1) + 1, last_seen_at = DATETIME('now')"
+)
+
+
+def _ignored_params(r: Dict[str, Any], usuario: str) -> Dict[str, Any]:
+    """Fila ignorada: columnas tipadas para listar/restaurar y el payload completo como respaldo."""
+    return {
+        "u": usuario,
+        "uk": r["unique_key"],
+        "fecha": r.get("fecha"),
+        "detalle": r.get("detalle"),
+        "detalle_norm": r.get("detalle_norm"),
+        "monto": r.get("monto"),
+        "monto_real": r.get("monto_real"),
+        "categoria": r.get("categoria"),
+        "payload": json.dumps(r, default=str),
+    }
+
+
+def _tombstoned_keys(conn, keys: List[str]) -> set:
+    """Subconjunto de keys presente en movimientos_borrados (búsqueda por PK, en bloques)."""
+    keys = sorted({str(k) for k in keys if k})
+    found: set = set()
+    if not keys:
+        return found
+    u = get_usuario(conn)
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        engine = conn["engine"]
+        with engine.connect() as e:
+            rows = e.execute(text(
+                "SELECT unique_key FROM movimientos_borrados WHERE usuario = :u AND unique_key = ANY(:keys)"
+            ), {"u": u, "keys": keys}).fetchall()
+        found.update(r[0] for r in rows)
+        return found
+    for placeholders, chunk in sqlite_in_chunks(keys, reserved=1):
+        rows = conn.execute(
+            f"SELECT unique_key FROM movimientos_borrados WHERE usuario = ? AND unique_key IN ({placeholders})",
+            [u, *chunk],
+        ).fetchall()
+        found.update(r[0] for r in rows)
+    return found
+
+
+def filter_tombstoned(conn, df: pd.DataFrame) -> Tuple[pd.DataFrame, int]:
+    """Quita de df las filas cuya unique_key fue borrada por el usuario. Devuelve (df, omitidas)."""
+    if df is None or df.empty or "unique_key" not in df.columns:
+        return df, 0
+    tomb = _tombstoned_keys(conn, df["unique_key"].astype(str).tolist())
+    if not tomb:
+        return df, 0
+    keep = ~df["unique_key"].astype(str).isin(tomb)
+    return df[keep].copy(), int((~keep).sum())
+
+
+# --- Reembolsos y transferencias entre cuentas propias ---
+# Al ingerir, cada fila nueva se marca con es_entre_cuentas (account_aliases de config.json)
+# y se empareja con los abonos/gastos sin pareja de la ventana de fechas que la rodea
+# (índice (usuario, fecha)); las agregaciones netean los pares con un LEFT JOIN a reembolsos.
+
+@functools.lru_cache(maxsize=1)
+def _reembolso_config() -> Tuple[float, float]:
+    """(reimbursement_window_days, reimbursement_amount_tolerance) de config.json."""
+    cfg: Dict[str, Any] = {}
+    try:
+        with open(_CONFIG_PATH, encoding="utf-8") as fh:
+            cfg = json.load(fh)
+    except Exception:
+        pass
+    return float(cfg.get("reimbursement_window_days", 21)), float(cfg.get("reimbursement_amount_tolerance", 1000))
+
+
+def _marcar_entre_cuentas(cx, u: str) -> int:
+    """Recalcula es_entre_cuentas de todas las filas del usuario (alias de cuentas propias)."""
+    pg = not isinstance(cx, sqlite3.Connection)
+    q = "SELECT unique_key, detalle_norm FROM movimientos WHERE usuario = {p}"
+    if pg:
+        filas = pd.read_sql_query(text(q.format(p=":u")), cx, params={"u": u})
+    else:
+        filas = pd.read_sql_query(q.format(p="?"), cx, params=[u])
+    if filas.empty:
+        return 0
+    marca = flag_rules(_CONFIG_PATH).flags(filas["detalle_norm"].fillna(""))["es_entre_cuentas"]
+    _executemany(
+        cx,
+        "UPDATE movimientos SET es_entre_cuentas = :v WHERE usuario = :u AND unique_key = :uk",
+        [{"v": bool(m) if pg else int(bool(m)), "u": u, "uk": uk} for uk, m in zip(filas["unique_key"], marca)],
+    )
+    return int(marca.sum())
+
+
+def _emparejar_reembolsos(cx, u: str, nuevas: Optional[List[Tuple[str, Optional[str]]]] = None) -> int:
+    """
+    Empareja gastos y abonos sin pareja del usuario (matching.match_pairs) y guarda los pares
+    en reembolsos. Con `nuevas` [(unique_key, fecha ISO)] solo lee la ventana de fechas que
+    rodea a esas filas y solo acepta pares donde al menos un lado es nuevo; sin `nuevas`
+    empareja todo el historial. Abono = es_abono (signo en el CSV de origen): las palabras
+    clave de es_transferencia_o_abono también marcan transferencias salientes y pagos de
+    tarjeta, que no son reembolsos. Las transferencias entre cuentas propias no se emparejan.
+    Devuelve los pares agregados.
+    """
+    pg = not isinstance(cx, sqlite3.Connection)
+    ventana, tol = _reembolso_config()
+    q = (
+        "SELECT m.unique_key, m.fecha, m.monto, m.es_abono, m.es_entre_cuentas FROM movimientos m "
+        "WHERE m.usuario = {u}{rango} "
+        "AND NOT EXISTS (SELECT 1 FROM reembolsos r WHERE r.usuario = m.usuario AND r.gasto_uk = m.unique_key) "
+        "AND NOT EXISTS (SELECT 1 FROM reembolsos r WHERE r.usuario = m.usuario AND r.abono_uk = m.unique_key)"
+    )
+    params: Dict[str, Any] = {"u": u}
+    rango = ""
+    nuevas_uks: set = set()
+    if nuevas is not None:
+        fechas = pd.to_datetime(pd.Series([f for _, f in nuevas], dtype=object), errors="coerce").dropna()
+        if fechas.empty:
+            return 0
+        nuevas_uks = {uk for uk, _ in nuevas}
+        dias = int(np.ceil(ventana))
+        params["desde"] = (fechas.min() - pd.Timedelta(days=dias)).date().isoformat()
+        params["hasta"] = (fechas.max() + pd.Timedelta(days=dias + 1)).date().isoformat()
+        rango = (
+            " AND m.fecha >= CAST(:desde AS DATE) AND m.fecha < CAST(:hasta AS DATE)" if pg
+            else " AND m.fecha >= ? AND m.fecha < ?"
+        )
+    if pg:
+        filas = pd.read_sql_query(text(q.format(u=":u", rango=rango)), cx, params=params)
+    else:
+        filas = pd.read_sql_query(q.format(u="?", rango=rango), cx, params=list(params.values()))
+    fecha = pd.to_datetime(filas["fecha"], errors="coerce")
+    monto = pd.to_numeric(filas["monto"], errors="coerce")
+    validas = fecha.notna() & monto.notna() & (monto != 0) & ~filas["es_entre_cuentas"].isin([1, True])
+    abono = validas & filas["es_abono"].isin([1, True])
+    gasto = validas & ~abono
+    g, a = np.flatnonzero(gasto.to_numpy()), np.flatnonzero(abono.to_numpy())
+    ns = fecha.to_numpy(dtype="datetime64[ns]").astype(np.int64)
+    amt = monto.abs().to_numpy(dtype=float)
+    nuevo = filas["unique_key"].isin(nuevas_uks).to_numpy() if nuevas is not None else None
+    gi, ai, _ = match_pairs(
+        ns[g], amt[g], ns[a], amt[a], ventana, tol,
+        g_nuevo=nuevo[g] if nuevo is not None else None,
+        a_nuevo=nuevo[a] if nuevo is not None else None,
+    )
+    if not len(gi):
+        return 0
+    uks = filas["unique_key"].astype(str).to_numpy()
+    rows = [
+        (u, str(guk), str(auk), float(d))
+        for guk, auk, d in zip(uks[g[gi]], uks[a[ai]], amt[g[gi]] - amt[a[ai]])
+    ]
+    return _insert_rows(cx, "reembolsos", ["usuario", "gasto_uk", "abono_uk", "diff"], rows, "ON CONFLICT DO NOTHING")
+
+
+def rebuild_reimbursements(conn) -> int:
+    """
+    Tras cambiar account_aliases o los parámetros de reembolso en config.json: recalcula
+    es_entre_cuentas y vuelve a emparejar todo el historial del usuario. Devuelve los pares.
+    """
+    _reembolso_config.cache_clear()
+    u = get_usuario(conn)
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        with conn["engine"].begin() as e:
+            e.execute(text("DELETE FROM reembolsos WHERE usuario = :u"), {"u": u})
+            _marcar_entre_cuentas(e, u)
+            return _emparejar_reembolsos(e, u)
+    with conn:
+        conn.execute("DELETE FROM reembolsos WHERE usuario = ?", (u,))
+        _marcar_entre_cuentas(conn, u)
+        return _emparejar_reembolsos(conn, u)
+
+
+def pair_reimbursements(conn, nuevas: List[Tuple[str, Optional[str]]]) -> int:
+    """
+    Empareja filas insertadas fuera de upsert_transactions (p. ej. el alta manual de la app):
+    `nuevas` son (unique_key, fecha ISO). Devuelve los pares agregados.
+    """
+    u = get_usuario(conn)
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        with conn["engine"].begin() as e:
+            return _emparejar_reembolsos(e, u, nuevas)
+    with conn:
+        return _emparejar_reembolsos(conn, u, nuevas)
+
+
 def upsert_transactions(conn, df: pd.DataFrame) -> Tuple[int, int]:
     df = df.copy()
     # --- Normalize detalle_norm and compute stable key inputs ---
@@ -369,29 +2130,13 @@ def upsert_transactions(conn, df: pd.DataFrame) -> Tuple[int, int]:
     # Always recompute a deterministic unique_key
     df["unique_key"] = df.apply(_compute_unique_key_row, axis=1)
 
-    # Excluir ignorados por historial (p. ej., eliminados previamente)
+    # Excluir tombstones (borrados por el usuario); solo se consultan las claves del lote
     try:
-        if isinstance(conn, dict) and conn.get("pg"):
-            engine = conn["engine"]
-            ignored = pd.read_sql_query("SELECT unique_key FROM movimientos_ignorados", engine)["unique_key"].tolist()
-            # ¿Está vacía la tabla de movimientos?
-            mov_count = pd.read_sql_query("SELECT COUNT(*) AS c FROM movimientos", engine)["c"].iloc[0]
-        else:
-            ignored = pd.read_sql_query("SELECT unique_key FROM movimientos_ignorados", conn)["unique_key"].tolist()
-            mov_count = pd.read_sql_query("SELECT COUNT(*) AS c FROM movimientos", conn)["c"].iloc[0]
+        tomb = _tombstoned_keys(conn, df["unique_key"].astype(str).tolist())
     except Exception:
-        ignored = []
-        mov_count = 0
-
-    # Si la base está vacía, solo honramos ignores de tipo "id:*" (provenientes de borrados manuales)
-    # para permitir la primera carga completa aunque existan claves k:* antiguas en movimientos_ignorados.
-    if ignored:
-        if int(mov_count or 0) == 0:
-            effective_ignored = [k for k in ignored if str(k).startswith("id:")]
-        else:
-            effective_ignored = ignored
-        if effective_ignored:
-            df = df[~df["unique_key"].isin(set(effective_ignored))]
+        tomb = set()
+    if tomb:
+        df = df[~df["unique_key"].isin(tomb)]
 
     cols = [
         "id",
@@ -416,6 +2161,10 @@ def upsert_transactions(conn, df: pd.DataFrame) -> Tuple[int, int]:
         df["fraccion_mia_sugerida"] = df["fraccion_mia"]
     if "monto_mio" in df.columns and "monto_mio_estimado" not in df.columns:
         df["monto_mio_estimado"] = df["monto_mio"]
+    # Abono por signo: la app fuerza montos negativos y lo trae ya calculado; otras fuentes
+    # (CSV estandarizado de prep.py) traen el signo en monto
+    if "es_abono" not in df.columns:
+        df["es_abono"] = pd.to_numeric(df.get("monto"), errors="coerce") > 0
     for c in cols:
         if c not in df.columns:
             df[c] = None
@@ -484,8 +2233,12 @@ def upsert_transactions(conn, df: pd.DataFrame) -> Tuple[int, int]:
         # Fallback por signo
         return abs(m) if m < 0 else 0.0
 
+    cat_ids = _load_meta(conn)["ids"]
+    df = df.reset_index(drop=True)
+    # Transferencias entre cuentas propias (alias de config.json), vectorizado sobre el lote
+    entre_cuentas = flag_rules(_CONFIG_PATH).flags(df["detalle_norm"])["es_entre_cuentas"]
     rows_dicts: List[Dict[str, Any]] = []
-    for _, r in df[cols].iterrows():
+    for idx, r in df[cols].iterrows():
         rows_dicts.append({
             "id": None if pd.isna(r["id"]) else int(r["id"]),
             "fecha": to_date_str(r["fecha"]),
@@ -500,134 +2253,164 @@ def upsert_transactions(conn, df: pd.DataFrame) -> Tuple[int, int]:
             "detalle_norm": None if pd.isna(r["detalle_norm"]) else str(r["detalle_norm"]),
             "monto_real": to_float(default_monto_real(r)),
             "categoria": None if pd.isna(r.get("categoria", None)) else str(r.get("categoria")),
+            "categoria_id": None if pd.isna(r.get("categoria", None)) else cat_ids.get(str(r.get("categoria"))),
             "nota_usuario": None if pd.isna(r.get("nota_usuario", None)) else str(r.get("nota_usuario")),
             "unique_key": str(r["unique_key"]),
+            "es_entre_cuentas": bool(entre_cuentas.loc[idx]),
+            "es_abono": bool(to_bool(df.at[idx, "es_abono"])),
         })
 
+    u = get_usuario(conn)
+    # Comercios del lote: detalle_norm canonicalizado (vectorizado) e internado en bloque
+    dns_lote = {r["detalle_norm"] for r in rows_dicts if r["detalle_norm"]}
+
     # Postgres path
     if isinstance(conn, dict) and conn.get("pg") and text is not None:
-        import json
         engine = conn["engine"]
-        inserted = 0
-        ignored = 0
         with engine.begin() as e:
-            for r in rows_dicts:
-                # Pre-check for an existing row with same signature (fecha, detalle_norm, abs(monto))
-                exists = e.execute(text(
-                    """
-                    SELECT 1
-                    FROM movimientos
-                    WHERE DATE(fecha) = :f
-                      AND detalle_norm = :dn
-                      AND ABS(COALESCE(monto, 0)) = :mc
-                    LIMIT 1
-                    """
-                ), {
-                    "f": r["fecha"],
-                    "dn": _normalize_text_basic(r.get("detalle_norm", "")),
-                    "mc": round(abs(r.get("monto") or 0.0), 2),
-                }).scalar()
-                if exists:
-                    payload = json.dumps(r, default=str)
-                    e.execute(text(
-                        "INSERT INTO movimientos_ignorados (unique_key, payload) VALUES (:uk, :payload) ON CONFLICT (unique_key) DO NOTHING"
-                    ), {"uk": r["unique_key"], "payload": payload})
-                    ignored += 1
-                    continue
-                # single-row insert; detectar inserción con RETURNING 1
-                inserted_now = e.execute(text(
-                    """
-                    WITH ins AS (
-                        INSERT INTO movimientos (
-                            id, fecha, detalle, monto, es_gasto, es_transferencia_o_abono,
-                            es_compartido_posible, fraccion_mia_sugerida, monto_mio_estimado, categoria_sugerida,
-                            detalle_norm, monto_real, categoria, nota_usuario, unique_key
-                        ) VALUES (
-                            :id, :fecha, :detalle, :monto, :es_gasto, :es_transferencia_o_abono,
-                            :es_compartido_posible, :fraccion_mia_sugerida, :monto_mio_estimado, :categoria_sugerida,
-                            :detalle_norm, :monto_real, :categoria, :nota_usuario, :unique_key
-                        )
-                        ON CONFLICT (unique_key) DO NOTHING
-                        RETURNING 1
-                    ) SELECT COUNT(*) FROM ins
-                    """
-                ), r).scalar() or 0
-
-                if inserted_now > 0:
-                    inserted += inserted_now
-                    # si existían filas con monto nulo, sincronizar monto
-                    if r.get("monto") is not None:
-                        e.execute(text(
-                            "UPDATE movimientos SET monto = :m WHERE unique_key = :uk AND (monto IS NULL OR monto = 0)"
-                        ), {"uk": r["unique_key"], "m": r["monto"]})
-                else:
-                    # duplicado: registrar en movimientos_ignorados con payload JSON
-                    payload = json.dumps(r, default=str)
-                    e.execute(text(
-                        "INSERT INTO movimientos_ignorados (unique_key, payload) VALUES (:uk, :payload) ON CONFLICT (unique_key) DO NOTHING"
-                    ), {"uk": r["unique_key"], "payload": payload})
-                    ignored += 1
+            # Tabla particionada por mes: crear las particiones que necesita el lote
+            if _pg_is_partitioned(e):
+                _pg_ensure_month_partitions(e, [r["fecha"] for r in rows_dicts])
+            comercio_ids = _intern_comercios(e, u, dns_lote)
+            inserted, ignored, nuevas = _insertar_lote(e, u, rows_dicts, comercio_ids)
+            _refresh_comercio_stats(e, u, comercio_ids.values())
+            if nuevas:
+                _emparejar_reembolsos(e, u, nuevas)
+        _bump_stats_version(conn)
         return inserted, ignored
 
     # SQLite path
-    import json
-    sql = (
-        "INSERT OR IGNORE INTO movimientos (id, fecha, detalle, monto, es_gasto, es_transferencia_o_abono, "
-        "es_compartido_posible, fraccion_mia_sugerida, monto_mio_estimado, categoria_sugerida, detalle_norm, "
-        "monto_real, categoria, nota_usuario, unique_key) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
-    )
-    inserted = 0
-    ignored = 0
-    for r in rows_dicts:
-        # Pre-check for duplicate by signature in SQLite
-        cur = conn.execute(
-            "SELECT 1 FROM movimientos WHERE date(fecha) = ? AND detalle_norm = ? AND ABS(COALESCE(monto, 0)) = ? LIMIT 1",
-            (
-                r["fecha"],
-                _normalize_text_basic(r.get("detalle_norm", "")),
-                round(abs(r.get("monto") or 0.0), 2),
-            ),
-        )
-        if cur.fetchone():
-            payload = json.dumps(r, default=str)
-            conn.execute(
-                "INSERT OR IGNORE INTO movimientos_ignorados (unique_key, payload) VALUES (?, ?)",
-                (r["unique_key"], payload),
-            )
-            ignored += 1
-            continue
-        try:
-            conn.execute(sql, (
-                r["id"], r["fecha"], r["detalle"], r["monto"], r["es_gasto"], r["es_transferencia_o_abono"], r["es_compartido_posible"],
-                r["fraccion_mia_sugerida"], r["monto_mio_estimado"], r["categoria_sugerida"], r["detalle_norm"], r["monto_real"], r["categoria"], r["nota_usuario"], r["unique_key"]
-            ))
-            inserted += 1
-            # Sincronizar monto si estaba nulo/0
-            if r.get("monto") is not None:
-                conn.execute(
-                    "UPDATE movimientos SET monto = ? WHERE unique_key = ? AND (monto IS NULL OR monto = 0)",
-                    (r["monto"], r["unique_key"]),
-                )
-        except Exception as e:
-            if "UNIQUE constraint failed" in str(e):
-                payload = json.dumps(r, default=str)
-                conn.execute(
-                    "INSERT OR IGNORE INTO movimientos_ignorados (unique_key, payload) VALUES (?, ?)",
-                    (r["unique_key"], payload),
-                )
-                ignored += 1
-            else:
-                raise
+    comercio_ids = _intern_comercios(conn, u, dns_lote)
+    inserted, ignored, nuevas = _insertar_lote(conn, u, rows_dicts, comercio_ids)
+    _refresh_comercio_stats(conn, u, comercio_ids.values())
+    if nuevas:
+        _emparejar_reembolsos(conn, u, nuevas)
     conn.commit()
+    _bump_stats_version(conn)
     return inserted, ignored
 
 
-def load_all(conn) -> pd.DataFrame:
+_MOVIMIENTOS_INSERT_COLS = [
+    "id", "fecha", "detalle", "monto", "es_gasto", "es_transferencia_o_abono", "es_compartido_posible",
+    "fraccion_mia_sugerida", "monto_mio_estimado", "categoria_sugerida", "detalle_norm", "comercio_id",
+    "monto_real", "categoria_id", "nota_usuario", "unique_key", "es_entre_cuentas", "es_abono", "usuario",
+]
+
+
+def _firma_movimiento(fecha: Any, detalle_norm: Any, monto: Any) -> Optional[Tuple[str, str, float]]:
+    """(día, detalle_norm, |monto|) con que upsert_transactions detecta duplicados; sin fecha no hay firma."""
+    if fecha is None:
+        return None
+    return (str(fecha)[:10], str(detalle_norm or ""), round(abs(float(monto or 0.0)), 2))
+
+
+def _firmas_y_claves_existentes(cx, usuario: str, rows: List[Dict[str, Any]]) -> Tuple[set, set]:
+    """
+    Firmas (_firma_movimiento) y unique_key ya guardadas que coinciden con filas del lote, en
+    pocas consultas por bloques. `cx` como en _insert_rows.
+    """
+    fechas = sorted(r["fecha"] for r in rows if r["fecha"])
+    dns = sorted({r["detalle_norm"] for r in rows if r["fecha"] and r["detalle_norm"]})
+    keys = sorted({r["unique_key"] for r in rows})
+    firmas: set = set()
+    claves: set = set()
+    if isinstance(cx, sqlite3.Connection):
+        if dns:
+            for placeholders, chunk in sqlite_in_chunks(dns, reserved=3):
+                firmas.update(_firma_movimiento(*f) for f in cx.execute(
+                    "SELECT date(fecha), detalle_norm, monto FROM movimientos WHERE usuario = ? AND fecha >= ? "
+                    f"AND fecha < date(?, '+1 day') AND detalle_norm IN ({placeholders})",
+                    [usuario, fechas[0], fechas[-1], *chunk],
+                ).fetchall())
+        for placeholders, chunk in sqlite_in_chunks(keys, reserved=1):
+            claves.update(r[0] for r in cx.execute(
+                f"SELECT unique_key FROM movimientos WHERE usuario = ? AND unique_key IN ({placeholders})",
+                [usuario, *chunk],
+            ).fetchall())
+        return firmas, claves
+    # Rango sobre fecha (no DATE(fecha)) para que Postgres pueda podar particiones
+    if dns:
+        firmas.update(_firma_movimiento(*f) for f in cx.execute(text(
+            "SELECT CAST(fecha AS DATE), detalle_norm, monto FROM movimientos WHERE usuario = :u "
+            "AND fecha >= CAST(:desde AS DATE) AND fecha < CAST(:hasta AS DATE) + 1 AND detalle_norm = ANY(:dns)"
+        ), {"u": usuario, "desde": fechas[0], "hasta": fechas[-1], "dns": dns}).fetchall())
+    claves.update(r[0] for r in cx.execute(text(
+        "SELECT unique_key FROM movimientos WHERE usuario = :u AND unique_key = ANY(:keys)"
+    ), {"u": usuario, "keys": keys}).fetchall())
+    return firmas, claves
+
+
+def _insertar_lote(cx, usuario: str, rows: List[Dict[str, Any]], comercio_ids: Dict[str, int]):
+    """
+    Inserta el lote de upsert_transactions con _insert_rows y registra el resto en
+    movimientos_ignorados. Una fila se ignora si ya hay un movimiento con su firma (mismo día,
+    detalle_norm y |monto|) o su unique_key, guardado o antes en el mismo lote: el resultado es el
+    del chequeo fila a fila, con dos consultas por bloque en vez de dos por fila. Devuelve
+    (insertadas, ignoradas, [(unique_key, fecha)] insertadas). `cx` como en _insert_rows.
+    """
+    if not rows:
+        return 0, 0, []
+    firmas, claves = _firmas_y_claves_existentes(cx, usuario, rows)
+    nuevas: List[Dict[str, Any]] = []
+    ignoradas: List[Dict[str, Any]] = []
+    for r in rows:
+        firma = _firma_movimiento(r["fecha"], r["detalle_norm"], r.get("monto"))
+        if firma in firmas or r["unique_key"] in claves:
+            ignoradas.append(r)
+            continue
+        nuevas.append(r)
+        claves.add(r["unique_key"])
+        if firma is not None:
+            firmas.add(firma)
+    sqlite = isinstance(cx, sqlite3.Connection)
+    valores = [
+        tuple(
+            usuario if c == "usuario"
+            else comercio_ids.get(r["detalle_norm"]) if c == "comercio_id"
+            else int(r[c]) if sqlite and c in ("es_entre_cuentas", "es_abono")
+            else r[c]
+            for c in _MOVIMIENTOS_INSERT_COLS
+        )
+        for r in nuevas
+    ]
+    # ON CONFLICT por si otra sesión insertó la misma clave entre la consulta y el INSERT
+    insertadas = _insert_rows(cx, "movimientos", _MOVIMIENTOS_INSERT_COLS, valores, "ON CONFLICT DO NOTHING")
+    _executemany(cx, _SQL_IGNORED_INSERT_SQLITE if sqlite else _SQL_IGNORED_INSERT_PG,
+                 [_ignored_params(r, usuario) for r in ignoradas])
+    return insertadas, len(ignoradas) + len(nuevas) - insertadas, [(r["unique_key"], r["fecha"]) for r in nuevas]
+
+
+def load_all(conn, desde: Optional[str] = None, hasta: Optional[str] = None) -> pd.DataFrame:
+    """
+    Carga movimientos; con desde/hasta (YYYY-MM-DD, hasta exclusivo) filtra por un
+    rango sobre fecha que Postgres puede usar para podar particiones mensuales.
+    Solo devuelve filas del usuario de la conexión; el nombre de la categoría y el
+    del comercio se obtienen por join (columnas categoria, comercio y comercio_clave,
+    junto a sus ids). reembolso_diff (|gasto| - |abono| en gastos emparejados) y
+    es_reembolso (abonos emparejados) vienen de reembolsos, para netear las agregaciones.
+    """
+    conds = [("u", "m.usuario = {p}", get_usuario(conn))]
+    if desde:
+        conds.append(("desde", "m.fecha >= {p}", str(desde)))
+    if hasta:
+        conds.append(("hasta", "m.fecha < {p}", str(hasta)))
+    select = (
+        "SELECT m.*, c.nombre AS categoria, co.canonical_name AS comercio, co.clave AS comercio_clave, "
+        "rg.diff AS reembolso_diff, ra.abono_uk IS NOT NULL AS es_reembolso FROM movimientos m "
+        "LEFT JOIN categorias c ON c.id = m.categoria_id LEFT JOIN comercios co ON co.id = m.comercio_id "
+        "LEFT JOIN reembolsos rg ON rg.usuario = m.usuario AND rg.gasto_uk = m.unique_key "
+        "LEFT JOIN reembolsos ra ON ra.usuario = m.usuario AND ra.abono_uk = m.unique_key"
+    )
     if isinstance(conn, dict) and conn.get("pg"):
         engine = conn["engine"]
-        df = pd.read_sql_query("SELECT * FROM movimientos", engine)
+        where = " AND ".join(c.format(p=f":{k}" if k == "u" else f"CAST(:{k} AS DATE)") for k, c, _ in conds)
+        with engine.connect() as cx:
+            df = pd.read_sql_query(text(f"{select} WHERE {where}"), cx, params={k: v for k, _, v in conds})
     else:
-        df = pd.read_sql_query("SELECT * FROM movimientos", conn)
+        where = " AND ".join(c.format(p="?") for _, c, _ in conds)
+        df = pd.read_sql_query(f"{select} WHERE {where}", conn, params=[v for _, _, v in conds])
+    # usuario es implícito; categoria_previa es el texto anterior a categoria_id (solo bases migradas)
+    df = df.drop(columns=["usuario", "categoria_previa"], errors="ignore")
     if not df.empty:
         df["fecha"] = pd.to_datetime(df["fecha"], errors="coerce")
         for c in ["es_gasto", "es_transferencia_o_abono", "es_compartido_posible"]:
@@ -656,6 +2439,19 @@ def apply_edits(conn, df_edits: pd.DataFrame) -> int:
     ]
 
     updates = 0
+    u = get_usuario(conn)
+    # categoria llega como nombre y se guarda como categoria_id
+    cat_ids = _load_meta(conn)["ids"]
+    # Filas recategorizadas (columna del WHERE -> valores): sus comercios se recalculan al final
+    recategorizadas: Dict[str, List[Any]] = {}
+
+    def to_categoria_id(v: Any):
+        try:
+            if pd.isna(v):
+                return None
+        except Exception:
+            pass
+        return cat_ids.get(str(v)) if v is not None else None
     
     def to_bool(v: Any):
         if pd.isna(v) or v is None:
@@ -677,110 +2473,76 @@ def apply_edits(conn, df_edits: pd.DataFrame) -> int:
         except Exception:
             return None
 
-    # Postgres path
-    if isinstance(conn, dict) and conn.get("pg") and text is not None:
-        engine = conn["engine"]
-        for _, r in df_edits.iterrows():
-            where_clause = ""
-            params = {}
-
-            # Preferir unique_key para evitar colisiones por ids repetidos entre CSVs
-            if pd.notna(r.get("unique_key", None)) and str(r.get("unique_key")).strip() != "":
-                where_clause = "unique_key = :uk"
-                params["uk"] = str(r["unique_key"])
-            elif pd.notna(r.get("id", None)):
-                where_clause = "id = :id"
-                params["id"] = int(r["id"])
-            else:
-                continue
-
-            sets = []
-            set_vals = {}
-            for c in editable_cols:
-                if c in r.index:
-                    sets.append(f"{c} = :{c}")
-                    val = r[c]
-                    # Asegurar escalar
-                    if isinstance(val, pd.Series):
-                        val = val.iloc[0] if not val.empty else None
-                    if isinstance(val, (np.generic,)):
-                        val = val.item()
-                    if c in {"es_gasto", "es_transferencia_o_abono", "es_compartido_posible"}:
-                        set_vals[c] = to_bool(val)
-                    elif c in {"fraccion_mia_sugerida", "monto_mio_estimado", "monto_real"}:
-                        set_vals[c] = to_float(val)
-                    else:
-                        try:
-                            na = pd.isna(val)
-                            if isinstance(na, (pd.Series, np.ndarray, list)):
-                                na = False
-                        except Exception:
-                            na = False
-                        set_vals[c] = None if na else (None if val is None else str(val))
-            
-            if not sets:
-                continue
-
-            sql = f"UPDATE movimientos SET {', '.join(sets)} WHERE {where_clause}"
-            set_vals.update(params)
-            with engine.begin() as cx:
-                cx.execute(text(sql), set_vals)
-            updates += 1
-        
-        return updates
+    def to_text(v: Any):
+        try:
+            na = pd.isna(v)
+            if isinstance(na, (pd.Series, np.ndarray, list)):
+                na = False
+        except Exception:
+            na = False
+        return None if na or v is None else str(v)
 
-    # SQLite path
-    for _, r in df_edits.iterrows():
-        where_clause = ""
-        params = []
-        # Preferir unique_key en SQLite también
+    # Filas agrupadas por (columnas del SET, columna del WHERE): un executemany por grupo
+    grupos: Dict[Tuple[Tuple[str, ...], str], List[Dict[str, Any]]] = {}
+    for r in df_edits.to_dict("records"):
+        # Preferir unique_key para evitar colisiones por ids repetidos entre CSVs
         if pd.notna(r.get("unique_key", None)) and str(r.get("unique_key")).strip() != "":
-            where_clause = "unique_key = ?"
-            params.append(str(r["unique_key"]))
+            where_col, clave = "unique_key", str(r["unique_key"])
         elif pd.notna(r.get("id", None)):
-            where_clause = "id = ?"
-            params.append(int(r["id"]))
+            where_col, clave = "id", int(r["id"])
         else:
             continue
 
-        sets = []
-        set_vals = []
+        set_vals: Dict[str, Any] = {}
         for c in editable_cols:
-            if c in r.index:
-                sets.append(f"{c} = ?")
+            if c in r:
                 val = r[c]
                 # Asegurar escalar
                 if isinstance(val, pd.Series):
                     val = val.iloc[0] if not val.empty else None
                 if isinstance(val, (np.generic,)):
                     val = val.item()
-                if c in {"es_gasto", "es_transferencia_o_abono", "es_compartido_posible"}:
-                    set_vals.append(to_bool(val))
+                if c == "categoria":
+                    set_vals["categoria_id"] = to_categoria_id(val)
+                elif c in {"es_gasto", "es_transferencia_o_abono", "es_compartido_posible"}:
+                    set_vals[c] = to_bool(val)
                 elif c in {"fraccion_mia_sugerida", "monto_mio_estimado", "monto_real"}:
-                    set_vals.append(to_float(val))
+                    set_vals[c] = to_float(val)
                 else:
-                    try:
-                        na = pd.isna(val)
-                        if isinstance(na, (pd.Series, np.ndarray, list)):
-                            na = False
-                    except Exception:
-                        na = False
-                    set_vals.append(None if na else (None if val is None else str(val)))
-        if not sets:
+                    set_vals[c] = to_text(val)
+        if not set_vals:
             continue
 
-        sql = f"UPDATE movimientos SET {', '.join(sets)} WHERE {where_clause}"
-        conn.execute(sql, (*set_vals, *params))
+        if "categoria" in r:
+            recategorizadas.setdefault(where_col, []).append(clave)
+        grupos.setdefault((tuple(set_vals), where_col), []).append({**set_vals, "usuario": u, "clave": clave})
         updates += 1
 
-    conn.commit()
+    def escribir(cx) -> None:
+        for (set_cols, where_col), filas in grupos.items():
+            sets = ", ".join(f"{c} = :{c}" for c in set_cols)
+            _executemany(cx, f"UPDATE movimientos SET {sets} WHERE usuario = :usuario AND {where_col} = :clave", filas)
+        afectados = [cid for col, keys in recategorizadas.items() for cid in _comercio_ids_de_filas(cx, u, col, keys)]
+        _refresh_comercio_stats(cx, u, afectados)
+
+    # Postgres path
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        if grupos:
+            with conn["engine"].begin() as cx:
+                escribir(cx)
+    # SQLite path
+    else:
+        escribir(conn)
+        conn.commit()
+    if recategorizadas:
+        _bump_stats_version(conn)
     return updates
 
 
 # --- Tombstone-based delete API for compatibility with app.py ---
 def delete_transactions(conn, unique_keys: Optional[List[str]] = None, ids: Optional[List[int]] = None) -> int:
     """
-    Delete rows from movimientos and record tombstones in movimientos_ignorados so
+    Delete rows from movimientos and record tombstones in movimientos_borrados so
     they are not reinserted on future CSV uploads.
 
     Returns the count of deleted rows.
@@ -792,6 +2554,10 @@ def delete_transactions(conn, unique_keys: Optional[List[str]] = None, ids: Opti
     if not unique_keys and not ids:
         return 0
 
+    u = get_usuario(conn)
+    tomb_cols = ["usuario", "unique_key"]
+    tomb_conflict = "ON CONFLICT (usuario, unique_key) DO NOTHING"
+
     # --- Postgres path ---
     if isinstance(conn, dict) and conn.get("pg") and text is not None:
         engine = conn["engine"]
@@ -800,101 +2566,437 @@ def delete_transactions(conn, unique_keys: Optional[List[str]] = None, ids: Opti
             # If only IDs were provided, fetch the corresponding unique_keys to tombstone
             fetched_uks = []
             if ids:
-                # Build dynamic param list for ids fetch
-                id_params = {}
-                id_placeholders = []
-                for idx, i in enumerate(ids):
-                    key = f"id{idx}"
-                    id_params[key] = int(i)
-                    id_placeholders.append(f":{key}")
-                if id_placeholders:
-                    rows = e.execute(
-                        text(f"SELECT id, unique_key FROM movimientos WHERE id IN ({', '.join(id_placeholders)})"),
-                        id_params
-                    ).fetchall()
-                    fetched_uks = [r[1] for r in rows if r[1]]
+                rows = e.execute(
+                    text("SELECT id, unique_key FROM movimientos WHERE usuario = :u AND id = ANY(:ids)"),
+                    {"u": u, "ids": ids},
+                ).fetchall()
+                fetched_uks = [r[1] for r in rows if r[1]]
 
             # Merge all unique_keys and de-duplicate
             all_uks = list({*unique_keys, *fetched_uks})
+            afectados = _comercio_ids_de_filas(e, u, "unique_key", all_uks) + _comercio_ids_de_filas(e, u, "id", ids)
 
-            # Tombstone: store unique_keys in movimientos_ignorados (payload optional)
+            # Tombstone: store unique_keys in movimientos_borrados
+            _insert_rows(e, "movimientos_borrados", tomb_cols, [(u, uk) for uk in all_uks], tomb_conflict)
             if all_uks:
-                for uk in all_uks:
-                    e.execute(
-                        text("INSERT INTO movimientos_ignorados (unique_key) VALUES (:uk) ON CONFLICT (unique_key) DO NOTHING"),
-                        {"uk": uk},
-                    )
+                e.execute(
+                    text("DELETE FROM reembolsos WHERE usuario = :u AND (gasto_uk = ANY(:uks) OR abono_uk = ANY(:uks))"),
+                    {"u": u, "uks": all_uks},
+                )
 
-            # Delete by unique_key (batch) with dynamic expansion
+            # Delete by unique_key (batch, arreglo como parámetro)
             if all_uks:
-                uk_params = {}
-                uk_placeholders = []
-                for idx, uk in enumerate(all_uks):
-                    key = f"uk{idx}"
-                    uk_params[key] = uk
-                    uk_placeholders.append(f":{key}")
                 res1 = e.execute(
-                    text(f"DELETE FROM movimientos WHERE unique_key IN ({', '.join(uk_placeholders)})"),
-                    uk_params
+                    text("DELETE FROM movimientos WHERE usuario = :u AND unique_key = ANY(:uks)"),
+                    {"u": u, "uks": all_uks},
                 )
                 deleted += int(res1.rowcount or 0)
 
             # Also delete by id (in case they lacked unique_key)
             if ids:
-                id_params = {}
-                id_placeholders = []
-                for idx, i in enumerate(ids):
-                    key = f"id_del{idx}"
-                    id_params[key] = int(i)
-                    id_placeholders.append(f":{key}")
                 res2 = e.execute(
-                    text(f"DELETE FROM movimientos WHERE id IN ({', '.join(id_placeholders)})"),
-                    id_params
+                    text("DELETE FROM movimientos WHERE usuario = :u AND id = ANY(:ids)"),
+                    {"u": u, "ids": ids},
                 )
                 deleted += int(res2.rowcount or 0)
-
+            _refresh_comercio_stats(e, u, afectados)
+        _bump_stats_version(conn)
         return deleted
 
     # --- SQLite path ---
     deleted = 0
-    # If only IDs were provided, fetch their unique_keys for tombstones
-    fetched_uks = []
-    if ids:
-        rows = conn.execute(
-            f"SELECT id, unique_key FROM movimientos WHERE id IN ({','.join(['?']*len(ids))})",
-            ids,
-        ).fetchall()
-        fetched_uks = [r[1] for r in rows if r[1]]
+    with conn:
+        # If only IDs were provided, fetch their unique_keys for tombstones
+        fetched_uks = []
+        for placeholders, chunk in sqlite_in_chunks(ids, reserved=1):
+            rows = conn.execute(
+                f"SELECT id, unique_key FROM movimientos WHERE usuario = ? AND id IN ({placeholders})",
+                [u, *chunk],
+            ).fetchall()
+            fetched_uks += [r[1] for r in rows if r[1]]
+
+        all_uks = list({*unique_keys, *fetched_uks})
+        afectados = _comercio_ids_de_filas(conn, u, "unique_key", all_uks) + _comercio_ids_de_filas(conn, u, "id", ids)
+
+        # Tombstone: insert unique_keys into movimientos_borrados
+        _insert_rows(conn, "movimientos_borrados", tomb_cols, [(u, uk) for uk in all_uks], tomb_conflict)
+        for placeholders, chunk in sqlite_in_chunks(all_uks, reserved=1):
+            conn.execute(
+                f"DELETE FROM reembolsos WHERE usuario = ? AND (gasto_uk IN ({placeholders}) OR abono_uk IN ({placeholders}))",
+                [u, *chunk, *chunk],
+            )
+
+        # Delete by unique_key, then by id as fallback
+        for col, keys in (("unique_key", all_uks), ("id", ids)):
+            for placeholders, chunk in sqlite_in_chunks(keys, reserved=1):
+                cur = conn.execute(
+                    f"DELETE FROM movimientos WHERE usuario = ? AND {col} IN ({placeholders})",
+                    [u, *chunk],
+                )
+                deleted += int(cur.rowcount or 0)
+        _refresh_comercio_stats(conn, u, afectados)
+    _bump_stats_version(conn)
+    return deleted
 
-    all_uks = list({*unique_keys, *fetched_uks})
 
-    # Tombstone: insert unique_keys into movimientos_ignorados
-    for uk in all_uks:
-        try:
-            conn.execute(
-                "INSERT OR IGNORE INTO movimientos_ignorados (unique_key) VALUES (?)",
-                (uk,),
+# --- Movimientos ignorados: listado paginado y restauración en lote ---
+def list_ignored(conn, limit: int = 50, offset: int = 0) -> Tuple[pd.DataFrame, int]:
+    """
+    Página de movimientos ignorados proyectada desde las columnas tipadas
+    (sin decodificar payload). Devuelve (página, total).
+    """
+    limit = max(1, int(limit))
+    offset = max(0, int(offset))
+    q = (
+        "SELECT id, created_at, COALESCE(NULLIF(detalle, ''), detalle_norm, '') AS nombre, "
+        "COALESCE(NULLIF(monto_real, 0), monto) AS monto, veces, last_seen_at, unique_key "
+        "FROM movimientos_ignorados WHERE usuario = {u} ORDER BY created_at DESC, id DESC LIMIT {lim} OFFSET {off}"
+    )
+    u = get_usuario(conn)
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        engine = conn["engine"]
+        with engine.connect() as cx:
+            total = cx.execute(text("SELECT COUNT(*) FROM movimientos_ignorados WHERE usuario = :u"), {"u": u}).scalar() or 0
+            page = pd.read_sql_query(
+                text(q.format(u=":u", lim=":lim", off=":off")), cx, params={"u": u, "lim": limit, "off": offset}
             )
-        except Exception:
-            pass
+        return page, int(total)
+    total = conn.execute("SELECT COUNT(*) FROM movimientos_ignorados WHERE usuario = ?", (u,)).fetchone()[0] or 0
+    page = pd.read_sql_query(q.format(u="?", lim="?", off="?"), conn, params=(u, limit, offset))
+    return page, int(total)
+
+
+# Categoría de una fila ignorada: el categoria_id resuelto al ingerirla (en el payload), si la
+# categoría sigue existiendo; no se busca por nombre (pudo renombrarse o crearse otra con ese nombre).
+# El comercio se asigna después, canonicalizando detalle_norm.
+_IGNORED_CATEGORIA_ID = (
+    "(SELECT c.id FROM categorias c WHERE c.usuario = movimientos_ignorados.usuario "
+    "AND c.id = CAST({payload_categoria_id} AS INTEGER))"
+)
+# Restaurables: con payload, sin una fila viva con la misma clave y sin tombstone
+_IGNORED_RESTAURABLE = (
+    " AND NOT EXISTS (SELECT 1 FROM movimientos m WHERE m.usuario = movimientos_ignorados.usuario "
+    "AND m.unique_key = movimientos_ignorados.unique_key)"
+    " AND NOT EXISTS (SELECT 1 FROM movimientos_borrados b WHERE b.usuario = movimientos_ignorados.usuario "
+    "AND b.unique_key = movimientos_ignorados.unique_key)"
+)
+
+
+def restore_ignored(conn, ids: Optional[List[int]] = None) -> int:
+    """
+    Reincorpora a movimientos las filas ignoradas indicadas (todas si ids es None) con
+    INSERT ... SELECT (uno por bloque de ids en SQLite). Se omiten las filas sin payload, las
+    que tienen tombstone en movimientos_borrados y las que ya tienen una fila viva con su
+    unique_key (esa fila no se toca); las omitidas siguen en movimientos_ignorados.
+    Devuelve la cantidad de filas restauradas.
+    """
+    if ids is not None:
+        ids = [int(i) for i in ids if i is not None]
+        if not ids:
+            return 0
+
+    cols = (
+        "usuario, unique_key, fecha, detalle, detalle_norm, monto, categoria_id, nota_usuario, monto_real, "
+        "es_gasto, es_transferencia_o_abono, es_entre_cuentas, es_abono"
+    )
+    u = get_usuario(conn)
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        engine = conn["engine"]
+        params: Dict[str, Any] = {"u": u}
+        where = "usuario = :u AND payload IS NOT NULL"
+        if ids is not None:
+            params["ids"] = ids
+            where += " AND id = ANY(:ids)"
+        with engine.begin() as e:
+            params["ids"] = [r[0] for r in e.execute(text(
+                f"SELECT id FROM movimientos_ignorados WHERE {where}{_IGNORED_RESTAURABLE}"
+            ), params).fetchall()]
+            if not params["ids"]:
+                return 0
+            where = "usuario = :u AND id = ANY(:ids)"
+            if _pg_is_partitioned(e):
+                fechas = [r[0] for r in e.execute(text(
+                    f"SELECT DISTINCT fecha FROM movimientos_ignorados WHERE {where}"
+                ), params).fetchall()]
+                _pg_ensure_month_partitions(e, fechas)
+            categoria_id = _IGNORED_CATEGORIA_ID.format(payload_categoria_id="payload->>'categoria_id'")
+            res = e.execute(text(
+                f"""
+                INSERT INTO movimientos ({cols})
+                SELECT usuario, unique_key, fecha, detalle, detalle_norm, monto, {categoria_id},
+                       payload->>'nota_usuario', monto_real,
+                       (payload->>'es_gasto')::boolean, (payload->>'es_transferencia_o_abono')::boolean,
+                       (payload->>'es_entre_cuentas')::boolean, (payload->>'es_abono')::boolean
+                FROM movimientos_ignorados
+                WHERE {where}
+                ON CONFLICT DO NOTHING
+                """
+            ), params)
+            restored = int(res.rowcount or 0)
+            e.execute(text(f"DELETE FROM movimientos_ignorados WHERE {where}"), params)
+            _asignar_comercios(e, u)
+        _bump_stats_version(conn)
+        return restored
+
+    # SQLite: una pasada por bloque de ids (bajo el límite de variables), en una sola transacción
+    base = "usuario = ? AND payload IS NOT NULL"
+    categoria_id = _IGNORED_CATEGORIA_ID.format(payload_categoria_id="json_extract(payload, '$.categoria_id')")
+    restored = 0
+    with conn:
+        if ids is None:
+            elegibles = [r[0] for r in conn.execute(
+                f"SELECT id FROM movimientos_ignorados WHERE {base}{_IGNORED_RESTAURABLE}", (u,)
+            ).fetchall()]
+        else:
+            elegibles = []
+            for placeholders, chunk in sqlite_in_chunks(ids, reserved=1):
+                elegibles += [r[0] for r in conn.execute(
+                    f"SELECT id FROM movimientos_ignorados WHERE {base} AND id IN ({placeholders}){_IGNORED_RESTAURABLE}",
+                    [u, *chunk],
+                ).fetchall()]
+        for placeholders, chunk in sqlite_in_chunks(elegibles, reserved=1):
+            where = f"usuario = ? AND id IN ({placeholders})"
+            cur = conn.execute(
+                f"""
+                INSERT OR IGNORE INTO movimientos ({cols})
+                SELECT usuario, unique_key, fecha, detalle, detalle_norm, monto, {categoria_id},
+                       json_extract(payload, '$.nota_usuario'), monto_real,
+                       json_extract(payload, '$.es_gasto'), json_extract(payload, '$.es_transferencia_o_abono'),
+                       json_extract(payload, '$.es_entre_cuentas'), json_extract(payload, '$.es_abono')
+                FROM movimientos_ignorados
+                WHERE {where}
+                """,
+                [u, *chunk],
+            )
+            restored += int(cur.rowcount or 0)
+            conn.execute(f"DELETE FROM movimientos_ignorados WHERE {where}", [u, *chunk])
+        _asignar_comercios(conn, u)
+    _bump_stats_version(conn)
+    return restored
 
-    # Delete by unique_key (if any)
-    if all_uks:
-        conn.execute(
-            f"DELETE FROM movimientos WHERE unique_key IN ({','.join(['?']*len(all_uks))})",
-            all_uks,
-        )
-        deleted += conn.total_changes  # best effort
 
-    # Delete by id as fallback (if any)
-    if ids:
-        conn.execute(
-            f"DELETE FROM movimientos WHERE id IN ({','.join(['?']*len(ids))})",
-            ids,
-        )
-        deleted += conn.total_changes  # best effort
+def clear_ignored(conn) -> int:
+    u = get_usuario(conn)
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        engine = conn["engine"]
+        with engine.begin() as e:
+            res = e.execute(text("DELETE FROM movimientos_ignorados WHERE usuario = :u"), {"u": u})
+        return int(res.rowcount or 0)
+    with conn:
+        cur = conn.execute("DELETE FROM movimientos_ignorados WHERE usuario = ?", (u,))
+    return int(cur.rowcount or 0)
 
-    conn.commit()
-    return deleted
+
+def clear_transactions(conn) -> int:
+    """
+    Vacía los movimientos del usuario (sin tombstones) junto con sus pares de reembolsos, que
+    de otro modo bloquearían el reemparejamiento al volver a cargar las mismas filas.
+    Devuelve las filas borradas.
+    """
+    u = get_usuario(conn)
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        with conn["engine"].begin() as e:
+            e.execute(text("DELETE FROM reembolsos WHERE usuario = :u"), {"u": u})
+            res = e.execute(text("DELETE FROM movimientos WHERE usuario = :u"), {"u": u})
+            _refresh_comercio_stats(e, u, None)
+    else:
+        with conn:
+            conn.execute("DELETE FROM reembolsos WHERE usuario = ?", (u,))
+            res = conn.execute("DELETE FROM movimientos WHERE usuario = ?", (u,))
+            _refresh_comercio_stats(conn, u, None)
+    _bump_stats_version(conn)
+    return int(res.rowcount or 0)
 
 
+# --- Retención y compactación de movimientos_ignorados ---
+IGNORED_RETENTION_DAYS_DEFAULT = 180
+
+_IGNORED_COLS = (
+    "id, unique_key, fecha, detalle, detalle_norm, monto, monto_real, categoria, payload, created_at, veces, last_seen_at, usuario"
+)
+
+
+def ignored_retention_days() -> int:
+    """Días sin re-aparecer tras los cuales un registro de duplicado expira (env IGNORED_RETENTION_DAYS)."""
+    try:
+        return int(os.environ.get("IGNORED_RETENTION_DAYS", IGNORED_RETENTION_DAYS_DEFAULT))
+    except Exception:
+        return IGNORED_RETENTION_DAYS_DEFAULT
+
+
+def compact_ignored(conn, retention_days: Optional[int] = None, archive: bool = True) -> Dict[str, int]:
+    """
+    Mantención de movimientos_ignorados:
+      1) mueve tombstones heredados (filas sin payload) a movimientos_borrados,
+      2) colapsa los registros de una misma unique_key en uno solo, acumulando `veces` y
+         conservando el `last_seen_at` más reciente (el índice único (usuario, unique_key) y el
+         upsert de veces ya lo evitan al insertar; filas distintas nunca se fusionan),
+      3) archiva en movimientos_ignorados_archivo (o elimina, si archive=False) los
+         registros no vistos en `retention_days` días. Un valor <= 0 desactiva la expiración.
+
+    Devuelve los conteos de cada paso.
+    """
+    if retention_days is None:
+        retention_days = ignored_retention_days()
+    stats = {"tombstones": 0, "colapsados": 0, "expirados": 0}
+    params: Dict[str, Any] = {"u": get_usuario(conn), "d": int(retention_days)}
+
+    # Todo se limita al usuario de la conexión (índice (usuario, ...) en movimientos_ignorados)
+    mine = "usuario = :u AND payload IS NOT NULL"
+    con_clave = f"{mine} AND unique_key IS NOT NULL"
+    keep_ids = f"SELECT MAX(id) FROM movimientos_ignorados WHERE {con_clave} GROUP BY unique_key"
+    # Subconsultas correlacionadas en vez de UPDATE ... FROM (SQLite >= 3.33)
+    misma_clave = (
+        "FROM movimientos_ignorados o WHERE o.usuario = movimientos_ignorados.usuario "
+        "AND o.unique_key = movimientos_ignorados.unique_key AND o.payload IS NOT NULL"
+    )
+    legacy_tombstones = (
+        "INSERT INTO movimientos_borrados (usuario, unique_key) SELECT usuario, unique_key FROM movimientos_ignorados "
+        "WHERE usuario = :u AND payload IS NULL AND unique_key IS NOT NULL ON CONFLICT (usuario, unique_key) DO NOTHING"
+    )
+    steps = [
+        ("tombstones", "DELETE FROM movimientos_ignorados WHERE usuario = :u AND payload IS NULL"),
+        (None, f"UPDATE movimientos_ignorados SET "
+               f"veces = (SELECT SUM(COALESCE(o.veces, 1)) {misma_clave}), "
+               f"last_seen_at = (SELECT MAX(COALESCE(o.last_seen_at, o.created_at)) {misma_clave}) "
+               f"WHERE id IN ({keep_ids} HAVING COUNT(*) > 1)"),
+        ("colapsados", f"DELETE FROM movimientos_ignorados WHERE {con_clave} AND id NOT IN ({keep_ids})"),
+    ]
+
+    if isinstance(conn, dict) and conn.get("pg") and text is not None:
+        engine = conn["engine"]
+        stale = f"{mine} AND COALESCE(last_seen_at, created_at) < NOW() - make_interval(days => :d)"
+        with engine.begin() as e:
+            e.execute(text(legacy_tombstones), params)
+            for key, sql in steps:
+                n = int(e.execute(text(sql), params).rowcount or 0)
+                if key:
+                    stats[key] = n
+            if retention_days > 0:
+                if archive:
+                    e.execute(text(
+                        f"INSERT INTO movimientos_ignorados_archivo ({_IGNORED_COLS}) "
+                        f"SELECT {_IGNORED_COLS} FROM movimientos_ignorados WHERE {stale}"
+                    ), params)
+                stats["expirados"] = int(e.execute(text(f"DELETE FROM movimientos_ignorados WHERE {stale}"), params).rowcount or 0)
+        return stats
+
+    params["d"] = f"-{int(retention_days)} days"
+    stale = f"{mine} AND COALESCE(last_seen_at, created_at) < DATETIME('now', :d)"
+    with conn:
+        conn.execute(legacy_tombstones, params)
+        for key, sql in steps:
+            n = int(conn.execute(sql, params).rowcount or 0)
+            if key:
+                stats[key] = n
+        if retention_days > 0:
+            if archive:
+                conn.execute(
+                    f"INSERT INTO movimientos_ignorados_archivo ({_IGNORED_COLS}) "
+                    f"SELECT {_IGNORED_COLS} FROM movimientos_ignorados WHERE {stale}",
+                    params,
+                )
+            stats["expirados"] = int(conn.execute(f"DELETE FROM movimientos_ignorados WHERE {stale}", params).rowcount or 0)
+    return stats
+
+
+# --- Particionamiento mensual de movimientos (Postgres, opcional) ---
+def _pg_is_partitioned(e) -> bool:
+    return bool(e.execute(text(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('movimientos')"
+    )).scalar())
+
+
+def _pg_month_partition_ddl(month: pd.Timestamp, table: str = "movimientos") -> str:
+    start = month.strftime("%Y-%m-01")
+    end = (month + pd.offsets.MonthBegin(1)).strftime("%Y-%m-01")
+    name = f"{table}_p{month.strftime('%Y%m')}"
+    return (
+        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{start}') TO ('{end}')"
+    )
+
+
+def _pg_ensure_month_partitions(e, fechas) -> int:
+    """Crea (si faltan) las particiones mensuales para las fechas dadas. Los índices del padre se heredan."""
+    months = pd.to_datetime(pd.Series(list(fechas), dtype=object), errors="coerce").dropna().dt.to_period("M").unique()
+    for m in sorted(months):
+        e.execute(text(_pg_month_partition_ddl(m.to_timestamp())))
+    return len(months)
+
+
+def ensure_month_partitions(conn, fechas) -> int:
+    """Variante pública para inserciones fuera de upsert_transactions (no-op en SQLite o sin particiones)."""
+    if not (isinstance(conn, dict) and conn.get("pg") and text is not None):
+        return 0
+    with conn["engine"].begin() as e:
+        if not _pg_is_partitioned(e):
+            return 0
+        return _pg_ensure_month_partitions(e, fechas)
+
+
+def _pg_ensure_foreign_keys(e) -> None:
+    """Claves foráneas de _FOREIGN_KEYS; al borrar una categoría o comercio sus filas quedan en NULL."""
+    for tabla, col, ref in _FOREIGN_KEYS:
+        e.execute(text(
+            f"""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = '{tabla}_{col}_fkey') THEN
+                    ALTER TABLE {tabla} ADD CONSTRAINT {tabla}_{col}_fkey
+                        FOREIGN KEY ({col}) REFERENCES {ref}(id) ON DELETE SET NULL;
+                END IF;
+            END
+            $$;
+            """
+        ))
+
+
+def partition_movimientos_by_month(conn) -> int:
+    """
+    Migración opt-in (solo Postgres): convierte movimientos en una tabla particionada
+    por rango mensual sobre fecha. Copia los datos, crea una partición por mes presente
+    y una partición DEFAULT (fechas nulas), y recrea los índices en el padre para que
+    cada partición los herede.
+
+    Un índice único sobre la tabla particionada debe incluir fecha, y UNIQUE (usuario,
+    unique_key, fecha) no basta: fecha es TIMESTAMP y la misma clave con otra hora pasaría.
+    La unicidad de (usuario, unique_key) queda en movimientos_claves, mantenida por los
+    triggers de _PG_CLAVES_TRIGGERS, así que el ON CONFLICT DO NOTHING de las inserciones
+    sigue descartando duplicados. UNIQUE (usuario, unique_key, fecha) se conserva para las
+    búsquedas por clave.
+
+    Devuelve la cantidad de particiones mensuales creadas (0 si ya estaba particionada).
+    """
+    if not (isinstance(conn, dict) and conn.get("pg") and text is not None):
+        raise RuntimeError("El particionamiento mensual solo está disponible en Postgres")
+    engine = conn["engine"]
+    with engine.begin() as e:
+        if _pg_is_partitioned(e):
+            return 0
+        e.execute(text("ALTER TABLE movimientos RENAME TO movimientos_sin_particion"))
+        e.execute(text(
+            "CREATE TABLE movimientos (LIKE movimientos_sin_particion INCLUDING DEFAULTS) PARTITION BY RANGE (fecha)"
+        ))
+        e.execute(text("CREATE TABLE IF NOT EXISTS movimientos_default PARTITION OF movimientos DEFAULT"))
+        for ddl in _PG_CLAVES_TRIGGERS:
+            e.execute(text(ddl))
+        # La copia de abajo vuelve a reclamar cada clave
+        e.execute(text("DELETE FROM movimientos_claves"))
+        months = [r[0] for r in e.execute(text(
+            "SELECT DISTINCT date_trunc('month', fecha) FROM movimientos_sin_particion WHERE fecha IS NOT NULL"
+        )).fetchall()]
+        for m in months:
+            e.execute(text(_pg_month_partition_ddl(pd.Timestamp(m))))
+        e.execute(text("INSERT INTO movimientos SELECT * FROM movimientos_sin_particion"))
+        # Al borrar la tabla original se liberan los nombres de sus índices
+        e.execute(text("DROP TABLE movimientos_sin_particion"))
+        e.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS idx_movimientos_usuario_unique_key ON movimientos(usuario, unique_key, fecha)"))
+        e.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS idx_movimientos_default_usuario_unique_key ON movimientos_default(usuario, unique_key)"))
+        for ddl in _TENANT_INDEXES:
+            if " ON movimientos(" in ddl:
+                e.execute(text(ddl))
+        for ddl in _PG_PENDIENTE_TRIGGERS:
+            e.execute(text(ddl))
+        _pg_ensure_foreign_keys(e)
+    return len(months)
@@ -3,6 +3,7 @@
 Script de inicialización de la base de datos para Facto$
 """
 
+import argparse
 import os
 import sys
 from pathlib import Path
@@ -10,7 +11,11 @@ from pathlib import Path
 # Agregar el directorio actual al path para importar db
 sys.path.insert(0, str(Path(__file__).parent))
 
-from db import get_conn, init_db, replace_categories
+from db import (
+    get_conn, init_db, replace_categories, partition_movimientos_by_month, rebuild_comercio_stats,
+    rebuild_reimbursements, recanonicalize_comercios,
+)
+from classifier import retrain
 
 DEFAULT_CATEGORIES = [
     "Sin categoría",
@@ -36,6 +41,34 @@ DEFAULT_CATEGORIES = [
 ]
 
 def main():
+    ap = argparse.ArgumentParser(description="Inicializa la base de datos de Facto$")
+    ap.add_argument(
+        "--particionar-mensual",
+        action="store_true",
+        help="(Postgres) convierte movimientos en tabla particionada por mes sobre fecha",
+    )
+    ap.add_argument(
+        "--reconstruir-estadisticas",
+        action="store_true",
+        help="recalcula comercio_categoria_stats (movimientos por comercio y categoría) desde movimientos",
+    )
+    ap.add_argument(
+        "--reentrenar-clasificador",
+        action="store_true",
+        help="reentrena el clasificador de texto del usuario (APP_USUARIO) desde los movimientos categorizados",
+    )
+    ap.add_argument(
+        "--reemparejar-reembolsos",
+        action="store_true",
+        help="recalcula transferencias entre cuentas propias y pares gasto/reembolso tras cambiar config.json",
+    )
+    ap.add_argument(
+        "--recanonicalizar-comercios",
+        action="store_true",
+        help="recalcula las claves de comercio (APP_USUARIO) tras cambiar las reglas merchant_* de config.json",
+    )
+    args = ap.parse_args()
+
     print("🚀 Inicializando base de datos de Facto$...")
     
     # Obtener conexión (autodetecta Postgres vs SQLite)
@@ -57,6 +90,34 @@ def main():
     print("🌱 Sembrando categorías por defecto...")
     replace_categories(conn, DEFAULT_CATEGORIES)
     print(f"✅ {len(DEFAULT_CATEGORIES)} categorías sembradas")
+
+    if args.particionar_mensual:
+        if db_type != "Postgres":
+            print("⚠️ El particionamiento mensual solo aplica a Postgres; se omite")
+        else:
+            print("🧩 Particionando movimientos por mes...")
+            n = partition_movimientos_by_month(conn)
+            print(f"✅ {n} particiones mensuales creadas" if n else "✅ movimientos ya estaba particionada")
+
+    if args.reconstruir_estadisticas:
+        print("📈 Reconstruyendo estadísticas comercio -> categoría...")
+        n = rebuild_comercio_stats(conn)
+        print(f"✅ {n} filas en comercio_categoria_stats")
+
+    if args.reentrenar_clasificador:
+        print("🧠 Reentrenando clasificador de categorías...")
+        n = retrain(conn)
+        print(f"✅ {n} conteos en clasificador_conteos")
+
+    if args.reemparejar_reembolsos:
+        print("🔁 Reemparejando reembolsos...")
+        n = rebuild_reimbursements(conn)
+        print(f"✅ {n} pares en reembolsos")
+
+    if args.recanonicalizar_comercios:
+        print("🏪 Recalculando claves de comercio...")
+        n = recanonicalize_comercios(conn)
+        print(f"✅ {n} comercios fusionados o variantes separadas")
     
     print(f"\n🎉 Base de datos {db_type} inicializada correctamente!")
     print("Puedes ejecutar 'streamlit run app.py' para iniciar la aplicación")
@@ -0,0 +1,170 @@
+"""
+Master del pipeline CSV (update_master.py) en Parquet particionado por mes.
+
+Estructura bajo la raíz (por defecto data/master/):
+
+    mes=YYYY-MM/part-00000.parquet ...   filas del mes; cada corrida agrega archivos, no reescribe
+    mes=sin-fecha/...                    filas sin fecha válida
+    _ids.parquet                         índice id -> mes
+    _matches.parquet                     pares de reembolso: id del abono -> match_id (id del gasto)
+
+Agregar filas solo escribe en las particiones de sus meses; los dos índices (solo ids, pequeños)
+se reemplazan de forma atómica, después de las particiones. La deduplicación consulta _ids.parquet sin leer filas, y read()
+carga solo las particiones que cruzan la ventana de fechas pedida (y solo las columnas
+pedidas). match_id vive aparte, en _matches.parquet: un gasto nuevo puede emparejarse con un
+abono ya escrito sin reescribir su partición.
+
+pyarrow está en requirements.txt; si falta, PARQUET_DISPONIBLE es False, MasterStore falla con un
+mensaje claro y update_master.py / pipeline.py siguen funcionando con --master data/master.csv.
+"""
+
+import os
+import re
+from pathlib import Path
+from typing import List, Optional
+
+import pandas as pd
+
+try:
+    import pyarrow.parquet as pq  # también es el motor de DataFrame.to_parquet / pd.read_parquet
+    PARQUET_DISPONIBLE = True
+except Exception:  # pyarrow is optional locally
+    pq = None
+    PARQUET_DISPONIBLE = False
+
+SIN_FECHA = "sin-fecha"
+_PARTICION = re.compile(r"^mes=(\d{4}-\d{2}|" + SIN_FECHA + r")$")
+
+
+def _escribir_atomico(df: pd.DataFrame, ruta: Path) -> None:
+    tmp = ruta.with_name(ruta.name + ".tmp")
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, ruta)
+
+
+class MasterStore:
+    """Master particionado por mes bajo `raiz`; ver el docstring del módulo."""
+
+    def __init__(self, raiz):
+        if not PARQUET_DISPONIBLE:
+            raise RuntimeError("El master Parquet requiere pyarrow (pip install pyarrow)")
+        self.raiz = Path(raiz)
+        self._ids: Optional[pd.DataFrame] = None
+        self._matches: Optional[pd.DataFrame] = None
+
+    # --- índices -----------------------------------------------------------------------------
+
+    def _indice(self) -> pd.DataFrame:
+        if self._ids is None:
+            ruta = self.raiz / "_ids.parquet"
+            self._ids = pd.read_parquet(ruta) if ruta.exists() else pd.DataFrame({"id": pd.Series(dtype=str), "mes": pd.Series(dtype=str)})
+        return self._ids
+
+    def _pares(self) -> pd.DataFrame:
+        if self._matches is None:
+            ruta = self.raiz / "_matches.parquet"
+            self._matches = pd.read_parquet(ruta) if ruta.exists() else pd.DataFrame({"id": pd.Series(dtype=str), "match_id": pd.Series(dtype=str)})
+        return self._matches
+
+    def __len__(self) -> int:
+        return len(self._indice())
+
+    def contains(self, ids: pd.Series) -> pd.Series:
+        """Máscara de los ids que ya están en el master (solo consulta el índice)."""
+        return ids.astype(str).isin(self._indice()["id"])
+
+    def matched_ids(self) -> set:
+        """Ids de gastos y abonos que ya tienen pareja de reembolso."""
+        pares = self._pares()
+        return set(pares["id"]) | set(pares["match_id"])
+
+    # --- lectura -----------------------------------------------------------------------------
+
+    def months(self, desde=None, hasta=None) -> List[str]:
+        """Particiones (YYYY-MM) presentes que cruzan [desde, hasta]; sin ventana, todas (y sin-fecha)."""
+        if not self.raiz.exists():
+            return []
+        meses = sorted(m.group(1) for m in (_PARTICION.match(p.name) for p in self.raiz.iterdir() if p.is_dir()) if m)
+        if desde is None and hasta is None:
+            return meses
+        lo = pd.Timestamp(desde).strftime("%Y-%m") if desde is not None else "0000-00"
+        hi = pd.Timestamp(hasta).strftime("%Y-%m") if hasta is not None else "9999-99"
+        return [m for m in meses if m != SIN_FECHA and lo <= m <= hi]
+
+    def read(self, desde=None, hasta=None, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Filas del master; con desde/hasta solo se abren las particiones de esos meses y se
+        filtra por fecha. `columns` limita las columnas leídas; match_id se une desde
+        _matches.parquet cuando se pide (o sin `columns`).
+        """
+        leer = None if columns is None else [c for c in dict.fromkeys(["id", "fecha", *columns]) if c != "match_id"]
+        partes = []
+        for mes in self.months(desde, hasta):
+            for archivo in sorted((self.raiz / f"mes={mes}").glob("part-*.parquet")):
+                # Archivos de corridas anteriores pueden no traer columnas agregadas después
+                cols = None if leer is None else [c for c in leer if c in pq.read_schema(archivo).names]
+                partes.append(pd.read_parquet(archivo, columns=cols))
+        partes = [p for p in partes if len(p)]
+        if not partes:
+            return pd.DataFrame(columns=(columns if columns is not None else ["id", "fecha", "match_id"]))
+        df = pd.concat(partes, ignore_index=True)
+        if desde is not None or hasta is not None:
+            fechas = pd.to_datetime(df["fecha"], errors="coerce")
+            ok = fechas.notna()
+            if desde is not None:
+                ok &= fechas >= pd.Timestamp(desde)
+            if hasta is not None:
+                ok &= fechas <= pd.Timestamp(hasta)
+            df = df[ok].reset_index(drop=True)
+        if columns is None or "match_id" in columns:
+            pares = self._pares().drop_duplicates("id").set_index("id")["match_id"]
+            df["match_id"] = df["id"].astype(str).map(pares)
+        return df if columns is None else df.reindex(columns=list(columns))
+
+    # --- escritura ---------------------------------------------------------------------------
+
+    def append(self, df: pd.DataFrame) -> int:
+        """
+        Agrega las filas cuyo id no está en el master (un archivo nuevo por mes afectado) y
+        actualiza el índice después de escribir las particiones; los ids que ya estaban en la
+        partición se saltan. match_id no se guarda en las filas: ver add_matches. Devuelve las
+        filas agregadas.
+        """
+        if df.empty:
+            return 0
+        df = df.drop(columns=["match_id"], errors="ignore")
+        df = df[~self.contains(df["id"])].drop_duplicates(subset=["id"])
+        if df.empty:
+            return 0
+        fechas = pd.to_datetime(df["fecha"], errors="coerce")
+        meses = fechas.dt.strftime("%Y-%m").fillna(SIN_FECHA)
+        agregadas = 0
+        for mes, filas in df.groupby(meses.to_numpy(), sort=True):
+            carpeta = self.raiz / f"mes={mes}"
+            carpeta.mkdir(parents=True, exist_ok=True)
+            archivos = sorted(carpeta.glob("part-*.parquet"))
+            # Una corrida interrumpida pudo escribir la partición sin llegar a _ids.parquet: esas
+            # filas no se repiten y sus ids entran al índice junto con los nuevos
+            if archivos:
+                en_disco = pd.concat([pd.read_parquet(a, columns=["id"]) for a in archivos])["id"].astype(str)
+                filas = filas[~filas["id"].astype(str).isin(en_disco)]
+            if len(filas):
+                _escribir_atomico(filas.reset_index(drop=True), carpeta / f"part-{len(archivos):05d}.parquet")
+                agregadas += len(filas)
+        nuevos = pd.DataFrame({"id": df["id"].astype(str).to_numpy(), "mes": meses.to_numpy()})
+        self._ids = pd.concat([self._indice(), nuevos], ignore_index=True)
+        _escribir_atomico(self._ids, self.raiz / "_ids.parquet")
+        return agregadas
+
+    def add_matches(self, pares: pd.DataFrame) -> int:
+        """Agrega pares (id del abono, match_id = id del gasto); devuelve los pares agregados."""
+        if pares.empty:
+            return 0
+        pares = pd.DataFrame({"id": pares["id"].astype(str), "match_id": pares["match_id"].astype(str)})
+        pares = pares[~pares["id"].isin(self._pares()["id"])]
+        if pares.empty:
+            return 0
+        self.raiz.mkdir(parents=True, exist_ok=True)
+        self._matches = pd.concat([self._pares(), pares], ignore_index=True)
+        _escribir_atomico(self._matches, self.raiz / "_matches.parquet")
+        return len(pares)
@@ -0,0 +1,92 @@
+"""
+Emparejamiento gasto <-> abono (reembolsos), uno a uno.
+
+Un abono compensa un gasto previo cuando su monto difiere a lo más `tol` y llega dentro de
+`window_days` días desde el gasto. Los gastos se ordenan por (tramo de monto de ancho tol,
+día) y, para cada abono, np.searchsorted entrega en los tres tramos vecinos la ventana de
+fechas [fecha - window_days, fecha]: solo se generan pares candidatos reales, en
+O((n + pares) log n). La asignación es voraz: menor diferencia de monto, luego el gasto más
+reciente y luego el abono más antiguo; cada gasto y cada abono se usa una sola vez.
+
+Lo usan update_master.match_reimbursements (master CSV) y db (tabla reembolsos, al ingerir).
+"""
+
+from typing import Optional, Tuple
+
+import numpy as np
+
+_NS_POR_DIA = 86_400_000_000_000
+
+
+def match_pairs(
+    g_ns: np.ndarray,
+    g_monto: np.ndarray,
+    a_ns: np.ndarray,
+    a_monto: np.ndarray,
+    window_days: float = 21,
+    tol: float = 1000,
+    g_nuevo: Optional[np.ndarray] = None,
+    a_nuevo: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Pares (índice de gasto, índice de abono, diferencia de monto) sobre los arreglos de
+    entrada: fechas en nanosegundos (int64) y montos en valor absoluto. Con g_nuevo/a_nuevo
+    solo se consideran pares donde al menos un lado es nuevo (emparejamiento incremental).
+    """
+    vacio = (np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=float))
+    g_ns = np.asarray(g_ns, dtype=np.int64)
+    a_ns = np.asarray(a_ns, dtype=np.int64)
+    g_monto = np.abs(np.asarray(g_monto, dtype=float))
+    a_monto = np.abs(np.asarray(a_monto, dtype=float))
+    if not len(g_ns) or not len(a_ns):
+        return vacio
+
+    ventana_ns = int(round(float(window_days) * _NS_POR_DIA))
+    ancho = float(tol) if tol > 0 else 1.0
+    g_tramo = np.floor(g_monto / ancho).astype(np.int64)
+    a_tramo = np.floor(a_monto / ancho).astype(np.int64)
+    g_dia = g_ns // _NS_POR_DIA
+    a_dia = a_ns // _NS_POR_DIA
+    w_dias = -(-ventana_ns // _NS_POR_DIA)
+    d0 = int(min(g_dia.min(), a_dia.min())) - w_dias - 1
+    span = int(max(g_dia.max(), a_dia.max())) - d0 + 2
+
+    orden = np.lexsort((g_dia, g_tramo))
+    clave = g_tramo[orden] * span + (g_dia[orden] - d0)
+
+    # Ventanas (abono, tramo vecino) -> rango [lo, hi) en los gastos ordenados
+    vecinos = np.array([-1, 0, 1], dtype=np.int64)
+    base = (a_tramo[:, None] + vecinos[None, :]) * span
+    lo = np.searchsorted(clave, (base + (a_dia - w_dias - d0)[:, None]).ravel(), side="left")
+    hi = np.searchsorted(clave, (base + (a_dia - d0)[:, None]).ravel(), side="right")
+    n = hi - lo
+    total = int(n.sum())
+    if total == 0:
+        return vacio
+    par_a = np.repeat(np.repeat(np.arange(len(a_ns)), len(vecinos)), n)
+    par_g = orden[np.repeat(lo - np.cumsum(n) + n, n) + np.arange(total)]
+
+    # Filtro exacto: tolerancia de monto y ventana con la hora completa
+    diff = np.abs(g_monto[par_g] - a_monto[par_a])
+    ok = (diff <= tol) & (g_ns[par_g] <= a_ns[par_a]) & (g_ns[par_g] >= a_ns[par_a] - ventana_ns)
+    if g_nuevo is not None or a_nuevo is not None:
+        nuevo = np.zeros(len(par_g), dtype=bool)
+        if g_nuevo is not None:
+            nuevo |= np.asarray(g_nuevo, dtype=bool)[par_g]
+        if a_nuevo is not None:
+            nuevo |= np.asarray(a_nuevo, dtype=bool)[par_a]
+        ok &= nuevo
+    par_a, par_g, diff = par_a[ok], par_g[ok], diff[ok]
+    prioridad = np.lexsort((a_ns[par_a], -g_ns[par_g], diff))
+
+    usados_g, usados_a = set(), set()
+    elegidos = []
+    for k in prioridad.tolist():
+        ig, ia = int(par_g[k]), int(par_a[k])
+        if ig in usados_g or ia in usados_a:
+            continue
+        usados_g.add(ig)
+        usados_a.add(ia)
+        elegidos.append(k)
+    elegidos = np.array(elegidos, dtype=np.int64)
+    return par_g[elegidos], par_a[elegidos], diff[elegidos]
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Pipeline prep -> master en un solo proceso.
+
+Uso:
+    python pipeline.py --in banco1.csv banco2.csv                    (master Parquet en data/master)
+    python pipeline.py --in banco.csv --master data/master.csv --std-out data/standardized.csv
+
+Cada CSV crudo se estandariza (prep.py) y el DataFrame pasa en memoria a las etapas de
+update_master.py: dedup por id, flags + merchant map, transferencias entre cuentas propias,
+master, reembolsos y aprendizaje del merchant_map. No hay ida y vuelta por
+data/standardized.csv: fechas y montos no se re-serializan como texto ni se vuelven a
+parsear. --std-out escribe ese CSV intermedio solo si se pide. Al final se imprime el tiempo
+y las filas de cada etapa.
+"""
+
+import argparse
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional
+
+import pandas as pd
+
+# Agregar el directorio actual al path para importar prep y update_master
+sys.path.insert(0, str(Path(__file__).parent))
+
+import prep
+import update_master as um
+from rules import flag_rules, merchant_rules
+
+
+class Etapas:
+    """Tiempo (ms) y filas de entrada/salida por etapa, en orden de ejecución."""
+
+    def __init__(self):
+        self.filas: List[tuple] = []
+
+    @contextmanager
+    def medir(self, nombre: str, entrada: Optional[int] = None):
+        info = {"entrada": entrada, "salida": None, "nota": ""}
+        t0 = time.perf_counter()
+        yield info
+        self.filas.append((nombre, info["entrada"], info["salida"], (time.perf_counter() - t0) * 1000.0, info["nota"]))
+
+    def reporte(self) -> str:
+        fmt = lambda n: "-" if n is None else f"{n:,}"
+        lineas = [f"  {'Etapa':<28}{'Entrada':>10}{'Salida':>10}{'ms':>10}"]
+        for nombre, entrada, salida, ms, nota in self.filas:
+            lineas.append(f"  {nombre:<28}{fmt(entrada):>10}{fmt(salida):>10}{ms:>10.1f}  {nota}".rstrip())
+        total = sum(f[3] for f in self.filas)
+        lineas.append(f"  {'Total':<28}{'':>10}{'':>10}{total:>10.1f}")
+        return "\n".join(lineas)
+
+
+def standardized_frames(inputs: Iterable[str], reglas, etapas: Etapas) -> Iterator[pd.DataFrame]:
+    """Un DataFrame estandarizado (prep.standardize) por CSV crudo, a medida que se leen."""
+    for ruta in inputs:
+        with etapas.medir(f"prep {Path(ruta).name}") as e:
+            std = prep.standardize(prep.read_bank_csv(ruta), reglas)
+            e["salida"] = len(std)
+        yield std
+
+
+def run_pipeline(inputs: List[str], master: str, mmap: str, config_path: str, std_out: Optional[str] = None) -> Etapas:
+    """Ejecuta todas las etapas y devuelve sus tiempos y conteos."""
+    etapas = Etapas()
+    um.DATA.mkdir(parents=True, exist_ok=True)
+    merchant_map = um.load_json(mmap, {})
+    config = um.load_json(config_path, um.DEFAULT_CONFIG)
+    reglas = flag_rules(config_path)
+
+    with etapas.medir("abrir master") as e:
+        if master.lower().endswith(".csv"):
+            store, df_master = None, um.load_csv_master(master, [])
+            e["salida"] = len(df_master)
+        else:
+            store, df_master = um.open_master_store(master), None
+            e["salida"] = len(store)
+
+    # Dedup por archivo a medida que llegan: contra el master y contra los archivos anteriores
+    nuevos, estandarizados, vistos = [], [], set()
+    for std in standardized_frames(inputs, reglas, etapas):
+        if std_out:
+            estandarizados.append(std)
+        with etapas.medir("dedup", len(std)) as e:
+            df = um.drop_known_ids(std, store, df_master)
+            df = df[~df["id"].astype(str).isin(vistos)].drop_duplicates(subset=["id"])
+            vistos.update(df["id"].astype(str))
+            nuevos.append(df)
+            e["salida"] = len(df)
+    if std_out and estandarizados:
+        Path(std_out).parent.mkdir(parents=True, exist_ok=True)
+        pd.concat(estandarizados, ignore_index=True).to_csv(std_out, index=False, encoding="utf-8")
+    nuevos = [df for df in nuevos if len(df)]
+    df_new = pd.concat(nuevos, ignore_index=True) if nuevos else pd.DataFrame(columns=["id", "fecha", "monto", "detalle_norm", "categoria"])
+
+    with etapas.medir("flags + merchant map", len(df_new)) as e:
+        df_new = um.apply_flags(df_new, reglas)
+        df_new = um.apply_merchant_map(df_new, merchant_rules(mmap))
+        e["salida"] = len(df_new)
+        e["nota"] = f"{int(df_new['categoria'].notna().sum()):,} con categoría"
+    with etapas.medir("transferencias propias", len(df_new)) as e:
+        df_new = um.mark_own_transfers(df_new, [a.upper() for a in config.get("account_aliases", [])])
+        e["salida"] = len(df_new)
+        e["nota"] = f"{int(df_new['es_entre_cuentas'].sum()):,} entre cuentas"
+
+    if store is not None:
+        with etapas.medir("master (agregar)", len(df_new)) as e:
+            e["salida"] = um.append_parquet_master(df_new, store)
+            e["nota"] = f"{len(store):,} en total"
+        with etapas.medir("reembolsos (ventana)", len(df_new)) as e:
+            e["salida"] = um.match_parquet_window(df_new, store, config)
+            e["nota"] = "pares nuevos"
+        with etapas.medir("leer para aprender") as e:
+            df_aprender = store.read(columns=["fecha", "detalle_norm", "categoria"])
+            e["salida"] = len(df_aprender)
+    else:
+        with etapas.medir("reembolsos", len(df_new)) as e:
+            df_all = um.match_reimbursements(um.merge_csv_master(df_new, df_master), *um.reimbursement_params(config))
+            e["salida"] = int(df_all["match_id"].notna().sum())
+            e["nota"] = "pares en el historial"
+        with etapas.medir("master (escribir csv)", len(df_all)) as e:
+            df_aprender = um.write_csv_master(df_all, master)
+            e["salida"] = len(df_aprender)
+
+    with etapas.medir("aprender merchant_map", len(df_aprender)) as e:
+        nuevas, cambiadas, aprendidas = um.update_merchant_map(df_aprender, merchant_map, mmap, config)
+        e["salida"] = aprendidas
+        e["nota"] = f"{nuevas} nuevas, {cambiadas} cambiadas"
+    return etapas
+
+
+def main():
+    ap = argparse.ArgumentParser(description="prep.py + update_master.py en un solo proceso")
+    ap.add_argument("--in", dest="inputs", nargs="+", required=True, help="CSV crudos del banco")
+    ap.add_argument("--master", dest="master", default="data/master",
+        help="Directorio del master Parquet particionado por mes (requiere pyarrow) o ruta de un master .csv")
+    ap.add_argument("--merchant-map", dest="mmap", default="data/merchant_map.json")
+    ap.add_argument("--config", dest="config", default="data/config.json")
+    ap.add_argument("--std-out", dest="std_out", default=None, help="Escribe también el CSV estandarizado intermedio")
+    args = ap.parse_args()
+
+    etapas = run_pipeline(args.inputs, args.master, args.mmap, args.config, args.std_out)
+    print(f"Master actualizado: {args.master}")
+    print(etapas.reporte())
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,8 @@ import pandas as pd, numpy as np, re, io, chardet, argparse, json
 from pathlib import Path
 from datetime import datetime
 
+from rules import CONFIG_PATH, FlagRules, flag_rules
+
 def sniff_encoding(p):
     raw = Path(p).read_bytes()
     return chardet.detect(raw)['encoding'] or 'utf-8'
@@ -66,7 +68,12 @@ def detect_header_and_read(raw_text):
         df = pd.read_csv(io.StringIO(raw_text), delimiter=delim, dtype=str)
     return df
 
-def standardize(df):
+def read_bank_csv(p):
+    # CSV crudo del banco -> DataFrame de texto (encoding, delimitador y fila de encabezado detectados)
+    raw_text = Path(p).read_text(encoding=sniff_encoding(p), errors='replace')
+    return detect_header_and_read(raw_text)
+
+def standardize(df, reglas=None):
     df = df.loc[:, ~df.columns.str.contains(r'^Unnamed', na=False)]
     # candidate cols
     cand_date = [c for c in df.columns if re.search(r'fech', c, flags=re.I)]
@@ -106,16 +113,11 @@ def standardize(df):
     # Standard: gasto = negativo (sale plata), abono = positivo (entra)
     std['monto'] = signed
 
-    # Flags heurísticos
-    TRANSFER_PATTERNS = [r"\bTRASPAS", r"\bTRANSFER", r"\bABONO\b", r"\bREEMB", r"\bREVERSA", r"\bCASHBACK", r"\bPAGO T", r"\bPAGO TARJ"]
-    SHARED_PATTERNS = [r"\bDIVIDID", r"\bCOMPARTID", r"\bAMIGOS\b"]
-
-    def has(patterns, text):
-        t = norm_text(text)
-        return any(re.search(p, t) for p in patterns)
-
-    std['es_transferencia_o_abono'] = std['detalle'].apply(lambda s: has(TRANSFER_PATTERNS, s))
-    std['es_compartido_posible'] = std['detalle'].apply(lambda s: has(SHARED_PATTERNS, s))
+    # Flags heurísticos: palabras clave de config.json (rules.FlagRules), sobre detalle_norm
+    reglas = reglas if isinstance(reglas, FlagRules) else flag_rules(reglas)
+    marcas = reglas.flags(std['detalle_norm'])
+    std['es_transferencia_o_abono'] = marcas['es_transferencia_o_abono']
+    std['es_compartido_posible'] = marcas['es_compartido_posible']
 
     std['categoria'] = None
     std['fraccion_mia'] = np.where(std['es_compartido_posible'], 0.5, 1.0)
@@ -138,12 +140,10 @@ def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--in", dest="inp", required=True, help="Ruta del CSV crudo del banco")
     ap.add_argument("--out", dest="outp", default="data/standardized.csv", help="Ruta de salida estandarizada")
+    ap.add_argument("--config", dest="config", default=CONFIG_PATH, help="config.json con transfer_keywords/shared_keywords")
     args = ap.parse_args()
 
-    enc = sniff_encoding(args.inp)
-    raw_text = Path(args.inp).read_text(encoding=enc, errors='replace')
-    df = detect_header_and_read(raw_text)
-    std = standardize(df)
+    std = standardize(read_bank_csv(args.inp), flag_rules(args.config))
     Path(args.outp).parent.mkdir(parents=True, exist_ok=True)
     std.to_csv(args.outp, index=False, encoding='utf-8')
     print(f"OK: {args.outp} ({len(std)} filas)")
@@ -0,0 +1,211 @@
+"""
+Reglas por subcadena sobre el detalle normalizado.
+
+merchant_map.json: "si el detalle contiene CLAVE -> categoría".
+
+Las claves se compilan una vez en un autómata Aho–Corasick (trie + enlaces de falla), así
+cada detalle se recorre en una sola pasada sin importar cuántas reglas haya. Gana la primera
+regla del mapa (orden del JSON) que aparece en el texto, igual que el recorrido clave por
+clave de antes. El autómata compilado se guarda en caché por archivo y mtime: solo se
+recompila cuando merchant_map.json cambia.
+
+Lo usan update_master.apply_merchant_map (pipeline CSV) y db.lookup_merchant_rules, que en la
+app solo alimenta la sugerencia "Regla de comercio" (no asigna categoría al ingerir).
+
+Flags por palabras clave (transfer_keywords, shared_keywords y account_aliases de
+config.json): cada lista se compila a una sola expresión regular alternada por flag y se
+evalúa vectorizada con Series.str.contains sobre el detalle ya normalizado. Lo comparten
+prep.standardize, update_master.main y la ingesta de la app.
+"""
+
+import json
+import os
+import re
+import threading
+import unicodedata
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
+
+# Flag -> (lista en config.json, palabras por defecto, ¿calza solo al inicio de una palabra?);
+# los alias de cuentas propias calzan en cualquier parte (como update_master.mark_own_transfers)
+FLAG_KEYWORDS: Dict[str, Tuple[str, List[str], bool]] = {
+    "es_transferencia_o_abono": (
+        "transfer_keywords",
+        ["TRASPAS", "TRANSFER", "ABONO", "REEMB", "REVERSA", "CASHBACK", "PAGO T", "PAGO TARJ"],
+        True,
+    ),
+    "es_compartido_posible": ("shared_keywords", ["DIVIDID", "COMPARTID", "AMIGOS"], True),
+    "es_entre_cuentas": ("account_aliases", [], False),
+}
+
+_LOCK = threading.Lock()
+_CACHE: Dict[Tuple[str, Optional[Callable[[str], str]]], Tuple[Tuple[int, int], "MerchantRules"]] = {}
+_FLAG_CACHE: Dict[str, Tuple[Tuple[int, int], "FlagRules"]] = {}
+
+
+class SubstringMatcher:
+    """Autómata Aho–Corasick sobre `claves`; first_match devuelve el índice de la clave de menor índice presente."""
+
+    def __init__(self, claves: List[str]):
+        self.claves = list(claves)
+        goto: List[Dict[str, int]] = [{}]
+        # Mejor (menor) índice de clave que termina en cada estado, -1 si ninguna
+        salida: List[int] = [-1]
+        for i, clave in enumerate(self.claves):
+            if not clave:
+                continue
+            s = 0
+            for ch in clave:
+                nxt = goto[s].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[s][ch] = nxt
+                    goto.append({})
+                    salida.append(-1)
+                s = nxt
+            if salida[s] < 0:
+                salida[s] = i
+        # Enlaces de falla por anchura; cada estado hereda la mejor salida de su sufijo
+        falla = [0] * len(goto)
+        cola = list(goto[0].values())
+        for s in cola:
+            for ch, t in goto[s].items():
+                f = falla[s]
+                while f and ch not in goto[f]:
+                    f = falla[f]
+                falla[t] = goto[f].get(ch, 0)
+                heredada = salida[falla[t]]
+                if heredada >= 0 and (salida[t] < 0 or heredada < salida[t]):
+                    salida[t] = heredada
+                cola.append(t)
+        self._goto, self._falla, self._salida = goto, falla, salida
+
+    def first_match(self, texto: str) -> int:
+        goto, falla, salida = self._goto, self._falla, self._salida
+        s, mejor = 0, -1
+        for ch in texto:
+            while s and ch not in goto[s]:
+                s = falla[s]
+            s = goto[s].get(ch, 0)
+            o = salida[s]
+            if o >= 0 and (mejor < 0 or o < mejor):
+                mejor = o
+                if mejor == 0:
+                    break
+        return mejor
+
+    def match(self, textos: pd.Series) -> pd.Series:
+        """Índice de la regla ganadora por fila (-1 sin regla); cada texto distinto se recorre una vez."""
+        if textos.empty or not self.claves:
+            return pd.Series(-1, index=textos.index, dtype=int)
+        codes, uniques = pd.factorize(textos.fillna("").astype(str))
+        por_unico = pd.Series([self.first_match(t) for t in uniques], dtype=int)
+        return pd.Series(por_unico.to_numpy()[codes], index=textos.index, dtype=int)
+
+
+class MerchantRules:
+    """merchant_map compilado: clave (ya normalizada) -> categoría, en el orden del mapa."""
+
+    def __init__(self, merchant_map: Dict[str, str], normalizar: Optional[Callable[[str], str]] = None):
+        claves: List[str] = []
+        categorias: List[str] = []
+        vistas = set()
+        for clave, categoria in merchant_map.items():
+            k = normalizar(clave) if normalizar else str(clave)
+            if not k or k in vistas or not isinstance(categoria, str) or not categoria.strip():
+                continue
+            vistas.add(k)
+            claves.append(k)
+            categorias.append(categoria.strip())
+        self.matcher = SubstringMatcher(claves)
+        self.categorias = categorias
+
+    def __len__(self) -> int:
+        return len(self.categorias)
+
+    def categorize(self, textos: pd.Series) -> pd.Series:
+        """Categoría de la primera regla contenida en cada texto, o None."""
+        idx = self.matcher.match(textos)
+        cats = pd.Series(self.categorias + [None], dtype=object)
+        return pd.Series(cats.to_numpy()[idx.to_numpy()], index=textos.index, dtype=object)
+
+
+def merchant_rules(path, normalizar: Optional[Callable[[str], str]] = None) -> MerchantRules:
+    """
+    Reglas compiladas de un merchant_map.json, en caché por (ruta, normalizador) y validadas
+    por mtime y tamaño del archivo. Sin archivo (o ilegible) devuelve un conjunto vacío.
+    """
+    ruta = os.path.abspath(str(path))
+    try:
+        st = os.stat(ruta)
+        firma = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return MerchantRules({})
+    clave = (ruta, normalizar)
+    with _LOCK:
+        hit = _CACHE.get(clave)
+    if hit is not None and hit[0] == firma:
+        return hit[1]
+    try:
+        with open(ruta, encoding="utf-8") as fh:
+            reglas = MerchantRules(json.load(fh), normalizar)
+    except (OSError, ValueError):
+        reglas = MerchantRules({})
+    with _LOCK:
+        _CACHE[clave] = (firma, reglas)
+    return reglas
+
+
+def _palabra_clave(s: str) -> str:
+    """Mayúsculas, sin acentos y con espacios colapsados (como prep.norm_text)."""
+    s = unicodedata.normalize("NFD", str(s))
+    s = "".join(ch for ch in s if unicodedata.category(ch) != "Mn")
+    return re.sub(r"\s+", " ", s).strip().upper()
+
+
+class FlagRules:
+    """Una expresión regular alternada por flag (insensible a mayúsculas)."""
+
+    def __init__(self, config: Optional[Dict] = None):
+        config = config or {}
+        self.patrones: Dict[str, "re.Pattern[str]"] = {}
+        for flag, (clave, defecto, inicio) in FLAG_KEYWORDS.items():
+            palabras = sorted({_palabra_clave(p) for p in config.get(clave, defecto) if str(p).strip()}, key=len, reverse=True)
+            alternativas = "|".join(re.escape(p) for p in palabras) or "(?!)"
+            self.patrones[flag] = re.compile(rf"\b(?:{alternativas})" if inicio else alternativas, re.IGNORECASE)
+
+    def flags(self, textos: pd.Series) -> pd.DataFrame:
+        """Un booleano por flag y fila; cada texto distinto se evalúa una vez."""
+        codes, uniques = pd.factorize(textos.fillna("").astype(str))
+        unicos = pd.Series(uniques, dtype=object)
+        return pd.DataFrame(
+            {flag: unicos.str.contains(rx).to_numpy(dtype=bool)[codes] if len(unicos) else np.zeros(0, dtype=bool)
+             for flag, rx in self.patrones.items()},
+            index=textos.index,
+        )
+
+
+def flag_rules(path=None) -> FlagRules:
+    """FlagRules de un config.json (por defecto el del repo), en caché por mtime; sin archivo, las listas por defecto."""
+    ruta = os.path.abspath(str(path or CONFIG_PATH))
+    try:
+        st = os.stat(ruta)
+        firma = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return FlagRules()
+    with _LOCK:
+        hit = _FLAG_CACHE.get(ruta)
+    if hit is not None and hit[0] == firma:
+        return hit[1]
+    try:
+        with open(ruta, encoding="utf-8") as fh:
+            reglas = FlagRules(json.load(fh))
+    except (OSError, ValueError):
+        reglas = FlagRules()
+    with _LOCK:
+        _FLAG_CACHE[ruta] = (firma, reglas)
+    return reglas
@@ -0,0 +1,579 @@
+"""
+Motor de sugerencias de categoría para movimientos sin categoría.
+
+build_suggestions_df arma las sugerencias como un pipeline de DataFrames, en orden de prioridad:
+  1) Mapa exacto: reglas de categoria_map,
+  2) Mismo comercio: reglas de otras variantes con la misma clave canónica de comercio
+     (confianza 0.9: la canonicalización puede unir comercios distintos),
+  3) Historial dominante: categoría que ya tiene >= 70% de los movimientos del comercio,
+  4) Regla de comercio: reglas por subcadena de merchant_map.json (confianza 0.75),
+  5) Nombres similares: una sola pasada en lote contra el historial categorizado, por
+     nombre exacto o prefijo y monto parecido,
+  6) Nombre aproximado: nombres del historial con trigramas parecidos (MinHash LSH),
+  7) Clasificador: Naive Bayes sobre n-gramas del nombre y tramo de monto (classifier.py),
+  8) Sin sugerencia.
+
+Las sugerencias se calculan en lote al ingerir (refresh_suggestions) y se guardan en
+movimientos (categoria_sugerida, sugerencia_fuente, sugerencia_confianza, sugerencia_alternativas);
+el panel las lee por páginas de la cola de pendientes con pending_suggestions. Cuando
+cambian el mapa, las categorías o las estadísticas (versiones guardadas en la base, así que un
+reinicio no fuerza un recálculo), ensure_suggestions_fresh las recalcula: en SQLite en el mismo
+hilo; en Postgres en segundo plano. save_suggestions vuelve a comprobar la versión y solo
+escribe filas que siguen pendientes, en la misma transacción.
+"""
+
+import hashlib
+import json
+import threading
+import unicodedata
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from classifier import suggest_by_classifier
+from db import (
+    cache_key,
+    get_comercio_ids,
+    get_dominant_categories,
+    get_saved_suggestion_version,
+    get_suggestion_version,
+    load_all,
+    load_suggestions,
+    lookup_categoria_map,
+    lookup_comercio_map,
+    lookup_merchant_rules,
+    save_suggestions,
+)
+
+# Columnas del DataFrame de sugerencias (en este orden)
+SUGGESTION_COLUMNS = [
+    "unique_key",
+    "detalle",
+    "detalle_norm",
+    "sugerida",
+    "fuente",
+    "confianza",
+    "aceptar",
+    "manual",
+    "alternativas_sim",
+    "monto",
+]
+
+# Fuentes de sugerencia en orden de prioridad (sugerencia_fuente empieza por una de ellas)
+SUGGESTION_SOURCES = ["Mapa exacto", "Mismo comercio", "Historial dominante", "Regla de comercio", "Nombres similares", "Nombre aproximado", "Clasificador"]
+
+DOMINANT_MIN_PCT = 70.0
+SIMILAR_TOP_K = 3
+
+# Nombres aproximados (MinHash LSH): 32 bandas x 3 filas. Un par con Jaccard 0.5 comparte alguna
+# banda con probabilidad 1-(1-0.5^3)^32 ~ 0.99; los candidatos se confirman con el Jaccard exacto.
+FUZZY_NUM_PERM = 96
+FUZZY_BANDS = 32
+FUZZY_MIN_JACCARD = 0.5
+
+
+def _norm_detalle(s) -> str:
+    if pd.isna(s):
+        return ""
+    s = str(s).strip()
+    s = unicodedata.normalize("NFKD", s)
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    s = s.replace("\n", " ").replace("\t", " ")
+    s = "".join(ch if ch.isalnum() or ch.isspace() else " " for ch in s)
+    return " ".join(s.upper().split())
+
+
+def _mask_pendientes(df: pd.DataFrame) -> pd.Series:
+    """Filas sin categoría o con "Sin categoría"."""
+    return (df["categoria"].isna()) | (df["categoria"] == "") | (df["categoria"] == "Sin categoría")
+
+
+def _dominant_categories(conn, dns: List[str]) -> Dict[str, Tuple[str, float]]:
+    """Categoría más frecuente (sin "Sin categoría") y su porcentaje, por detalle_norm (búsqueda en comercio_categoria_stats)."""
+    comercio_ids = get_comercio_ids(conn, dns)
+    por_comercio = get_dominant_categories(conn, comercio_ids.values())
+    # Las variantes de un mismo comercio (misma clave canónica) comparten su categoría dominante
+    return {dn: por_comercio[cid] for dn, cid in comercio_ids.items() if cid in por_comercio}
+
+
+_MINHASH_PRIMO = np.uint64((1 << 31) - 1)
+
+
+def _shingles(nombre: str) -> frozenset:
+    """Trigramas de caracteres de cada palabra (con bordes): el orden de las palabras no importa."""
+    out = set()
+    for w in nombre.split():
+        w = f" {w} "
+        out.update(w[i:i + 3] for i in range(len(w) - 2))
+    return frozenset(out)
+
+
+def _jaccard(a: frozenset, b: frozenset) -> float:
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+
+class MinHashLSH:
+    """
+    Búsqueda aproximada de nombres parecidos: cada nombre es un conjunto de trigramas, su firma
+    MinHash se calcula vectorizada con NumPy y las firmas se reparten en bandas (LSH). Una consulta
+    solo compara contra los nombres que comparten alguna banda, en vez de contra todo el historial.
+    """
+
+    def __init__(self, nombres: List[str], num_perm: int = FUZZY_NUM_PERM, bandas: int = FUZZY_BANDS):
+        rng = np.random.default_rng(20240601)
+        self.a = rng.integers(1, _MINHASH_PRIMO, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, _MINHASH_PRIMO, num_perm, dtype=np.uint64)
+        self.filas = num_perm // bandas
+        self.bandas = bandas
+        # Multiplicadores para reducir cada banda (filas valores) a una sola clave entera
+        self.mezcla = rng.integers(1, np.iinfo(np.uint64).max, self.filas, dtype=np.uint64)
+        self.nombres = list(nombres)
+        self.shingles = [_shingles(n) for n in self.nombres]
+        claves = self._claves_banda(self._firmas(self.shingles))
+        self.buckets = [
+            pd.Series(np.arange(len(self.nombres))).groupby(claves[:, j]).indices for j in range(bandas)
+        ]
+
+    def _firmas(self, conjuntos: List[frozenset], bloque: int = 200_000) -> np.ndarray:
+        """Firma MinHash (len(conjuntos) x num_perm): mínimo de (a*h + b) mod p sobre los trigramas."""
+        hashes = [np.fromiter((zlib.crc32(t.encode()) for t in c), dtype=np.uint64, count=len(c)) for c in conjuntos]
+        largos = np.array([max(len(h), 1) for h in hashes])
+        # Un conjunto vacío recibe un trigrama imposible (no coincide con nada real)
+        plano = np.concatenate([h if len(h) else np.array([_MINHASH_PRIMO], dtype=np.uint64) for h in hashes]) % _MINHASH_PRIMO
+        inicios = np.concatenate([[0], np.cumsum(largos)[:-1]])
+        firmas = np.empty((len(conjuntos), len(self.a)), dtype=np.uint64)
+        # Por bloques de conjuntos, para acotar la matriz trigramas x permutaciones
+        i = 0
+        while i < len(conjuntos):
+            j = int(np.searchsorted(inicios, inicios[i] + bloque, side="right"))
+            j = max(j, i + 1)
+            desde, hasta = inicios[i], inicios[j - 1] + largos[j - 1]
+            valores = (plano[desde:hasta, None] * self.a + self.b) % _MINHASH_PRIMO
+            firmas[i:j] = np.minimum.reduceat(valores, inicios[i:j] - desde, axis=0)
+            i = j
+        return firmas
+
+    def _claves_banda(self, firmas: np.ndarray) -> np.ndarray:
+        """Clave entera por banda (len(firmas) x bandas); los choques solo agregan candidatos."""
+        por_banda = firmas[:, : self.bandas * self.filas].reshape(len(firmas), self.bandas, self.filas)
+        return (por_banda * self.mezcla).sum(axis=2)
+
+    def consultar(self, nombres: List[str], umbral: float = FUZZY_MIN_JACCARD) -> List[List[Tuple[int, float]]]:
+        """Por cada nombre, [(posición en el índice, Jaccard exacto)] de los parecidos con Jaccard >= umbral."""
+        if not nombres or not self.nombres:
+            return [[] for _ in nombres]
+        conjuntos = [_shingles(n) for n in nombres]
+        claves = self._claves_banda(self._firmas(conjuntos))
+        out = []
+        for conjunto, fila in zip(conjuntos, claves.tolist()):
+            candidatos = set()
+            for bucket, clave in zip(self.buckets, fila):
+                candidatos.update(bucket.get(clave, ()))
+            parecidos = [(int(c), _jaccard(conjunto, self.shingles[c])) for c in candidatos]
+            out.append(sorted([p for p in parecidos if p[1] >= umbral], key=lambda p: (-p[1], p[0])))
+        return out
+
+
+class SimilarityIndex:
+    """
+    Índice del historial categorizado para "Nombres similares", construido una vez por versión
+    de los datos (ver similarity_index):
+      - nombre exacto -> filas del historial,
+      - 4-grama -> nombres que lo contienen: el respaldo por prefijo de 4 caracteres es un acceso
+        al diccionario en vez de recorrer todos los nombres,
+      - por grupo de candidatos (nombre o prefijo), los montos de cada categoría ordenados, para
+        contar los que caen en el rango de un monto con búsqueda binaria. Se calculan al primer uso.
+    """
+
+    GRAMA = 4
+
+    def __init__(self, hist_df: pd.DataFrame):
+        codes, self.cats = pd.factorize(hist_df["categoria"], sort=True)
+        self.nombres = list(self.cats)
+        validas = codes >= 0
+        self.codes = codes[validas]
+        self.h_abs = pd.to_numeric(hist_df["monto"], errors="coerce").fillna(0).abs().to_numpy(dtype=float)[validas]
+        keys = hist_df["detalle_norm_cmp"].astype(str).to_numpy()[validas]
+        self.filas_por_key: Dict[str, np.ndarray] = pd.Series(np.arange(len(keys))).groupby(keys).indices
+        gramas: Dict[str, List[str]] = {}
+        n = self.GRAMA
+        for k in self.filas_por_key:
+            for g in {k[i:i + n] for i in range(len(k) - n + 1)}:
+                gramas.setdefault(g, []).append(k)
+        self.gramas = gramas
+        self._montos: Dict[Tuple[bool, str], List[Tuple[int, np.ndarray]]] = {}
+        self._lsh: Optional[MinHashLSH] = None
+
+    @property
+    def lsh(self) -> MinHashLSH:
+        """Índice MinHash LSH de los nombres del historial (se construye al primer uso)."""
+        if self._lsh is None:
+            self._lsh = MinHashLSH(list(self.filas_por_key))
+        return self._lsh
+
+    def grupo(self, key: str) -> Optional[Tuple[bool, str]]:
+        """(es_prefijo, valor) de los candidatos de un nombre, o None si no hay ninguno."""
+        if key in self.filas_por_key:
+            return (False, key)
+        if len(key) >= self.GRAMA and key[:self.GRAMA] in self.gramas:
+            return (True, key[:self.GRAMA])
+        return None
+
+    def montos_por_categoria(self, grupo: Tuple[bool, str]) -> List[Tuple[int, np.ndarray]]:
+        """[(código de categoría, montos absolutos ordenados)] de los candidatos del grupo."""
+        cached = self._montos.get(grupo)
+        if cached is not None:
+            return cached
+        es_prefijo, valor = grupo
+        if es_prefijo:
+            filas = np.concatenate([self.filas_por_key[k] for k in self.gramas[valor]])
+        else:
+            filas = self.filas_por_key[valor]
+        c, h = self.codes[filas], self.h_abs[filas]
+        orden = np.lexsort((h, c))
+        c, h = c[orden], h[orden]
+        cortes = np.flatnonzero(np.diff(c)) + 1
+        out = [(int(cc[0]), hh) for cc, hh in zip(np.split(c, cortes), np.split(h, cortes))]
+        self._montos[grupo] = out
+        return out
+
+    def conteos(self, grupo: Tuple[bool, str], montos: np.ndarray) -> np.ndarray:
+        """
+        Frecuencia de cada categoría entre los candidatos del grupo, para cada monto de `montos`
+        (matriz len(montos) x categorías). Si el monto es > 0 se cuentan solo los candidatos con
+        monto dentro de ±max(25%, 1000), salvo que ninguno caiga en el rango.
+        """
+        tol = np.maximum(montos * 0.25, 1000)
+        lo, hi = montos - tol, montos + tol
+        total = np.zeros(len(self.cats), dtype=np.int64)
+        en_rango = np.zeros((len(montos), len(self.cats)), dtype=np.int64)
+        for c, arr in self.montos_por_categoria(grupo):
+            total[c] = len(arr)
+            en_rango[:, c] = np.searchsorted(arr, hi, side="right") - np.searchsorted(arr, lo, side="left")
+        usar_rango = (montos > 0) & (en_rango.sum(axis=1) > 0)
+        return np.where(usar_rango[:, None], en_rango, total[None, :])
+
+    def sugerir(self, pendientes: pd.DataFrame, top_k: int = SIMILAR_TOP_K) -> pd.Series:
+        """Ver suggest_by_similarity."""
+        out = np.empty(len(pendientes), dtype=object)
+        out[:] = [[] for _ in range(len(pendientes))]
+        pend = pd.DataFrame({
+            "key": pendientes["detalle_norm"].fillna("").astype(str).str.strip().str.upper().to_numpy(),
+            "m": pd.to_numeric(pendientes["monto"], errors="coerce").abs().fillna(0.0).to_numpy(),
+        })
+        pend = pend[pend["key"] != ""]
+        grupos = {k: self.grupo(k) for k in pend["key"].unique()}
+        pend["grupo"] = pend["key"].map(grupos)
+        pend = pend[pend["grupo"].notna()]
+        for grupo, filas_pend in pend.groupby("grupo", sort=False):
+            montos, inv = np.unique(filas_pend["m"].to_numpy(dtype=float), return_inverse=True)
+            conteos = self.conteos(grupo, montos)
+            # Orden estable: frecuencia descendente, empates por nombre de categoría (códigos ordenados)
+            top = np.argsort(-conteos, axis=1, kind="stable")[:, :top_k]
+            n_top = np.take_along_axis(conteos, top, axis=1)
+            scores = n_top / np.maximum(n_top.sum(axis=1, keepdims=True), 1)
+            listas = [
+                [{"categoria": self.nombres[i], "score": sc} for i, n, sc in zip(fi, fn, fs) if n > 0]
+                for fi, fn, fs in zip(top.tolist(), n_top.tolist(), scores.tolist())
+            ]
+            for pos, i in zip(filas_pend.index, inv):
+                out[pos] = listas[i]
+        return pd.Series(out, index=pendientes.index, dtype=object)
+
+    def sugerir_aproximado(self, pendientes: pd.DataFrame, top_k: int = SIMILAR_TOP_K) -> pd.DataFrame:
+        """Ver suggest_by_fuzzy_name."""
+        keys = pendientes["detalle_norm"].fillna("").astype(str).str.strip().str.upper()
+        unicos = [k for k in keys.unique() if k]
+        por_key = {}
+        for key, parecidos in zip(unicos, self.lsh.consultar(unicos)):
+            if not parecidos:
+                continue
+            # Peso de cada categoría: Jaccard del nombre parecido x sus movimientos en esa categoría
+            pesos = np.zeros(len(self.cats))
+            for pos, jac in parecidos:
+                pesos += jac * np.bincount(self.codes[self.filas_por_key[self.lsh.nombres[pos]]], minlength=len(self.cats))
+            top = np.argsort(-pesos, kind="stable")[:top_k]
+            top = top[pesos[top] > 0]
+            scores = pesos[top] / pesos[top].sum()
+            alternativas = [{"categoria": self.nombres[i], "score": float(sc)} for i, sc in zip(top, scores)]
+            por_key[key] = (alternativas, float(scores[0] * parecidos[0][1]))
+        con_match = keys.isin(por_key.keys())
+        hallados = keys[con_match]
+        return pd.DataFrame({
+            "alternativas_sim": pd.Series([por_key[k][0] for k in hallados], index=hallados.index, dtype=object),
+            "confianza": [por_key[k][1] for k in hallados],
+        }, index=hallados.index)
+
+
+# Índices de similitud por huella del historial (contenido de nombre, monto y categoría)
+_INDEX_LOCK = threading.Lock()
+_INDEX_CACHE: Dict[str, SimilarityIndex] = {}
+_INDEX_CACHE_MAX = 4
+
+
+def similarity_index(hist_df: pd.DataFrame) -> SimilarityIndex:
+    """Índice del historial, reutilizado mientras su contenido no cambie (la huella se calcula vectorizada)."""
+    cols = hist_df[["detalle_norm_cmp", "monto", "categoria"]]
+    huella = hashlib.blake2b(pd.util.hash_pandas_object(cols, index=False).to_numpy().tobytes(), digest_size=16).hexdigest()
+    with _INDEX_LOCK:
+        idx = _INDEX_CACHE.get(huella)
+        if idx is None:
+            idx = SimilarityIndex(hist_df)
+            if len(_INDEX_CACHE) >= _INDEX_CACHE_MAX:
+                _INDEX_CACHE.pop(next(iter(_INDEX_CACHE)))
+            _INDEX_CACHE[huella] = idx
+        return idx
+
+
+def suggest_by_similarity(pendientes: pd.DataFrame, hist_df: pd.DataFrame, top_k: int = SIMILAR_TOP_K) -> pd.Series:
+    """
+    Sugerencias por nombres similares para muchas filas a la vez (pendientes: detalle_norm, monto).
+    Devuelve, con el índice de pendientes, la lista [{"categoria", "score"}, ...] de cada fila
+    (vacía si no hay coincidencias). Para cada fila:
+      - candidatos: historial con el mismo detalle_norm (mayúsculas); si no hay y el nombre tiene
+        4+ caracteres, historial cuyo nombre contiene sus 4 primeros caracteres,
+      - si el monto es > 0, se prefieren los candidatos con monto dentro de ±max(25%, 1000),
+      - top_k categorías por frecuencia (empates por nombre); score = frecuencia / suma de las top_k.
+    Cada grupo de candidatos evalúa todos sus montos distintos de una sola vez, sobre el índice
+    del historial (ver SimilarityIndex).
+    """
+    if pendientes.empty or hist_df is None or hist_df.empty:
+        return pd.Series([[] for _ in range(len(pendientes))], index=pendientes.index, dtype=object)
+    return similarity_index(hist_df).sugerir(pendientes, top_k)
+
+
+def suggest_by_fuzzy_name(pendientes: pd.DataFrame, hist_df: pd.DataFrame, top_k: int = SIMILAR_TOP_K) -> pd.DataFrame:
+    """
+    Sugerencias por nombre aproximado (pendientes: detalle_norm) para los nombres que no tienen
+    coincidencia exacta ni por prefijo: variantes y palabras en otro orden ("UBER EATS" / "EATS UBER").
+    Los nombres del historial con Jaccard de trigramas >= FUZZY_MIN_JACCARD se encuentran con
+    MinHash LSH; cada categoría pesa el Jaccard del nombre por sus movimientos en ella.
+    Devuelve, solo para las filas con parecidos, alternativas_sim (top_k, score normalizado) y
+    confianza = score de la mejor categoría x Jaccard del nombre más parecido.
+    """
+    if pendientes.empty or hist_df is None or hist_df.empty:
+        return pd.DataFrame({"alternativas_sim": pd.Series(dtype=object), "confianza": pd.Series(dtype=float)})
+    return similarity_index(hist_df).sugerir_aproximado(pendientes, top_k)
+
+
+def build_suggestions_df(df, conn, hist_df=None) -> pd.DataFrame:
+    """Construir DataFrame de sugerencias de categoría (pipeline vectorizado, consultas en lote)."""
+    sug_df = df[_mask_pendientes(df)].copy()
+    if sug_df.empty:
+        return pd.DataFrame()
+
+    # Asegurar columna detalle_norm consistente
+    if "detalle_norm" not in sug_df.columns:
+        sug_df["detalle_norm"] = sug_df["detalle"].apply(_norm_detalle)
+    base = pd.DataFrame({
+        "unique_key": sug_df["unique_key"] if "unique_key" in sug_df.columns else "",
+        "detalle": sug_df["detalle"] if "detalle" in sug_df.columns else "",
+        "detalle_norm": sug_df["detalle_norm"].fillna("").astype(str),
+        "monto": sug_df["monto"] if "monto" in sug_df.columns else None,
+    }, index=sug_df.index)
+    base = base[base["detalle_norm"] != ""]
+    if base.empty:
+        return pd.DataFrame()
+    dn_list = sorted(set(base["detalle_norm"]))
+
+    # 1) Mapa exacto para TODOS los detalle_norm únicos (sondeo en memoria contra la caché de db.py)
+    try:
+        exact_map = lookup_categoria_map(conn, dn_list)
+    except Exception:
+        exact_map = {}
+    exacta = base["detalle_norm"].map(exact_map)
+    es_exacta = exacta.notna() & (exacta.astype(str).str.strip() != "")
+    exactos = base[es_exacta].assign(sugerida=exacta[es_exacta], fuente="Mapa exacto", confianza=1.0)
+    # Filas repetidas (mismo detalle_norm y unique_key) se sugieren una sola vez
+    resto = base[~es_exacta].drop_duplicates(["detalle_norm", "unique_key"])
+
+    # 2) Reglas de otras variantes del mismo comercio (clave canónica)
+    try:
+        comercio_map = lookup_comercio_map(conn, sorted(set(resto["detalle_norm"])))
+    except Exception:
+        comercio_map = {}
+    por_comercio = resto["detalle_norm"].map(comercio_map)
+    es_comercio = por_comercio.notna() & (por_comercio.astype(str).str.strip() != "")
+    mismo_comercio = resto[es_comercio].assign(sugerida=por_comercio[es_comercio], fuente="Mismo comercio", confianza=0.9)
+    resto = resto[~es_comercio]
+
+    # 3) Historial dominante por detalle_norm, en lote
+    pending_dns = sorted(set(resto["detalle_norm"]))
+    try:
+        dom_map = _dominant_categories(conn, pending_dns) if pending_dns else {}
+    except Exception:
+        dom_map = {}
+    dom = resto["detalle_norm"].map(dom_map)
+    dom_cat = dom.map(lambda v: v[0] if isinstance(v, tuple) else None)
+    dom_pct = dom.map(lambda v: v[1] if isinstance(v, tuple) else 0.0).astype(float)
+    es_dom = dom_cat.notna() & (dom_cat.astype(str).str.strip() != "") & (dom_pct >= DOMINANT_MIN_PCT)
+    dominantes = resto[es_dom].assign(sugerida=dom_cat[es_dom], fuente="Historial dominante", confianza=0.8)
+
+    # 4) Reglas por subcadena de merchant_map.json
+    resto = resto[~es_dom]
+    try:
+        regla_map = lookup_merchant_rules(conn, sorted(set(resto["detalle_norm"])))
+    except Exception:
+        regla_map = {}
+    por_regla = resto["detalle_norm"].map(regla_map)
+    es_regla = por_regla.notna()
+    por_reglas = resto[es_regla].assign(sugerida=por_regla[es_regla], fuente="Regla de comercio", confianza=0.75)
+
+    # 5) Similitud por nombre/monto: una sola pasada para todo el resto
+    resto = resto[~es_regla]
+    alternativas = suggest_by_similarity(resto, hist_df)
+    con_sim = alternativas.map(len) > 0
+    mejor = alternativas[con_sim].map(lambda alts: alts[0])
+    similares = resto[con_sim].assign(
+        sugerida=mejor.map(lambda b: b["categoria"]),
+        fuente=mejor.map(lambda b: f"Nombres similares ({b['score']:.2f})"),
+        confianza=mejor.map(lambda b: b["score"]),
+        alternativas_sim=alternativas[con_sim],
+    )
+
+    # 6) Nombre aproximado (MinHash LSH) para lo que no tuvo coincidencia exacta ni por prefijo
+    resto = resto[~con_sim]
+    fuzzy = suggest_by_fuzzy_name(resto, hist_df)
+    aproximados = resto.loc[fuzzy.index].assign(
+        sugerida=fuzzy["alternativas_sim"].map(lambda alts: alts[0]["categoria"]),
+        fuente=fuzzy["confianza"].map(lambda c: f"Nombre aproximado ({c:.2f})"),
+        confianza=fuzzy["confianza"],
+        alternativas_sim=fuzzy["alternativas_sim"],
+    )
+
+    # 7) Clasificador de texto, en lote, para lo que sigue sin sugerencia
+    resto = resto.drop(index=fuzzy.index)
+    try:
+        clasif = suggest_by_classifier(conn, resto)
+    except Exception:
+        clasif = pd.DataFrame(columns=["sugerida", "confianza", "alternativas_sim"])
+    clasificados = resto.loc[clasif.index].assign(
+        sugerida=clasif["sugerida"],
+        fuente=clasif["confianza"].map(lambda c: f"Clasificador ({c:.2f})"),
+        confianza=clasif["confianza"],
+        alternativas_sim=clasif["alternativas_sim"],
+    )
+
+    # 8) Sin sugerencia
+    sin_sug = resto.drop(index=clasif.index).assign(sugerida="Sin categoría", fuente="Sin sugerencia", confianza=0.0)
+    sin_sug["alternativas_sim"] = [[] for _ in range(len(sin_sug))]
+
+    # Mapa exacto, mismo comercio, historial dominante y reglas no informan alternativas ni monto
+    exactos = exactos.drop(columns=["monto"])
+    mismo_comercio = mismo_comercio.drop(columns=["monto"])
+    dominantes = dominantes.drop(columns=["monto"])
+    por_reglas = por_reglas.drop(columns=["monto"])
+    # Orden de salida: primero los del mapa exacto, luego el resto en su orden original
+    # (base no está vacía, así que al menos una parte tiene filas)
+    partes = [exactos] if not exactos.empty else []
+    resto_partes = [p for p in (mismo_comercio, dominantes, por_reglas, similares, aproximados, clasificados, sin_sug) if not p.empty]
+    if resto_partes:
+        partes.append(pd.concat(resto_partes).sort_index(kind="stable"))
+    out = pd.concat(partes, ignore_index=True)
+    out["aceptar"] = False
+    out["manual"] = ""
+    return out.reindex(columns=SUGGESTION_COLUMNS)
+
+
+# --- Sugerencias persistidas ---
+# Conexiones (Postgres) con un recálculo en segundo plano en curso
+_REFRESH_LOCK = threading.Lock()
+_REFRESH_RUNNING: set = set()
+
+
+def history_for_similarity(df: pd.DataFrame) -> pd.DataFrame:
+    """Historial categorizado (con detalle_norm_cmp) contra el que se buscan nombres similares."""
+    hist = df.copy()
+    hist["detalle_norm_cmp"] = hist.get("detalle_norm", "").astype(str).str.strip().str.upper()
+    return hist[
+        (hist["detalle_norm_cmp"] != "")
+        & hist["categoria"].notna()
+        & (hist["categoria"] != "Sin categoría")
+    ]
+
+
+def refresh_suggestions(conn, df: Optional[pd.DataFrame] = None, hist_df: Optional[pd.DataFrame] = None) -> int:
+    """
+    Recalcula en una sola pasada las sugerencias de todos los movimientos pendientes del
+    usuario y las guarda en movimientos. `df` (load_all) y `hist_df` se cargan si no se pasan.
+    Devuelve las filas guardadas (0 si otro escritor cambió la versión mientras se calculaban).
+    """
+    version = get_suggestion_version(conn)
+    if df is None:
+        df = load_all(conn)
+    sugerencias = pd.DataFrame()
+    if not df.empty:
+        if hist_df is None:
+            hist_df = history_for_similarity(df)
+        sugerencias = build_suggestions_df(df, conn, hist_df=hist_df)
+    return save_suggestions(conn, sugerencias, version=version)
+
+
+def _refresh_en_segundo_plano(conn, key: str) -> None:
+    try:
+        refresh_suggestions(conn)
+    except Exception:
+        # Se reintenta en la próxima llamada a ensure_suggestions_fresh
+        pass
+    finally:
+        with _REFRESH_LOCK:
+            _REFRESH_RUNNING.discard(key)
+
+
+def ensure_suggestions_fresh(conn, df: Optional[pd.DataFrame] = None, hist_df: Optional[pd.DataFrame] = None) -> bool:
+    """
+    Si el mapa, las categorías o las estadísticas cambiaron desde el último cálculo guardado,
+    recalcula las sugerencias. En SQLite lo hace en este hilo, con `df`/`hist_df` si se pasan
+    (un escritor por archivo: un hilo aparte competiría por el bloqueo); en Postgres en segundo
+    plano. Devuelve True si recalculó o lanzó el recálculo.
+    """
+    if get_saved_suggestion_version(conn) == get_suggestion_version(conn):
+        return False
+    if not (isinstance(conn, dict) and conn.get("pg")):
+        refresh_suggestions(conn, df=df, hist_df=hist_df)
+        return True
+    key = cache_key(conn)
+    with _REFRESH_LOCK:
+        if key in _REFRESH_RUNNING:
+            return False
+        _REFRESH_RUNNING.add(key)
+    threading.Thread(target=_refresh_en_segundo_plano, args=(conn, key), daemon=True).start()
+    return True
+
+
+def pending_suggestions(
+    conn, limit: Optional[int] = None, offset: int = 0, hist_df: Optional[pd.DataFrame] = None
+) -> pd.DataFrame:
+    """
+    Sugerencias (columnas SUGGESTION_COLUMNS) de una página de la cola de pendientes
+    (load_suggestions, del más reciente al más antiguo). Las filas de la página que aún no
+    tienen sugerencia se calculan en lote (contra `hist_df`, o el historial de la base si no
+    se pasa) y se guardan primero.
+    """
+    stored = load_suggestions(conn, limit=limit, offset=offset)
+    faltan = stored["sugerencia_fuente"].isna() & (stored["detalle_norm"].fillna("").astype(str) != "")
+    if faltan.any():
+        if hist_df is None:
+            hist_df = history_for_similarity(load_all(conn))
+        nuevas = build_suggestions_df(stored[faltan].assign(categoria=None), conn, hist_df=hist_df)
+        if not nuevas.empty:
+            save_suggestions(conn, nuevas)
+            stored = load_suggestions(conn, limit=limit, offset=offset)
+    stored = stored[stored["sugerencia_fuente"].notna()]
+    if stored.empty:
+        return pd.DataFrame()
+    out = pd.DataFrame({
+        "unique_key": stored["unique_key"],
+        "detalle": stored["detalle"],
+        "detalle_norm": stored["detalle_norm"],
+        "sugerida": stored["categoria_sugerida"],
+        "fuente": stored["sugerencia_fuente"],
+        "confianza": stored["sugerencia_confianza"].astype(float),
+        "aceptar": False,
+        "manual": "",
+        "alternativas_sim": stored["sugerencia_alternativas"].map(lambda v: json.loads(v) if isinstance(v, str) and v else []),
+        "monto": stored["monto"],
+    })
+    return out.reset_index(drop=True).reindex(columns=SUGGESTION_COLUMNS)
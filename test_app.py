@@ -3,7 +3,9 @@
 Script de prueba para verificar que la aplicación Facto$ funcione correctamente
 """
 
+import os
 import sys
+import tempfile
 from pathlib import Path
 
 # Agregar el directorio actual al path
@@ -57,8 +59,8 @@ def test_database():
     try:
         from db import get_conn, init_db, get_categories, replace_categories
         
-        # Obtener conexión
-        conn = get_conn()
+        # Obtener conexión (base temporal: no tocar data/gastos.db)
+        conn = get_conn(os.path.join(tempfile.mkdtemp(), "gastos.db"))
         print("✅ Conexión a base de datos establecida")
         
         # Inicializar base de datos
@@ -106,6 +108,844 @@ def test_requirements():
         print("❌ requirements.txt no encontrado")
         return False
 
+def _base_temporal():
+    """Conexión SQLite nueva en un directorio temporal, con el esquema y categorías mínimas."""
+    from db import get_conn, init_db, replace_categories
+
+    conn = get_conn(os.path.join(tempfile.mkdtemp(), "gastos.db"))
+    init_db(conn)
+    replace_categories(conn, ["Sin categoría", "Supermercado", "Transporte"])
+    return conn
+
+def test_reembolsos():
+    """Solo los abonos por signo se emparejan; transferencias y pagos de tarjeta no"""
+    print("\n🔁 Probando emparejamiento de reembolsos...")
+    import pandas as pd
+    from db import upsert_transactions, load_all, pair_reimbursements
+
+    conn = _base_temporal()
+    # Como en la app: montos forzados a negativo y es_abono según el signo del CSV
+    upsert_transactions(conn, pd.DataFrame([
+        {"fecha": "2024-03-01", "detalle": "RESTAURANT SUSHI", "monto": -30000, "es_abono": False},
+        {"fecha": "2024-03-02", "detalle": "LIDER", "monto": -12000, "es_abono": False},
+        {"fecha": "2024-03-05", "detalle": "TRANSFERENCIA A PEDRO", "monto": -50000, "es_transferencia_o_abono": True, "es_abono": False},
+        {"fecha": "2024-03-06", "detalle": "PAGO TARJETA VISA", "monto": -12000, "es_transferencia_o_abono": True, "es_abono": False},
+        {"fecha": "2024-03-07", "detalle": "TRASPASO CUENTA PROPIA", "monto": -12000, "es_abono": True},
+    ]))
+    pares = conn.execute("SELECT COUNT(*) FROM reembolsos").fetchone()[0]
+    assert pares == 0, f"transferencias/pagos emparejados como reembolso: {pares}"
+    print("✅ 'TRANSFERENCIA A X', 'PAGO TARJETA' y cuentas propias no se emparejan")
+
+    upsert_transactions(conn, pd.DataFrame([
+        {"fecha": "2024-03-10", "detalle": "ABONO MARIA", "monto": -29500, "es_abono": True},
+    ]))
+    df = load_all(conn).set_index("detalle")
+    assert df.loc["RESTAURANT SUSHI", "reembolso_diff"] == 500
+    assert bool(df.loc["ABONO MARIA", "es_reembolso"])
+    assert int(df.loc["TRASPASO CUENTA PROPIA", "es_entre_cuentas"]) == 1
+    print("✅ Abono por signo emparejado con el gasto (diferencia 500)")
+
+    # Alta manual (fuera de upsert_transactions): monto positivo, sin es_abono
+    conn.execute(
+        "INSERT INTO movimientos (unique_key, fecha, detalle, detalle_norm, monto, es_abono, es_entre_cuentas, usuario) "
+        "VALUES ('m:1', '2024-03-03', 'CENA', 'CENA', 12000, 0, 0, ?)", (conn.usuario,)
+    )
+    conn.execute(
+        "INSERT INTO movimientos (unique_key, fecha, detalle, detalle_norm, monto, es_abono, es_entre_cuentas, usuario) "
+        "VALUES ('a:1', '2024-03-04', 'ABONO JUAN', 'ABONO JUAN', -11800, 1, 0, ?)", (conn.usuario,)
+    )
+    conn.commit()
+    assert pair_reimbursements(conn, [("m:1", "2024-03-03"), ("a:1", "2024-03-04")]) == 1
+    print("✅ pair_reimbursements empareja filas insertadas a mano")
+    conn.close()
+    return True
+
+def test_vaciar_movimientos():
+    """Vaciar movimientos borra también los pares de reembolsos y permite reemparejar"""
+    print("\n🧹 Probando vaciado de movimientos...")
+    import pandas as pd
+    from db import upsert_transactions, clear_transactions
+
+    conn = _base_temporal()
+    filas = pd.DataFrame([
+        {"fecha": "2024-03-01", "detalle": "RESTAURANT SUSHI", "monto": -30000, "es_abono": False},
+        {"fecha": "2024-03-10", "detalle": "ABONO MARIA", "monto": -29500, "es_abono": True},
+    ])
+    upsert_transactions(conn, filas)
+    assert conn.execute("SELECT COUNT(*) FROM reembolsos").fetchone()[0] == 1
+    assert clear_transactions(conn) == 2
+    assert conn.execute("SELECT COUNT(*) FROM reembolsos").fetchone()[0] == 0
+    upsert_transactions(conn, filas)
+    assert conn.execute("SELECT COUNT(*) FROM reembolsos").fetchone()[0] == 1
+    print("✅ Sin pares huérfanos: la recarga vuelve a emparejar")
+    conn.close()
+    return True
+
+def test_comercios_canonicos():
+    """La clave canónica no recorta nombres reales y su respaldo solo sugiere, con confianza < 1"""
+    print("\n🏪 Probando claves canónicas de comercio...")
+    import pandas as pd
+    from db import canonicalize_merchants, map_categories_for_df, update_categoria_map_from_df
+    from suggest import build_suggestions_df
+
+    casos = {
+        "FLOW BAR": "flow bar",
+        "MP CAFE": "mp cafe",
+        "BANCO DE CHILE": "banco de chile",
+        "7 ELEVEN": "7 eleven",
+        "7-ELEVEN 123": "7 eleven",
+        "MERPAGO*LIQUIDOS OFF COME": "liquidos off come",
+        "MERPAGO - LIQUIDOS": "liquidos",
+        "LIDER EXPRESS 123": "lider express",
+        "JUMBO LAS CONDES": "jumbo",
+        "SANTIAGO": "santiago",
+        "MP": "mp",
+    }
+    claves = canonicalize_merchants(pd.Series(list(casos)))
+    for detalle, clave in zip(casos, claves):
+        assert clave == casos[detalle], (detalle, clave)
+
+    conn = _base_temporal()
+    update_categoria_map_from_df(conn, pd.DataFrame({"detalle_norm": ["lider express 123"], "categoria": ["Supermercado"]}))
+    nuevas = map_categories_for_df(conn, pd.DataFrame({"detalle_norm": ["lider express 123", "lider express 456"]}))
+    assert list(nuevas["categoria"]) == ["Supermercado", "Sin categoría"]
+    sug = build_suggestions_df(pd.DataFrame({
+        "unique_key": ["a"], "detalle": ["LIDER EXPRESS 456"], "detalle_norm": ["lider express 456"],
+        "monto": [-1000], "categoria": ["Sin categoría"],
+    }), conn, hist_df=pd.DataFrame())
+    assert sug.loc[0, "sugerida"] == "Supermercado" and sug.loc[0, "fuente"] == "Mismo comercio"
+    assert sug.loc[0, "confianza"] < 1
+    print("✅ Nombres intactos; la variante del comercio llega como sugerencia, no como categoría")
+    conn.close()
+    return True
+
+def test_sugerencias_vigentes():
+    """Las sugerencias guardadas no pisan filas ya categorizadas ni se guardan con una versión vieja"""
+    print("\n💡 Probando vigencia de las sugerencias guardadas...")
+    import pandas as pd
+    from db import (
+        apply_edits, get_saved_suggestion_version, get_suggestion_version, load_all, save_suggestions,
+        upsert_transactions,
+    )
+    from suggest import build_suggestions_df, ensure_suggestions_fresh, refresh_suggestions
+
+    conn = _base_temporal()
+    upsert_transactions(conn, pd.DataFrame({
+        "fecha": ["2024-04-01", "2024-04-02", "2024-04-03"],
+        "detalle": ["LIDER EXPRESS", "LIDER EXPRESS", "UBER TRIP"],
+        "monto": [-5000, -6000, -7000],
+        "categoria": ["Supermercado", None, None],
+    }))
+    refresh_suggestions(conn)
+    assert get_saved_suggestion_version(conn) == get_suggestion_version(conn)
+    assert not ensure_suggestions_fresh(conn)  # versión persistida: un proceso nuevo no recalcula
+
+    # Cálculo que empezó antes de que el usuario categorizara la fila de Uber
+    version = get_suggestion_version(conn)
+    df = load_all(conn)
+    sugerencias = build_suggestions_df(df, conn)
+    uber = df.loc[df["detalle"] == "UBER TRIP", "unique_key"].iloc[0]
+    apply_edits(conn, pd.DataFrame({"unique_key": [uber], "categoria": ["Transporte"]}))
+    assert save_suggestions(conn, sugerencias, version=version) == 0
+    # Sin versión tampoco toca la fila que ya no está pendiente
+    consulta = "SELECT categoria_sugerida, sugerencia_fuente, pendiente FROM movimientos WHERE unique_key = ?"
+    antes = conn.execute(consulta, (uber,)).fetchone()
+    save_suggestions(conn, sugerencias.assign(sugerida="Transporte", fuente="Prueba"))
+    assert antes[2] == 0 and conn.execute(consulta, (uber,)).fetchone() == antes
+    assert ensure_suggestions_fresh(conn)
+    assert get_saved_suggestion_version(conn) == get_suggestion_version(conn)
+    print("✅ Versión en la base y filas categorizadas protegidas")
+    conn.close()
+    return True
+
+def test_ignorados_y_tombstones():
+    """compact_ignored no fusiona registros de claves distintas y los tombstones valen con la base vacía"""
+    print("\n🪦 Probando compactación de ignorados y tombstones...")
+    import pandas as pd
+    import db
+
+    conn = _base_temporal()
+    fila = {"fecha": "2024-05-01", "detalle": "FARMACIA", "detalle_norm": "farmacia", "monto": -2500.0}
+    with conn:
+        # Misma fecha, detalle y monto pero claves distintas (p. ej. un ingreso manual y uno del CSV)
+        for uk in ("k:csv", "m:manual"):
+            conn.execute(db._SQL_IGNORED_INSERT_SQLITE, db._ignored_params({**fila, "unique_key": uk}, "default"))
+    stats = db.compact_ignored(conn, retention_days=0)
+    assert stats["colapsados"] == 0
+    assert conn.execute("SELECT COUNT(*) FROM movimientos_ignorados").fetchone()[0] == 2
+
+    movimiento = pd.DataFrame([{"fecha": "2024-05-02", "detalle": "CINE", "monto": -8000}])
+    assert db.upsert_transactions(conn, movimiento) == (1, 0)
+    uk = conn.execute("SELECT unique_key FROM movimientos").fetchone()[0]
+    db.delete_transactions(conn, unique_keys=[uk])
+    db.clear_transactions(conn)
+    # Base vacía: el tombstone se respeta igual
+    assert db.upsert_transactions(conn, movimiento)[0] == 0
+    print("✅ Sin fusiones entre claves distintas; el borrado sigue vigente tras vaciar")
+    conn.close()
+    return True
+
+def test_restaurar_ignorados():
+    """restore_ignored respeta tombstones, no reemplaza filas vivas y resuelve la categoría por id"""
+    print("\n♻️ Probando restauración de ignorados...")
+    import pandas as pd
+    import db
+
+    conn = _base_temporal()
+    super_ = pd.DataFrame([{"fecha": "2024-06-01", "detalle": "LIDER", "monto": -9000, "categoria": "Supermercado"}])
+    taxi = pd.DataFrame([{"fecha": "2024-06-02", "detalle": "TAXI", "monto": -4000, "categoria": "Transporte"}])
+    for lote in (super_, taxi, super_, taxi):
+        db.upsert_transactions(conn, lote)
+    assert conn.execute("SELECT COUNT(*) FROM movimientos_ignorados").fetchone()[0] == 2
+    lider_uk, lider_id = conn.execute("SELECT unique_key, id FROM movimientos WHERE detalle = 'LIDER'").fetchone()
+    db.apply_edits(conn, pd.DataFrame({"unique_key": [lider_uk], "nota_usuario": ["editada"]}))
+
+    # Con fila viva: no se restaura ni se reemplaza la fila (conserva id y nota)
+    assert db.restore_ignored(conn) == 0
+    assert conn.execute("SELECT id, nota_usuario FROM movimientos WHERE unique_key = ?", (lider_uk,)).fetchone() == (lider_id, "editada")
+
+    # Con tombstone: tampoco
+    db.delete_transactions(conn, unique_keys=[lider_uk])
+    assert db.restore_ignored(conn) == 0
+
+    # Categoría renombrada después de ignorar la fila: se resuelve por id
+    db.rename_category(conn, "Transporte", "Movilidad")
+    db.clear_transactions(conn)
+    assert db.restore_ignored(conn) == 1
+    restaurada = db.load_all(conn)
+    assert list(restaurada["detalle"]) == ["TAXI"] and list(restaurada["categoria"]) == ["Movilidad"]
+    assert conn.execute("SELECT COUNT(*) FROM movimientos_ignorados").fetchone()[0] == 1
+    print("✅ Tombstones y filas vivas intactos; categoría por id")
+    conn.close()
+    return True
+
+def test_reglas_merchant_map():
+    """Las reglas por subcadena de merchant_map.json sugieren (confianza < 1) y no categorizan al ingerir"""
+    print("\n🧾 Probando reglas de merchant_map.json...")
+    import json
+    import pandas as pd
+    import db
+    from suggest import build_suggestions_df
+
+    conn = _base_temporal()
+    ruta = os.path.join(tempfile.mkdtemp(), "merchant_map.json")
+    with open(ruta, "w", encoding="utf-8") as fh:
+        json.dump({"UBER": "Transporte", "NETFLIX": "Streaming"}, fh)
+    original, db._MERCHANT_MAP_PATH = db._MERCHANT_MAP_PATH, ruta
+    try:
+        ingeridas = db.map_categories_for_df(conn, pd.DataFrame({"detalle_norm": ["uber trip 123"], "categoria": [None]}))
+        assert list(ingeridas["categoria"].fillna("Sin categoría")) == ["Sin categoría"]
+        # Solo hacia categorías del usuario ("Streaming" no existe)
+        assert db.lookup_merchant_rules(conn, ["uber trip 123", "netflix.com"]) == {"uber trip 123": "Transporte"}
+        sug = build_suggestions_df(pd.DataFrame({
+            "unique_key": ["a"], "detalle": ["UBER TRIP 123"], "detalle_norm": ["uber trip 123"],
+            "monto": [-3000], "categoria": ["Sin categoría"],
+        }), conn, hist_df=pd.DataFrame())
+        assert sug.loc[0, "sugerida"] == "Transporte" and sug.loc[0, "fuente"] == "Regla de comercio"
+        assert sug.loc[0, "confianza"] < 1
+    finally:
+        db._MERCHANT_MAP_PATH = original
+    print("✅ La regla queda como sugerencia")
+    conn.close()
+    return True
+
+def test_cache_metadatos():
+    """La caché de categorías distingue bases en memoria y ve lo que escribe otro proceso"""
+    print("\n🗃️ Probando caché de metadatos...")
+    import subprocess
+    from db import get_categories, get_conn, init_db, replace_categories
+
+    memorias = [get_conn(":memory:") for _ in range(2)]
+    for conn, cats in zip(memorias, (["Sin categoría", "Uno"], ["Sin categoría", "Dos"])):
+        init_db(conn)
+        replace_categories(conn, cats)
+    assert sorted(get_categories(memorias[0])) == ["Sin categoría", "Uno"]
+    assert sorted(get_categories(memorias[1])) == ["Dos", "Sin categoría"]
+
+    conn = _base_temporal()
+    ruta = conn.execute("PRAGMA database_list").fetchone()[2]
+    assert "Mascotas" not in get_categories(conn)
+    script = (
+        "import sys; sys.path.insert(0, sys.argv[1]); from db import get_conn, get_categories, replace_categories; "
+        "c = get_conn(sys.argv[2]); replace_categories(c, get_categories(c) + ['Mascotas'])"
+    )
+    subprocess.run([sys.executable, "-c", script, str(Path(__file__).parent), ruta], check=True,
+                   env={k: v for k, v in os.environ.items() if k != "DATABASE_URL"})
+    assert "Mascotas" in get_categories(conn)
+    print("✅ Caché por conexión en memoria y versión leída de la base")
+    conn.close()
+    return True
+
+def test_upsert_por_lotes():
+    """upsert_transactions inserta por lotes e ignora duplicados de la base y del mismo lote"""
+    print("\n📥 Probando inserción por lotes...")
+    import pandas as pd
+    from db import list_ignored, load_all, upsert_transactions
+
+    conn = _base_temporal()
+    lote = pd.DataFrame({
+        "fecha": pd.to_datetime(["2024-03-01", "2024-03-01", "2024-03-01", None]),
+        "detalle": ["UBER TRIP", "UBER TRIP", "LIDER EXPRESS", "SIN FECHA"],
+        "monto": [-3000, -3000, -5000, -700],
+        "categoria": ["Transporte", None, "Supermercado", None],
+    })
+    assert upsert_transactions(conn, lote) == (3, 1)
+    otro = pd.DataFrame({
+        "fecha": pd.to_datetime(["2024-03-01", "2024-03-02", None]),
+        "detalle": ["UBER TRIP", "UBER TRIP", "SIN FECHA"],
+        "monto": [-3000, -3000, -700],
+    })
+    assert upsert_transactions(conn, otro) == (1, 2)
+    df = load_all(conn)
+    assert len(df) == 4 and sorted(df["detalle"]) == ["LIDER EXPRESS", "SIN FECHA", "UBER TRIP", "UBER TRIP"]
+    assert df.loc[df["detalle"] == "LIDER EXPRESS", "categoria"].item() == "Supermercado"
+    ignorados, total = list_ignored(conn)
+    assert total == 2
+    assert int(ignorados.loc[ignorados["nombre"] == "UBER TRIP", "veces"].item()) == 2
+    print("✅ Lote insertado con los mismos duplicados que el chequeo fila a fila")
+    conn.close()
+    return True
+
+def test_apply_edits_por_lotes():
+    """apply_edits agrupa las filas por columnas editadas y clave, y aplica cada una a su movimiento"""
+    print("\n✏️ Probando ediciones por lotes...")
+    import pandas as pd
+    from db import apply_edits, load_all, upsert_transactions
+
+    conn = _base_temporal()
+    upsert_transactions(conn, pd.DataFrame({
+        "id": [1, 2, 3],
+        "fecha": pd.to_datetime(["2024-03-01", "2024-03-02", "2024-03-03"]),
+        "detalle": ["UBER TRIP", "LIDER EXPRESS", "COPEC APP"],
+        "monto": [-3000, -5000, -20000],
+    }))
+    df = load_all(conn).set_index("detalle")
+    uk = df["unique_key"]
+    n = apply_edits(conn, pd.DataFrame({
+        "unique_key": [uk["UBER TRIP"], uk["LIDER EXPRESS"], None],
+        "id": [None, None, 3],
+        "categoria": ["Transporte", "Supermercado", "Transporte"],
+        "nota_usuario": ["50% : viaje", None, "bencina"],
+    }))
+    n += apply_edits(conn, pd.DataFrame({"unique_key": [uk["UBER TRIP"]], "monto_real": [1500.0]}))
+    assert n == 4
+    df = load_all(conn).set_index("detalle")
+    assert df["categoria"].to_dict() == {"UBER TRIP": "Transporte", "LIDER EXPRESS": "Supermercado", "COPEC APP": "Transporte"}
+    assert df.loc["UBER TRIP", "nota_usuario"] == "50% : viaje" and df.loc["COPEC APP", "nota_usuario"] == "bencina"
+    assert pd.isna(df.loc["LIDER EXPRESS", "nota_usuario"])
+    assert df.loc["UBER TRIP", "monto_real"] == 1500.0 and df.loc["LIDER EXPRESS", "monto_real"] == 5000.0
+    print("✅ Ediciones aplicadas por grupo")
+    conn.close()
+    return True
+
+def test_merchant_map_aprendido():
+    """learn_merchant_map respeta soporte y confianza mínimos, desempata por fecha y no reescribe sin cambios"""
+    print("\n🧠 Probando aprendizaje de merchant_map...")
+    import json
+    import pandas as pd
+    from update_master import learn_merchant_map, update_merchant_map
+
+    df = pd.DataFrame({
+        "detalle_norm": ["UBER*TRIP 1", "UBER*TRIP 2", "UBER*EATS", "UBER*TRIP 3", "RAPPI*PRO",
+                         "LIDER*EXPRESS", "LIDER*HIPER", "LIDER*EXPRESS", "LIDER*HIPER"],
+        "categoria": ["Transporte", "Transporte", "Comida", "Transporte", "Comida",
+                      "Supermercado", "Supermercado", "Hogar", "Hogar"],
+        "fecha": pd.to_datetime(["2024-01-01", "2024-01-02", "2024-01-03", "2024-01-04", "2024-01-05",
+                                 "2024-01-01", "2024-01-02", "2024-02-01", "2024-02-02"]),
+    })
+    reglas = learn_merchant_map(df).set_index("clave")
+    # RAPPI tiene una sola fila (min_count) y LIDER queda 50/50 (min_confidence)
+    assert list(reglas.index) == ["UBER"] and reglas.loc["UBER", "categoria"] == "Transporte"
+    assert reglas.loc["UBER", "n"] == 3 and reglas.loc["UBER", "confianza"] == 0.75
+    assert "RAPPI" in learn_merchant_map(df, min_count=1)["clave"].tolist()
+    # Empate: gana la categoría vista más recientemente
+    empate = learn_merchant_map(df, min_confidence=0.5).set_index("clave")
+    assert empate.loc["LIDER", "categoria"] == "Hogar"
+
+    ruta = Path(tempfile.mkdtemp()) / "merchant_map.json"
+    config = {"merchant_map_min_count": 2, "merchant_map_min_confidence": 0.5}
+    assert update_merchant_map(df, {"UBER": "Comida"}, ruta, config) == (1, 1, 2)
+    mapa = json.loads(ruta.read_text(encoding="utf-8"))
+    assert mapa == {"UBER": "Transporte", "LIDER": "Hogar"}
+    os.utime(ruta, ns=(0, 0))
+    assert update_merchant_map(df, mapa, ruta, config) == (0, 0, 2)
+    assert ruta.stat().st_mtime_ns == 0
+    print("✅ Umbrales, desempate y escritura solo con cambios")
+    return True
+
+def test_flag_rules():
+    """FlagRules: palabras por defecto al inicio de palabra, config.json, alias en cualquier parte y caché por mtime"""
+    print("\n🚩 Probando flags por palabras clave...")
+    import json
+    import pandas as pd
+    from rules import FlagRules, flag_rules
+
+    textos = pd.Series(["TRANSFERENCIA A JUAN", "ABONOS VARIOS", "PAGO TARJETA", "SUPERABONO SPA",
+                        "CENA AMIGOS", "TEF CTA12345678", "LIDER EXPRESS"])
+    f = FlagRules().flags(textos)
+    assert f["es_transferencia_o_abono"].tolist() == [True, True, True, False, False, False, False]
+    assert f["es_compartido_posible"].tolist() == [False, False, False, False, True, False, False]
+    assert not f["es_entre_cuentas"].any()
+
+    ruta = Path(tempfile.mkdtemp()) / "config.json"
+    ruta.write_text(json.dumps({"transfer_keywords": ["devolución"], "account_aliases": ["12345678"]}), encoding="utf-8")
+    reglas = flag_rules(ruta)
+    f = reglas.flags(pd.Series(["DEVOLUCION COMPRA", "TRANSFERENCIA A JUAN", "TEF CTA12345678", "CENA AMIGOS"]))
+    assert f["es_transferencia_o_abono"].tolist() == [True, False, False, False]
+    # Alias de cuentas propias: en cualquier parte del texto, no solo al inicio de palabra
+    assert f["es_entre_cuentas"].tolist() == [False, False, True, False]
+    # Sin shared_keywords en el archivo siguen las palabras por defecto
+    assert f["es_compartido_posible"].tolist() == [False, False, False, True]
+    assert flag_rules(ruta) is reglas
+
+    ruta.write_text(json.dumps({"transfer_keywords": ["TRANSFER"]}), encoding="utf-8")
+    os.utime(ruta, ns=(10**9, 10**9))
+    nuevas = flag_rules(ruta)
+    assert nuevas is not reglas
+    assert nuevas.flags(pd.Series(["TRANSFERENCIA A JUAN"]))["es_transferencia_o_abono"].item()
+    print("✅ Flags por defecto, desde config.json y recargados al cambiar el archivo")
+    return True
+
+def test_pipeline_master():
+    """run_pipeline deduplica entre archivos y corridas, empareja reembolsos y aprende reglas (Parquet y CSV)"""
+    print("\n🚰 Probando pipeline prep -> master...")
+    import json
+    import pandas as pd
+    from master_store import MasterStore
+    from pipeline import run_pipeline
+
+    tmp = Path(tempfile.mkdtemp())
+    (tmp / "a.csv").write_text(
+        "Fecha,Detalle,Monto\n01/03/2024,LIDER*EXPRESS 1,-5000\n02/03/2024,LIDER*EXPRESS 2,-7000\n"
+        "03/03/2024,CENA RESTAURANT,-20000\n", encoding="utf-8")
+    (tmp / "b.csv").write_text(
+        "Fecha,Detalle,Monto\n02/03/2024,LIDER*EXPRESS 2,-7000\n10/03/2024,DEVOLUCION CENA,19500\n", encoding="utf-8")
+    entradas = [str(tmp / "a.csv"), str(tmp / "b.csv")]
+
+    for master in (tmp / "master", tmp / "master.csv"):
+        mapa = tmp / f"merchant_map_{master.name}.json"
+        mapa.write_text(json.dumps({"EXPRESS": "Supermercado"}), encoding="utf-8")
+        for corrida, esperado in ((1, [3, 1]), (2, [0, 0])):
+            etapas = run_pipeline(entradas, str(master), str(mapa), str(tmp / "config.json"))
+            assert [f[2] for f in etapas.filas if f[0] == "dedup"] == esperado, (master.name, corrida)
+        df = (MasterStore(master).read() if master.suffix != ".csv" else pd.read_csv(master)).set_index("detalle_norm")
+        assert len(df) == 4
+        assert df.loc["DEVOLUCION CENA", "match_id"] == df.loc["CENA RESTAURANT", "id"]
+        assert df["match_id"].notna().sum() == 1
+        assert df.loc["LIDER*EXPRESS 1", "categoria"] == "Supermercado"
+        assert json.loads(mapa.read_text(encoding="utf-8")) == {"EXPRESS": "Supermercado", "LIDER": "Supermercado"}
+    print("✅ Mismo resultado con master Parquet y CSV, sin duplicados al repetir")
+    return True
+
+def test_nombre_aproximado():
+    """MinHash LSH encuentra nombres mal escritos y "Nombre aproximado" solo actúa sin fuentes previas"""
+    print("\n🔤 Probando nombres aproximados...")
+    import pandas as pd
+    from db import load_all, update_categoria_map_from_df, upsert_transactions
+    from suggest import MinHashLSH, _jaccard, _shingles, build_suggestions_df, history_for_similarity
+
+    historial = ["LIDER EXPRESS", "UBER EATS", "COPEC APP", "FARMACIA CRUZ VERDE"]
+    consultas = ["XIDER EXPRESS", "EATS UBER", "FRAMACIA CRUZ VERDE", "ZZZZ"]
+    encontrados = MinHashLSH(historial).consultar(consultas)
+    for nombre, pares in zip(consultas, encontrados):
+        exactos = [i for i, h in enumerate(historial) if _jaccard(_shingles(nombre), _shingles(h)) >= 0.5]
+        assert [i for i, _ in pares] == exactos, nombre
+    assert encontrados[3] == []
+
+    conn = _base_temporal()
+    upsert_transactions(conn, pd.DataFrame({
+        "fecha": pd.to_datetime(["2024-03-01", "2024-03-08", "2024-03-10", "2024-03-11"]),
+        "detalle": ["LIDER EXPRESS", "LIDER EXPRESS", "XIDER EXPRESS", "LIDER EXPRES"],
+        "monto": [-5000, -6000, -5500, -5200],
+        "categoria": ["Supermercado", "Supermercado", None, None],
+    }))
+
+    def fuentes():
+        df = load_all(conn)
+        sug = build_suggestions_df(df, conn, hist_df=history_for_similarity(df))
+        return {d.upper(): (s, f) for d, s, f in zip(sug["detalle_norm"], sug["sugerida"], sug["fuente"])}
+
+    sug = fuentes()
+    # Sin coincidencia exacta ni por prefijo ("XIDE"): sugerencia aproximada
+    assert sug["XIDER EXPRESS"][0] == "Supermercado" and sug["XIDER EXPRESS"][1].startswith("Nombre aproximado")
+    # El prefijo "LIDE" ya encuentra el historial: gana "Nombres similares"
+    assert sug["LIDER EXPRES"][1].startswith("Nombres similares")
+    # Con una regla exacta, el nombre aproximado no se usa
+    update_categoria_map_from_df(conn, pd.DataFrame({"detalle_norm": ["xider express"], "categoria": ["Transporte"]}))
+    assert fuentes()["XIDER EXPRESS"] == ("Transporte", "Mapa exacto")
+    print("✅ Candidatos LSH iguales al Jaccard exacto y orden de fuentes respetado")
+    conn.close()
+    return True
+
+def test_aceptar_sugerencias():
+    """accept_suggestions aplica sobre el umbral en una transacción y guarda las reglas en categoria_map"""
+    print("\n✅ Probando aceptación masiva de sugerencias...")
+    import pandas as pd
+    import db
+    from db import accept_suggestions, count_pending, load_all, lookup_categoria_map, save_suggestions, upsert_transactions
+
+    conn = _base_temporal()
+    detalles = ["LIDER EXPRESS", "COPEC APP", "TIENDA RARA", "UBER TRIP"]
+    upsert_transactions(conn, pd.DataFrame({
+        "fecha": pd.to_datetime(["2024-03-01", "2024-03-02", "2024-03-03", "2024-03-04"]),
+        "detalle": detalles, "monto": [-5000, -20000, -1000, -3000],
+    }))
+    df = load_all(conn).set_index("detalle")
+    save_suggestions(conn, pd.DataFrame({
+        "unique_key": [df.loc[d, "unique_key"] for d in detalles],
+        "sugerida": ["Supermercado", "Transporte", "Mascotas", "Transporte"],
+        "fuente": ["Mapa exacto", "Nombres similares (0.50)", "Mapa exacto", "Historial dominante"],
+        "confianza": [1.0, 0.5, 0.95, 0.85],
+        "alternativas_sim": [[], [], [], []],
+    }))
+    assert count_pending(conn) == 4 and count_pending(conn, 0.8) == 3
+
+    # Si algo falla a mitad de camino no queda nada aplicado
+    original = db._refresh_comercio_stats
+    db._refresh_comercio_stats = lambda *a, **k: (_ for _ in ()).throw(RuntimeError("falla simulada"))
+    try:
+        accept_suggestions(conn, 0.8)
+        raise AssertionError("accept_suggestions debía fallar")
+    except RuntimeError:
+        pass
+    finally:
+        db._refresh_comercio_stats = original
+    assert load_all(conn)["categoria"].isna().all() and count_pending(conn) == 4
+    assert lookup_categoria_map(conn, ["lider express"]) == {}
+
+    aplicadas = accept_suggestions(conn, 0.8)
+    # "Mascotas" no es una categoría del usuario y COPEC queda bajo el umbral
+    assert sorted(aplicadas["categoria"]) == ["Supermercado", "Transporte"]
+    df = load_all(conn).set_index("detalle")
+    assert df.loc["LIDER EXPRESS", "categoria"] == "Supermercado" and df.loc["UBER TRIP", "categoria"] == "Transporte"
+    assert pd.isna(df.loc["COPEC APP", "categoria"]) and pd.isna(df.loc["TIENDA RARA", "categoria"])
+    assert lookup_categoria_map(conn, ["lider express", "uber trip", "copec app"]) == {
+        "lider express": "Supermercado", "uber trip": "Transporte"}
+    assert count_pending(conn) == 2
+    assert accept_suggestions(conn, 0.0, fuente="Mapa exacto").empty
+    print("✅ Umbral, transacción única y reglas guardadas")
+    conn.close()
+    return True
+
+def test_cola_pendientes():
+    """count_pending y la columna pendiente siguen las recategorizaciones y los cambios de categorías"""
+    print("\n📥 Probando cola de pendientes...")
+    import pandas as pd
+    from db import apply_edits, count_pending, load_all, rename_category, save_suggestions, upsert_transactions
+
+    conn = _base_temporal()
+    upsert_transactions(conn, pd.DataFrame({
+        "fecha": pd.to_datetime(["2024-04-01", "2024-04-02", "2024-04-03"]),
+        "detalle": ["LIDER", "METRO", "JUMBO"], "monto": [-5000, -800, -9000],
+    }))
+    claves = load_all(conn).set_index("detalle")["unique_key"]
+
+    def editar(**cats):
+        apply_edits(conn, pd.DataFrame({"unique_key": [claves[d] for d in cats], "categoria": list(cats.values())}))
+
+    def pendiente_consistente():
+        # La columna mantenida por los triggers coincide con recalcularla desde categorias
+        return conn.execute(
+            "SELECT COUNT(*) FROM movimientos m LEFT JOIN categorias c ON c.id = m.categoria_id "
+            "WHERE m.pendiente != (m.categoria_id IS NULL OR COALESCE(c.nombre = 'Sin categoría', 0))"
+        ).fetchone()[0] == 0
+
+    assert count_pending(conn) == 3 and pendiente_consistente()
+    editar(LIDER="Supermercado", METRO="Transporte")
+    assert count_pending(conn) == 1 and pendiente_consistente()
+    editar(METRO="Sin categoría")
+    assert count_pending(conn) == 2 and pendiente_consistente()
+
+    # Renombrar no cambia la cola; fusionar en "Sin categoría" devuelve sus movimientos a ella
+    rename_category(conn, "Supermercado", "Súper")
+    assert count_pending(conn) == 2 and pendiente_consistente()
+    rename_category(conn, "Súper", "Sin categoría")
+    assert count_pending(conn) == 3 and pendiente_consistente()
+
+    save_suggestions(conn, pd.DataFrame({
+        "unique_key": [claves["LIDER"], claves["JUMBO"]], "sugerida": ["Transporte", "Transporte"],
+        "fuente": ["Mapa exacto", "Historial dominante"], "confianza": [0.95, 0.6], "alternativas_sim": [[], []],
+    }))
+    assert count_pending(conn, 0.8) == 1 and count_pending(conn, fuente="Historial") == 1
+    editar(LIDER="Transporte")
+    assert count_pending(conn, 0.8) == 0 and count_pending(conn) == 2 and pendiente_consistente()
+    print("✅ Cola y columna pendiente consistentes")
+    conn.close()
+    return True
+
+def test_stats_comercio():
+    """comercio_categoria_stats y get_dominant_categories siguen a apply_edits y a los borrados"""
+    print("\n🏪 Probando estadísticas por comercio...")
+    import pandas as pd
+    from db import apply_edits, delete_transactions, get_dominant_categories, load_all, upsert_transactions
+
+    conn = _base_temporal()
+    upsert_transactions(conn, pd.DataFrame({
+        "fecha": pd.to_datetime(["2024-05-01", "2024-05-02", "2024-05-03", "2024-05-04", "2024-05-05"]),
+        "detalle": ["ALMACEN DON PEPE", "ALMACEN DON PEPE", "ALMACEN DON PEPE", "ALMACEN DON PEPE", "KIOSKO LUCHO"],
+        "monto": [-1000, -2000, -3000, -4000, -5000],
+    }))
+    df = load_all(conn).sort_values("fecha")
+    lider = int(df.loc[df["detalle"] == "ALMACEN DON PEPE", "comercio_id"].iloc[0])
+    copec = int(df.loc[df["detalle"] == "KIOSKO LUCHO", "comercio_id"].iloc[0])
+    k = df["unique_key"].tolist()
+
+    def editar(cats):
+        apply_edits(conn, pd.DataFrame({"unique_key": list(cats), "categoria": list(cats.values())}))
+
+    def stats_consistentes():
+        # La tabla coincide con recalcular los conteos desde movimientos
+        guardadas = conn.execute("SELECT comercio_id, categoria_id, n FROM comercio_categoria_stats ORDER BY 1, 2").fetchall()
+        esperadas = conn.execute(
+            "SELECT comercio_id, categoria_id, COUNT(*) FROM movimientos WHERE comercio_id IS NOT NULL "
+            "AND categoria_id IS NOT NULL GROUP BY comercio_id, categoria_id ORDER BY 1, 2"
+        ).fetchall()
+        return [tuple(r) for r in guardadas] == [tuple(r) for r in esperadas]
+
+    assert get_dominant_categories(conn, [lider, copec]) == {} and stats_consistentes()
+    editar({k[0]: "Supermercado", k[1]: "Supermercado", k[2]: "Supermercado", k[3]: "Transporte", k[4]: "Transporte"})
+    assert get_dominant_categories(conn, [lider, copec]) == {lider: ("Supermercado", 75.0), copec: ("Transporte", 100.0)}
+    assert stats_consistentes()
+
+    # Empate 2-2: gana por nombre; "Sin categoría" no cuenta para el porcentaje
+    editar({k[0]: "Transporte"})
+    assert get_dominant_categories(conn, [lider]) == {lider: ("Supermercado", 50.0)} and stats_consistentes()
+    editar({k[1]: "Sin categoría"})
+    cat, pct = get_dominant_categories(conn, [lider])[lider]
+    assert cat == "Transporte" and round(pct, 2) == 66.67 and stats_consistentes()
+
+    delete_transactions(conn, unique_keys=[k[0], k[3]])
+    assert get_dominant_categories(conn, [lider]) == {lider: ("Supermercado", 100.0)} and stats_consistentes()
+    delete_transactions(conn, unique_keys=[k[1], k[2], k[4]])
+    assert get_dominant_categories(conn, [lider, copec]) == {} and stats_consistentes()
+    assert conn.execute("SELECT COUNT(*) FROM comercio_categoria_stats").fetchone()[0] == 0
+    print("✅ Estadísticas por comercio al día tras ediciones y borrados")
+    conn.close()
+    return True
+
+def test_master_parquet():
+    """MasterStore agrega solo ids nuevos, lee por ventana y no duplica tras una corrida interrumpida"""
+    print("\n🗂️ Probando master Parquet...")
+    import pandas as pd
+    from master_store import MasterStore
+
+    raiz = Path(tempfile.mkdtemp()) / "master"
+    df = pd.DataFrame({
+        "id": ["a", "b", "c"],
+        "fecha": pd.to_datetime(["2024-01-10", "2024-02-05", "2024-02-20"]),
+        "monto": [-1000, -2000, 2000],
+        "detalle_norm": ["UBER", "LIDER", "LIDER"],
+    })
+    store = MasterStore(raiz)
+    assert store.append(df) == 3
+    assert store.append(df) == 0 and len(store) == 3
+    assert store.months() == ["2024-01", "2024-02"]
+    feb = store.read("2024-02-01", "2024-02-29", columns=["id", "monto"])
+    assert sorted(feb["id"]) == ["b", "c"] and list(feb.columns) == ["id", "monto"]
+    assert store.add_matches(pd.DataFrame({"id": ["c"], "match_id": ["b"]})) == 1
+    assert MasterStore(raiz).read().set_index("id").loc["c", "match_id"] == "b"
+
+    # Particiones escritas sin índice (corrida cortada antes de _ids.parquet)
+    (raiz / "_ids.parquet").unlink()
+    store = MasterStore(raiz)
+    assert store.append(df) == 0 and len(store) == 3
+    assert len(store.read()) == 3 and MasterStore(raiz).contains(df["id"]).all()
+    print("✅ Master Parquet sin filas repetidas")
+    return True
+
+def test_agregaciones_por_categoria():
+    """Los gráficos agrupan por categoria_id y muestran el nombre vigente tras renombrar"""
+    print("\n📊 Probando agregaciones por categoría...")
+    import pandas as pd
+    from streamlit.testing.v1 import AppTest
+    from db import get_conn, init_db, rename_category, replace_categories, upsert_transactions
+
+    previo, tmp = os.getcwd(), tempfile.mkdtemp()
+    os.chdir(tmp)
+    url = os.environ.pop("DATABASE_URL", None)
+    try:
+        conn = get_conn()
+        init_db(conn)
+        replace_categories(conn, ["Sin categoría", "Supermercado", "Transporte"])
+        upsert_transactions(conn, pd.DataFrame({
+            "fecha": pd.to_datetime(["2024-03-01", "2024-03-02", "2024-03-03"]),
+            "detalle": ["UBER TRIP", "COPEC APP", "LIDER EXPRESS"],
+            "monto": [-30000, -25000, -40000],
+            "categoria": ["Transporte", "Transporte", "Supermercado"],
+        }))
+        rename_category(conn, "Transporte", "Movilidad")
+        conn.close()
+
+        at = AppTest.from_file(str(Path(__file__).parent / "app.py"), default_timeout=120)
+        at.run()
+        assert not at.exception, [e.value for e in at.exception]
+        assert any("**Movilidad**" in c.value for c in at.caption), [c.value for c in at.caption]
+    finally:
+        os.chdir(previo)
+        if url is not None:
+            os.environ["DATABASE_URL"] = url
+    print("✅ Totales por id con la etiqueta nueva")
+    return True
+
+def test_match_pairs():
+    """match_pairs asigna uno a uno como la búsqueda exhaustiva voraz, respetando ventana y tolerancia"""
+    print("\n🧮 Probando emparejamiento gasto <-> abono...")
+    import numpy as np
+    from matching import match_pairs
+
+    dia = 86_400_000_000_000
+    # Abono antes del gasto, fuera de ventana o fuera de tolerancia: sin pareja
+    g, a, _ = match_pairs([10 * dia], [5000], [5 * dia, 40 * dia, 11 * dia], [5000, 5000, 7000], window_days=21, tol=1000)
+    assert len(g) == 0
+    # Dos abonos para un gasto: gana el de menor diferencia
+    g, a, d = match_pairs([0], [5000], [dia, 2 * dia], [4500, 5000], window_days=21, tol=1000)
+    assert list(zip(g, a)) == [(0, 1)] and d[0] == 0
+    # Incremental: solo pares con algún lado nuevo
+    g, a, _ = match_pairs([0, dia], [5000, 8000], [2 * dia, 3 * dia], [5000, 8000], g_nuevo=[False, True], a_nuevo=[False, False])
+    assert list(zip(g, a)) == [(1, 1)]
+
+    rng = np.random.default_rng(3)
+    g_ns = rng.integers(0, 120 * dia, 300)
+    a_ns = rng.integers(0, 120 * dia, 200)
+    g_m = rng.integers(1, 60, 300) * 500.0 + rng.random(300)
+    a_m = rng.integers(1, 60, 200) * 500.0 + rng.random(200)
+    candidatos = sorted(
+        (abs(g_m[i] - a_m[j]), -g_ns[i], a_ns[j], i, j)
+        for i in range(len(g_ns)) for j in range(len(a_ns))
+        if abs(g_m[i] - a_m[j]) <= 1000 and a_ns[j] - 21 * dia <= g_ns[i] <= a_ns[j]
+    )
+    esperado, usados_g, usados_a = set(), set(), set()
+    for _, _, _, i, j in candidatos:
+        if i not in usados_g and j not in usados_a:
+            esperado.add((i, j))
+            usados_g.add(i)
+            usados_a.add(j)
+    g, a, _ = match_pairs(g_ns, g_m, a_ns, a_m, window_days=21, tol=1000)
+    assert set(zip(g.tolist(), a.tolist())) == esperado and len(esperado) > 0
+    print(f"✅ {len(esperado)} pares iguales a la búsqueda exhaustiva")
+    return True
+
+def test_migracion_base_antigua():
+    """init_db migra una base con el esquema original (categoria como texto, sin usuario)"""
+    print("\n🧱 Probando migración de una base antigua...")
+    import sqlite3
+    import pandas as pd
+    from db import (get_categories, get_conn, init_db, list_ignored, load_all, lookup_categoria_map,
+                    rename_category, upsert_transactions)
+
+    ruta = os.path.join(tempfile.mkdtemp(), "gastos.db")
+    raw = sqlite3.connect(ruta)
+    raw.executescript("""
+        CREATE TABLE movimientos (id INTEGER, fecha TEXT, detalle TEXT, monto REAL, es_gasto INTEGER,
+            es_transferencia_o_abono INTEGER, es_compartido_posible INTEGER, fraccion_mia_sugerida REAL,
+            monto_mio_estimado REAL, categoria_sugerida TEXT, detalle_norm TEXT, monto_real REAL,
+            categoria TEXT, nota_usuario TEXT, unique_key TEXT UNIQUE);
+        CREATE TABLE movimientos_ignorados (id INTEGER PRIMARY KEY AUTOINCREMENT, unique_key TEXT UNIQUE,
+            payload TEXT, created_at TEXT DEFAULT (DATETIME('now')));
+        CREATE TABLE categorias (nombre TEXT UNIQUE);
+        CREATE TABLE categoria_map (detalle_norm TEXT PRIMARY KEY, categoria TEXT);
+        INSERT INTO categorias VALUES ('Sin categoría'), ('Transporte'), ('Supermercado');
+        INSERT INTO categoria_map VALUES ('uber trip', 'Transporte');
+        INSERT INTO movimientos (fecha, detalle, detalle_norm, monto, monto_real, categoria, unique_key) VALUES
+            ('2024-03-01', 'UBER TRIP', 'uber trip', -3000, 3000, 'Transporte', 'k1'),
+            ('2024-03-02', 'LIDER EXPRESS', 'lider express', -5000, 5000, 'Supermercado', 'k2');
+        INSERT INTO movimientos_ignorados (unique_key, payload) VALUES ('k3', '{"detalle": "COPEC"}');
+    """)
+    raw.close()
+
+    conn = get_conn(ruta)
+    init_db(conn)
+    init_db(conn)  # idempotente sobre la base ya migrada
+    assert sorted(get_categories(conn)) == ["Sin categoría", "Supermercado", "Transporte"]
+    df = load_all(conn).set_index("unique_key")
+    assert df.loc["k1", "categoria"] == "Transporte" and df.loc["k2", "categoria"] == "Supermercado"
+    assert df["categoria_id"].notna().all() and df["comercio"].tolist() == ["UBER TRIP", "LIDER EXPRESS"]
+    assert lookup_categoria_map(conn, ["uber trip"]) == {"uber trip": "Transporte"}
+    ignorados, total = list_ignored(conn)
+    assert total == 1 and ignorados.loc[0, "nombre"] == "COPEC"
+
+    rename_category(conn, "Transporte", "Movilidad")
+    assert load_all(conn).set_index("unique_key").loc["k1", "categoria"] == "Movilidad"
+    assert lookup_categoria_map(conn, ["uber trip"]) == {"uber trip": "Movilidad"}
+    nuevo = pd.DataFrame({"fecha": pd.to_datetime(["2024-03-01"]), "detalle": ["UBER TRIP"], "monto": [-3000]})
+    assert upsert_transactions(conn, nuevo) == (0, 1)
+    print("✅ Base antigua migrada con ids de categoría y comercio")
+    conn.close()
+    return True
+
+def test_clasificador_naive_bayes():
+    """NaiveBayesModel puntúa por trigramas y monto, solo entre categorías válidas"""
+    print("\n🤖 Probando clasificador Naive Bayes...")
+    import numpy as np
+    import pandas as pd
+    from classifier import NaiveBayesModel, _conteos
+
+    entrenamiento = pd.DataFrame({
+        "detalle_norm": ["UBER TRIP", "UBER TRIP HELP", "CABIFY", "LIDER EXPRESS", "JUMBO COSTANERA", "LIDER HIPER"],
+        "monto": [-3000, -4500, -5000, -25000, -40000, -32000],
+        "categoria_id": [1, 1, 1, 2, 2, 2],
+    })
+    modelo = NaiveBayesModel(_conteos(entrenamiento["detalle_norm"], entrenamiento["monto"], entrenamiento["categoria_id"]))
+    assert not modelo.vacio and list(modelo.clases) == [1, 2]
+
+    pendientes = pd.DataFrame({"detalle_norm": ["UBER EATS", "LIDER SANTIAGO", "ZZZ"], "monto": [-3500, -30000, -1]})
+    probs, con_datos = modelo.probabilidades(pendientes["detalle_norm"], pendientes["monto"], np.array([1, 2]))
+    assert np.allclose(probs.sum(axis=1), 1.0)
+    assert probs[0].argmax() == 0 and probs[1].argmax() == 1 and probs[1, 1] > 0.6
+    assert list(con_datos) == [True, True, False]  # "ZZZ" no comparte trigramas ni tramo de monto
+
+    # Una categoría que ya no es válida no recibe probabilidad
+    probs, _ = modelo.probabilidades(pendientes["detalle_norm"], pendientes["monto"], np.array([2]))
+    assert (probs[:, 0] == 0).all() and np.allclose(probs[:, 1], 1.0)
+
+    # Restar los conteos de una corrección deja la otra categoría como la más probable
+    uber = entrenamiento[entrenamiento["categoria_id"] == 1]
+    corregido = modelo.con(_conteos(uber["detalle_norm"], uber["monto"], uber["categoria_id"], -1.0))
+    probs, _ = corregido.probabilidades(pendientes["detalle_norm"][:1], pendientes["monto"][:1], np.array([1, 2]))
+    assert probs[0].argmax() == 1
+    print("✅ Probabilidades normalizadas y por categoría válida")
+    return True
+
+def test_particion_unicidad():
+    """Con movimientos particionados por mes, la misma clave no entra dos veces (ni con otra hora)"""
+    print("\n🗂️ Probando unicidad en movimientos particionados (Postgres)...")
+    url = os.environ.get("TEST_DATABASE_URL", "").strip()
+    if not url:
+        print("⏭️ TEST_DATABASE_URL no definida: se omite (requiere una base Postgres desechable)")
+        return True
+    import pandas as pd
+    from sqlalchemy import text
+    import db
+
+    conn = {"engine": db._get_engine(url), "pg": True, "usuario": "prueba-particion"}
+    db.init_db(conn)
+    db.replace_categories(conn, ["Sin categoría"])
+    db.clear_transactions(conn)
+    with conn["engine"].begin() as e:
+        e.execute(text("DELETE FROM movimientos_borrados WHERE usuario = 'prueba-particion'"))
+    filas = pd.DataFrame({"fecha": ["2024-01-05", "2024-02-07"], "detalle": ["UBER", "LIDER"], "monto": [-1000, -2000]})
+    assert db.upsert_transactions(conn, filas) == (2, 0)
+    db.partition_movimientos_by_month(conn)
+    db.init_db(conn)
+    with conn["engine"].begin() as e:
+        uk, fecha = e.execute(text(
+            "SELECT unique_key, fecha FROM movimientos WHERE usuario = 'prueba-particion' ORDER BY fecha LIMIT 1"
+        )).fetchone()
+        otra_hora = e.execute(text(
+            "WITH ins AS (INSERT INTO movimientos (usuario, unique_key, fecha, detalle, monto) "
+            "VALUES ('prueba-particion', :uk, CAST(:f AS TIMESTAMP) + interval '3 hours', 'UBER', -1000) "
+            "ON CONFLICT DO NOTHING RETURNING 1) SELECT COUNT(*) FROM ins"
+        ), {"uk": uk, "f": fecha}).scalar()
+    assert otra_hora == 0
+    assert db.upsert_transactions(conn, filas) == (0, 2)
+    db.delete_transactions(conn, unique_keys=[uk])
+    with conn["engine"].begin() as e:
+        claves = e.execute(text("SELECT COUNT(*) FROM movimientos_claves WHERE usuario = 'prueba-particion'")).scalar()
+    assert claves == 1
+    db.clear_transactions(conn)
+    print("✅ Claves únicas por usuario aunque cambie la hora; borrar libera la clave")
+    return True
+
 def main():
     """Función principal de pruebas"""
     print("🚀 Iniciando pruebas del Dashboard de Facto$...\n")
@@ -115,6 +955,29 @@ def main():
         ("Base de datos", test_database),
         ("Configuración Streamlit", test_streamlit_config),
         ("Dependencias", test_requirements),
+        ("Reembolsos", test_reembolsos),
+        ("Vaciar movimientos", test_vaciar_movimientos),
+        ("Comercios canónicos", test_comercios_canonicos),
+        ("Sugerencias vigentes", test_sugerencias_vigentes),
+        ("Ignorados y tombstones", test_ignorados_y_tombstones),
+        ("Restaurar ignorados", test_restaurar_ignorados),
+        ("Reglas de merchant_map", test_reglas_merchant_map),
+        ("Caché de metadatos", test_cache_metadatos),
+        ("Inserción por lotes", test_upsert_por_lotes),
+        ("Ediciones por lotes", test_apply_edits_por_lotes),
+        ("Aprendizaje de merchant_map", test_merchant_map_aprendido),
+        ("Flags por palabras clave", test_flag_rules),
+        ("Nombre aproximado", test_nombre_aproximado),
+        ("Aceptar sugerencias", test_aceptar_sugerencias),
+        ("Cola de pendientes", test_cola_pendientes),
+        ("Estadísticas por comercio", test_stats_comercio),
+        ("Master Parquet", test_master_parquet),
+        ("Pipeline prep -> master", test_pipeline_master),
+        ("Agregaciones por categoría", test_agregaciones_por_categoria),
+        ("Emparejamiento de pares", test_match_pairs),
+        ("Migración de base antigua", test_migracion_base_antigua),
+        ("Clasificador Naive Bayes", test_clasificador_naive_bayes),
+        ("Unicidad con particiones", test_particion_unicidad),
     ]
     
     results = []
@@ -1,7 +1,10 @@
 \
 import pandas as pd, numpy as np, argparse, json, re
 from pathlib import Path
-from datetime import timedelta
+
+from master_store import MasterStore
+from matching import match_pairs
+from rules import FlagRules, MerchantRules, flag_rules, merchant_rules
 
 ROOT = Path(__file__).resolve().parent
 DATA = ROOT / "data"
@@ -13,6 +16,14 @@ def norm_text(s):
     s2 = ''.join(ch for ch in s2 if unicodedata.category(ch) != 'Mn')
     return re.sub(r'\s+', ' ', s2).strip().upper()
 
+DEFAULT_CONFIG = {
+    "account_aliases": [],
+    "reimbursement_window_days": 21,
+    "reimbursement_amount_tolerance": 1000,
+    "merchant_map_min_count": 2,
+    "merchant_map_min_confidence": 0.6
+}
+
 def load_json(path, default):
     p = Path(path)
     if p.exists():
@@ -22,53 +33,196 @@ def load_json(path, default):
     return default
 
 def apply_merchant_map(df, merchant_map):
+    # merchant_map: dict o reglas ya compiladas (rules.merchant_rules, en caché por mtime);
+    # gana la primera clave del mapa contenida en detalle_norm, en una sola pasada por texto
     df = df.copy()
-    cats = []
-    for t in df['detalle_norm']:
-        cat = None
-        for key, val in merchant_map.items():
-            if key in t:
-                cat = val; break
-        cats.append(cat)
-    df['categoria'] = df['categoria'].fillna(pd.Series(cats, index=df.index))
+    reglas = merchant_map if isinstance(merchant_map, MerchantRules) else MerchantRules(merchant_map)
+    df['categoria'] = df['categoria'].fillna(reglas.categorize(df['detalle_norm'].fillna('').astype(str)))
+    return df
+
+def apply_flags(df, reglas):
+    # Flags de palabras clave (rules.FlagRules) para filas que no los traen desde prep.py
+    df = df.copy()
+    reglas = reglas if isinstance(reglas, FlagRules) else FlagRules(reglas)
+    marcas = reglas.flags(df['detalle_norm'].fillna('').astype(str))
+    for col in marcas.columns:
+        if col in df.columns:
+            df[col] = df[col].where(df[col].notna(), marcas[col]).astype(bool)
+        else:
+            df[col] = marcas[col]
     return df
 
 def mark_own_transfers(df, account_aliases):
-    pats = [re.escape(a.upper()) for a in account_aliases]
-    rx = re.compile("|".join(pats)) if pats else None
-    if rx is None:
-        df['es_entre_cuentas'] = False
-    else:
-        df['es_entre_cuentas'] = df['detalle_norm'].str.contains(rx)
+    # Misma regla que la base (rules.FLAG_KEYWORDS['es_entre_cuentas']): alias en cualquier parte
+    marcas = FlagRules({'account_aliases': account_aliases}).flags(df['detalle_norm'].fillna('').astype(str))
+    df['es_entre_cuentas'] = marcas['es_entre_cuentas']
     return df
 
 def match_reimbursements(df, window_days=21, tol=1000):
-    # Busca abonos (+) que compensen gastos (-) previos de similar monto.
+    # Busca abonos (+) que compensen gastos (-) previos de similar monto, uno a uno
+    # (matching.match_pairs: barrido con searchsorted, asignación voraz por monto y fecha).
     df = df.sort_values('fecha')
     df['match_id'] = None
-    # index para búsqueda rápida por monto aproximado
-    gastos = df[df['monto'] < 0][['id','fecha','monto','detalle_norm']].copy()
-    abonos = df[df['monto'] > 0][['id','fecha','monto','detalle_norm']].copy()
-
-    for idx, row in abonos.iterrows():
-        monto = row['monto']
-        fmin = row['fecha'] - timedelta(days=window_days)
-        candidates = gastos[(gastos['fecha'] >= fmin) & (gastos['fecha'] <= row['fecha'])]
-        # diferencia de montos inversos dentro de tolerancia
-        diff = (candidates['monto'].abs() - abs(monto)).abs()
-        near = candidates[diff <= tol].copy()
-        if len(near):
-            # pick the closest by amount, then most recent
-            near['absdiff'] = diff.loc[near.index]
-            best = near.sort_values(['absdiff','fecha'], ascending=[True, False]).head(1)
-            g_id = best['id'].iloc[0]
-            df.loc[idx, 'match_id'] = g_id
+    fechas = pd.to_datetime(df['fecha'], errors='coerce')
+    montos = pd.to_numeric(df['monto'], errors='coerce')
+    g = np.flatnonzero((montos < 0).to_numpy() & fechas.notna().to_numpy())
+    a = np.flatnonzero((montos > 0).to_numpy() & fechas.notna().to_numpy())
+    ns = fechas.to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    amt = montos.abs().to_numpy(dtype=float)
+    gi, ai, _ = match_pairs(ns[g], amt[g], ns[a], amt[a], window_days, tol)
+    if len(ai):
+        df.iloc[a[ai], df.columns.get_loc('match_id')] = df['id'].to_numpy()[g[gi]]
+    return df
+
+def learn_merchant_map(df, min_count=2, min_confidence=0.6):
+    # Reglas aprendidas de las filas categorizadas: clave = detalle_norm antes de '*';
+    # por clave, la categoría mayoritaria (empate: la vista más recientemente) con su
+    # soporte y confianza (fracción de filas de la clave con esa categoría).
+    cols = ['clave', 'categoria', 'n', 'confianza', 'ultima_fecha']
+    if df.empty or 'categoria' not in df.columns:
+        return pd.DataFrame(columns=cols)
+    det = df['detalle_norm'].fillna('').astype(str)
+    cat = df['categoria'].where(df['categoria'].map(lambda v: isinstance(v, str)), '').str.strip()
+    clave = det.str.split('*').str[0].str.strip()
+    ok = (cat != '') & (det.str.len() > 3) & (clave.str.len() >= 3)
+    if not ok.any():
+        return pd.DataFrame(columns=cols)
+    fechas = pd.to_datetime(df['fecha'], errors='coerce') if 'fecha' in df.columns else pd.Series(pd.NaT, index=df.index)
+    base = pd.DataFrame({'clave': clave[ok], 'categoria': cat[ok], 'fecha': fechas[ok]})
+    g = base.groupby(['clave', 'categoria'], sort=False).agg(n=('fecha', 'size'), ultima_fecha=('fecha', 'max')).reset_index()
+    g['total'] = g.groupby('clave')['n'].transform('sum')
+    g = g.sort_values(['clave', 'n', 'ultima_fecha'], ascending=[True, False, False], na_position='last')
+    top = g.drop_duplicates('clave').copy()
+    top['confianza'] = top['n'] / top['total']
+    top = top[(top['n'] >= min_count) & (top['confianza'] >= min_confidence)]
+    return top[cols].reset_index(drop=True)
+
+def merge_learned_rules(merchant_map, learned):
+    # Solo reglas nuevas o cuya categoría cambió; devuelve (mapa, n_nuevas, n_cambiadas)
+    merged = dict(merchant_map)
+    nuevas = cambiadas = 0
+    for key, cat in zip(learned['clave'], learned['categoria']):
+        prev = merged.get(key)
+        if prev == cat:
+            continue
+        if prev is None:
+            nuevas += 1
+        else:
+            cambiadas += 1
+        merged[key] = cat
+    return merged, nuevas, cambiadas
+
+def update_merchant_map(df, merchant_map, path, config):
+    # Learn merchant_map from rows with categoria manual (vectorizado, con umbral de confianza);
+    # el archivo solo se reescribe si hay reglas nuevas o cambiadas
+    learned = learn_merchant_map(df,
+        min_count=int(config.get("merchant_map_min_count", 2)),
+        min_confidence=float(config.get("merchant_map_min_confidence", 0.6)))
+    merchant_map, nuevas, cambiadas = merge_learned_rules(merchant_map, learned)
+    if nuevas or cambiadas:
+        Path(path).write_text(json.dumps(merchant_map, ensure_ascii=False, indent=2), encoding='utf-8')
+    return nuevas, cambiadas, len(learned)
+
+def drop_known_ids(df_new, store=None, df_master=None):
+    # Dedup by 'id' (Parquet: consulta el índice de ids, sin leer filas del master)
+    if store is not None:
+        return df_new[~store.contains(df_new['id'])].copy()
+    ids_master = set(df_master['id'].astype(str)) if df_master is not None and len(df_master) else set()
+    return df_new[~df_new['id'].astype(str).isin(ids_master)].copy()
+
+def enrich_new(df_new, config, reglas_flags, reglas_mapa):
+    # Flags, merchant map y transferencias propias: todo por fila, sin mirar el master
+    df_new = apply_flags(df_new, reglas_flags)
+    df_new = apply_merchant_map(df_new, reglas_mapa)
+    return mark_own_transfers(df_new, [a.upper() for a in config.get("account_aliases", [])])
+
+def compute_monto_mio(df):
+    # monto_mio por fila, según categoria/fracción y excluyendo transferencias propias
+    if 'fraccion_mia' not in df.columns:
+        df['fraccion_mia'] = np.where(df.get('es_compartido_posible', False), 0.5, 1.0)
+    df['es_gasto'] = (df['monto'] < 0) & (~df.get('es_transferencia_o_abono', False))
+    df['monto_mio'] = np.where(df['es_gasto'], df['monto'] * df['fraccion_mia'], 0.0)
+    df.loc[df.get('es_entre_cuentas', False)==True, 'monto_mio'] = 0.0
     return df
 
+def match_new_reimbursements(df, nuevos, window_days=21, tol=1000):
+    # Como match_reimbursements, pero solo pares con al menos un lado en `nuevos` (ids);
+    # df trae las filas sin pareja de la ventana. Devuelve (id del abono, match_id).
+    fechas = pd.to_datetime(df['fecha'], errors='coerce')
+    montos = pd.to_numeric(df['monto'], errors='coerce')
+    g = np.flatnonzero((montos < 0).to_numpy() & fechas.notna().to_numpy())
+    a = np.flatnonzero((montos > 0).to_numpy() & fechas.notna().to_numpy())
+    ns = fechas.to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    amt = montos.abs().to_numpy(dtype=float)
+    nuevo = df['id'].astype(str).isin(nuevos).to_numpy()
+    gi, ai, _ = match_pairs(ns[g], amt[g], ns[a], amt[a], window_days, tol, g_nuevo=nuevo[g], a_nuevo=nuevo[a])
+    ids = df['id'].astype(str).to_numpy()
+    return pd.DataFrame({'id': ids[a[ai]], 'match_id': ids[g[gi]]})
+
+def load_csv_master(path, columns):
+    if Path(path).exists():
+        return pd.read_csv(path, parse_dates=['fecha'])
+    return pd.DataFrame(columns=columns)
+
+def reimbursement_params(config):
+    return (int(config.get("reimbursement_window_days", 21)),
+            float(config.get("reimbursement_amount_tolerance", 1000)))
+
+def merge_csv_master(df_new, df_master):
+    # Sin frames vacíos en el concat: no deben decidir los tipos de las columnas
+    df_all = pd.concat([d for d in (df_master, df_new) if len(d)] or [df_new], ignore_index=True)
+    return df_all.drop_duplicates(subset=['id'])
+
+def write_csv_master(df_all, path):
+    df_all = compute_monto_mio(df_all)
+    df_all.to_csv(path, index=False, encoding='utf-8')
+    return df_all
+
+def update_csv_master(df_new, df_master, path, config):
+    # master.csv: se concatena entero, se empareja sobre todo el historial y se reescribe
+    # (con --master *.csv)
+    df_all = match_reimbursements(merge_csv_master(df_new, df_master), *reimbursement_params(config))
+    return write_csv_master(df_all, path)
+
+def append_parquet_master(df_new, store):
+    # Master Parquet (master_store.MasterStore): solo las filas nuevas, en sus meses
+    return store.append(compute_monto_mio(df_new[~store.contains(df_new['id'])].copy()))
+
+def match_parquet_window(df_new, store, config):
+    # Empareja reembolsos solo en la ventana de fechas que rodea a las filas nuevas; los pares
+    # ya guardados no se recalculan. Devuelve los pares nuevos.
+    fechas = pd.to_datetime(df_new['fecha'], errors='coerce').dropna()
+    if fechas.empty:
+        return 0
+    window_days, tol = reimbursement_params(config)
+    dias = pd.Timedelta(days=window_days)
+    ventana = store.read(fechas.min() - dias, fechas.max() + dias, columns=['id', 'fecha', 'monto'])
+    ventana = ventana[~ventana['id'].astype(str).isin(store.matched_ids())]
+    pares = match_new_reimbursements(ventana, set(df_new['id'].astype(str)), window_days, tol)
+    return store.add_matches(pares)
+
+def update_parquet_master(df_new, store, config):
+    # Devuelve (filas agregadas, pares nuevos)
+    agregadas = append_parquet_master(df_new, store)
+    return agregadas, match_parquet_window(df_new, store, config)
+
+def open_master_store(path):
+    # Abre el master Parquet; la primera vez lo siembra con <path>.csv si existe (migración)
+    store = MasterStore(path)
+    legado = Path(str(path).rstrip('/\\') + '.csv')
+    if not len(store) and legado.exists():
+        df_legado = pd.read_csv(legado, parse_dates=['fecha'])
+        store.append(df_legado)
+        if 'match_id' in df_legado.columns:
+            store.add_matches(df_legado.loc[df_legado['match_id'].notna(), ['id', 'match_id']])
+        print(f"Master migrado desde {legado} ({len(store)} filas)")
+    return store
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--in", dest="inp", required=True, help="CSV estandarizado (salida de prep.py)")
-    ap.add_argument("--master", dest="master", default="data/master.csv", help="Ruta del master.csv")
+    ap.add_argument("--master", dest="master", default="data/master",
+        help="Directorio del master Parquet particionado por mes (requiere pyarrow) o ruta de un master .csv")
     ap.add_argument("--merchant-map", dest="mmap", default="data/merchant_map.json")
     ap.add_argument("--config", dest="config", default="data/config.json")
     args = ap.parse_args()
@@ -77,62 +231,29 @@ def main():
 
     # Load inputs
     df_new = pd.read_csv(args.inp, parse_dates=['fecha'])
-    if Path(args.master).exists():
-        df_master = pd.read_csv(args.master, parse_dates=['fecha'])
+    merchant_map = load_json(args.mmap, {})
+    config = load_json(args.config, DEFAULT_CONFIG)
+    if args.master.lower().endswith('.csv'):
+        store, df_master = None, load_csv_master(args.master, df_new.columns)
     else:
-        df_master = pd.DataFrame(columns=df_new.columns)
+        store, df_master = open_master_store(args.master), None
 
-    merchant_map = load_json(args.mmap, {})
-    config = load_json(args.config, {
-        "account_aliases": [],
-        "reimbursement_window_days": 21,
-        "reimbursement_amount_tolerance": 1000
-    })
-
-    # Dedup by 'id'
-    ids_master = set(df_master['id'].astype(str)) if len(df_master) else set()
-    df_new = df_new[~df_new['id'].astype(str).isin(ids_master)].copy()
-
-    # Apply merchant map
-    df_new = apply_merchant_map(df_new, merchant_map)
-
-    # Mark own account transfers
-    df_new = mark_own_transfers(df_new, [a.upper() for a in config.get("account_aliases", [])])
-
-    # Combine
-    df_all = pd.concat([df_master, df_new], ignore_index=True)
-    df_all = df_all.drop_duplicates(subset=['id'])
-
-    # Reimbursement matching on full set
-    df_all = match_reimbursements(df_all,
-        window_days=int(config.get("reimbursement_window_days", 21)),
-        tol=float(config.get("reimbursement_amount_tolerance", 1000)))
-
-    # Compute monto_mio (again) based on categoria/fraccion and excluding own transfers
-    if 'fraccion_mia' not in df_all.columns:
-        df_all['fraccion_mia'] = np.where(df_all.get('es_compartido_posible', False), 0.5, 1.0)
-    df_all['es_gasto'] = (df_all['monto'] < 0) & (~df_all.get('es_transferencia_o_abono', False))
-    df_all['monto_mio'] = np.where(df_all['es_gasto'], df_all['monto'] * df_all['fraccion_mia'], 0.0)
-    df_all.loc[df_all.get('es_entre_cuentas', False)==True, 'monto_mio'] = 0.0
+    df_new = drop_known_ids(df_new, store, df_master)
+
+    df_new = enrich_new(df_new, config, flag_rules(args.config), merchant_rules(args.mmap))
 
     # Persist
-    df_all.to_csv(args.master, index=False, encoding='utf-8')
-    print(f"Master actualizado: {args.master} ({len(df_all)} filas)")
-
-    # Learn merchant_map from rows with categoria manual
-    learned = {}
-    for _, r in df_all.iterrows():
-        cat = r.get('categoria')
-        det = str(r.get('detalle_norm') or "")
-        if isinstance(cat, str) and len(cat.strip())>0 and len(det)>3:
-            # learn by exact merchant token prefix (first token or before '*')
-            key = det.split('*')[0].strip()
-            if len(key)>=3:
-                learned[key] = cat.strip()
-    # merge and save
-    merchant_map.update(learned)
-    Path(args.mmap).write_text(json.dumps(merchant_map, ensure_ascii=False, indent=2), encoding='utf-8')
-    print(f"merchant_map.json actualizado con {len(learned)} nuevas reglas (si correspondía).")
+    if store is not None:
+        agregadas, pares = update_parquet_master(df_new, store, config)
+        print(f"Master actualizado: {args.master} ({agregadas} filas nuevas, {len(store)} en total; {pares} reembolsos nuevos)")
+        df_aprender = store.read(columns=['fecha', 'detalle_norm', 'categoria'])
+    else:
+        df_all = update_csv_master(df_new, df_master, args.master, config)
+        print(f"Master actualizado: {args.master} ({len(df_all)} filas)")
+        df_aprender = df_all
+
+    nuevas, cambiadas, aprendidas = update_merchant_map(df_aprender, merchant_map, args.mmap, config)
+    print(f"merchant_map.json: {nuevas} reglas nuevas, {cambiadas} cambiadas ({aprendidas} aprendidas sobre el umbral).")
 
 if __name__ == "__main__":
     main()